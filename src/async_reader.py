@@ -0,0 +1,311 @@
+import datetime
+import functools
+import threading
+from collections.abc import Iterator
+from queue import Empty, Full, Queue
+from typing import TYPE_CHECKING, Any, Optional
+
+from botocore.exceptions import ClientError
+
+import src.msg as msg
+from src.shard_reading import (
+    EndBound,
+    is_caught_up,
+    starting_position,
+    to_record,
+    trim_to_bound,
+    with_end_time,
+)
+
+if TYPE_CHECKING:
+    import asyncio
+
+    from src.kinesis_client import KinesisClient
+    from src.record_cache import RecordCache
+
+# 非同期読み取りでの同時リクエスト数(HTTP接続数)の既定値
+# スレッドを使用しないため、スレッドでの読み取りよりも大きな値とする
+DEFAULT_ASYNC_CONCURRENCY = 256
+# イベントループから呼び出し元に渡すバッチの待機間隔(秒)
+_POLL_INTERVAL_SEC = 0.1
+# 読み取りの終了を通知するための番兵
+_READ_DONE = object()
+
+
+class AsyncShardReader:
+    """1つのイベントループで全シャードのシャードイテレーターを並行に読み進めるリーダー、aiobotocoreが必要
+
+    シャードごとにコルーチンを1つ作成し、同時に実行するリクエスト数はmax_concurrency
+    (HTTP接続プールのサイズと同じ)までに制限する
+    レート制限、再試行はKinesisClientのスケジューラーを共有し、スケジューラーの同時実行数は変更しない
+    イベントループは専用のスレッドで実行し、読み取ったバッチは上限付きのキューを経由して
+    KinesisClient.iter_recordsと同じ(シャードID, レコードバッチ)の形式で呼び出し元に渡す
+    """
+
+    def __init__(self, client: "KinesisClient", max_concurrency: int = 0) -> None:
+        """
+        Args:
+            max_concurrency: 同時リクエスト数、0の場合はDEFAULT_ASYNC_CONCURRENCY
+        """
+        self.client = client
+        self.scheduler = client.scheduler
+        self.max_concurrency = max_concurrency or DEFAULT_ASYNC_CONCURRENCY
+
+    def iter_records(
+        self, shard_ids: tuple[str, ...], after: Optional[dict[str, int]] = None
+    ) -> Iterator[tuple[str, list[dict[str, Any]]]]:
+        """複数シャードのレコードを(シャードID, レコードバッチ)の形式で逐次返す
+
+        リシャーディングで作成されたシャードは、親シャードを最後まで読み取ってから読み取りを開始する
+        """
+        if not shard_ids:
+            return
+
+        import asyncio
+
+        # 同期APIを使用する準備はイベントループの開始前に済ませる
+        bounds = self.client.snapshot_bounds(shard_ids)
+        cache = self.client.open_cache()
+        topology = self.client.topology()
+        ordered = tuple(
+            shard_id for shard_id in topology.ordered() if shard_id in shard_ids
+        ) + tuple(shard_id for shard_id in shard_ids if shard_id not in topology.shards)
+        parents = {shard_id: topology.parents(shard_id) for shard_id in ordered}
+
+        queue: Queue = Queue(maxsize=self.scheduler.workers_for(len(shard_ids)) * 2)
+        stop = threading.Event()
+        errors: list[BaseException] = []
+
+        def run() -> None:
+            try:
+                asyncio.run(
+                    self._read_all(ordered, parents, bounds, after or {}, cache, queue, stop)
+                )
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                self._put_blocking(queue, _READ_DONE, stop)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                try:
+                    item = queue.get(timeout=_POLL_INTERVAL_SEC)
+                except Empty:
+                    if thread.is_alive():
+                        continue
+                    break
+                if item is _READ_DONE:
+                    break
+                yield item
+            # イベントループ内で発生した例外を呼び出し元に伝播させる
+            if errors:
+                raise errors[0]
+        finally:
+            # 呼び出し元が途中で読み取りをやめた場合もイベントループを停止させる
+            stop.set()
+            thread.join()
+
+    async def _read_all(
+        self,
+        ordered: tuple[str, ...],
+        parents: dict[str, tuple[str, ...]],
+        bounds: dict[str, EndBound],
+        after: dict[str, int],
+        cache: Optional["RecordCache"],
+        queue: Queue,
+        stop: threading.Event,
+    ) -> None:
+        """全シャードのコルーチンを実行し、停止要求があるか、いずれかのシャードで例外が発生した場合は取り消す"""
+        import asyncio
+
+        finished = {shard_id: asyncio.Event() for shard_id in ordered}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._create_client() as kinesis_client:
+
+            async def read(shard_id: str) -> None:
+                try:
+                    # 親シャードを最後まで読み取ってから読み取りを開始する
+                    for parent in parents[shard_id]:
+                        if parent in finished:
+                            await finished[parent].wait()
+                    await self._read_shard(
+                        kinesis_client,
+                        semaphore,
+                        shard_id,
+                        bounds.get(shard_id),
+                        after.get(shard_id),
+                        cache,
+                        queue,
+                        stop,
+                    )
+                finally:
+                    finished[shard_id].set()
+
+            tasks = [asyncio.ensure_future(read(shard_id)) for shard_id in ordered]
+            try:
+                pending = set(tasks)
+                while pending and not stop.is_set():
+                    done, pending = await asyncio.wait(
+                        pending, timeout=_POLL_INTERVAL_SEC, return_when=asyncio.FIRST_EXCEPTION
+                    )
+                    # いずれかのシャードで例外が発生した場合は、他のシャードの読み取りを取り消して送出する
+                    for task in done:
+                        if not task.cancelled() and task.exception() is not None:
+                            task.result()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+
+    def _create_client(self) -> Any:
+        """aiobotocoreのKinesisクライアントを生成する、接続プールのサイズは同時実行数と同じとする"""
+        try:
+            from aiobotocore.config import AioConfig  # type: ignore
+            from aiobotocore.session import get_session  # type: ignore
+        except ImportError:
+            raise ValueError(msg.ASYNC_UNAVAILABLE)
+
+        return get_session().create_client(
+            "kinesis",
+            region_name=self.client.region,
+            config=AioConfig(max_pool_connections=self.max_concurrency),
+        )
+
+    async def _read_shard(
+        self,
+        kinesis_client: Any,
+        semaphore: "asyncio.Semaphore",
+        shard_id: str,
+        end_bound: Optional[EndBound],
+        after_sequence_number: Optional[int],
+        cache: Optional["RecordCache"],
+        queue: Queue,
+        stop: threading.Event,
+    ) -> None:
+        """シャード内のレコードをGetRecordsのレスポンス単位でキューに追加する
+
+        キャッシュの使用、読み取りの終了条件はKinesisClient.iter_shard_recordsと同じ
+        キャッシュ(SQLite)の読み書きはイベントループを止めないよう、別スレッドで実行する
+        """
+        import asyncio
+
+        end_bound = with_end_time(end_bound, self.client.end_time)
+        last_sequence_number = after_sequence_number
+        if cache is not None:
+            batches = cache.iter_batches(shard_id, after=after_sequence_number)
+            while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+                if not await self._put(queue, (shard_id, batch), stop):
+                    return
+            if await asyncio.to_thread(cache.is_closed, shard_id):
+                return
+            cached_sequence_number = await asyncio.to_thread(cache.last_sequence_number, shard_id)
+            if cached_sequence_number is not None and (
+                last_sequence_number is None or cached_sequence_number > last_sequence_number
+            ):
+                last_sequence_number = cached_sequence_number
+
+        async def call(func: Any, **kwargs: Any) -> dict:
+            # レート制限、バックオフでの待機中は同時リクエスト数に数えない
+            @functools.wraps(func)
+            async def request(**request_kwargs: Any) -> dict:
+                async with semaphore:
+                    return await func(**request_kwargs)
+
+            return await self.scheduler.call_async(shard_id, request, **kwargs)
+
+        shard_iterator: Optional[str] = await self._get_shard_iterator(
+            call,
+            kinesis_client,
+            shard_id,
+            last_sequence_number,
+            None if last_sequence_number is not None else self.client.start_time,
+        )
+        empty_polls = 0
+        while shard_iterator:
+            response = await call(
+                kinesis_client.get_records, ShardIterator=shard_iterator, Limit=1000
+            )
+            shard_iterator = response.get("NextShardIterator")
+            records, reached_end = trim_to_bound(response["Records"], end_bound)
+            self.client.hooks.on_batch(shard_id, records, response.get("MillisBehindLatest"))
+            if records:
+                empty_polls = 0
+                batch = [to_record(record) for record in records]
+                if cache is not None:
+                    await asyncio.to_thread(cache.append, shard_id, batch)
+                if not await self._put(queue, (shard_id, batch), stop):
+                    return
+            else:
+                empty_polls += 1
+            if is_caught_up(
+                response, bool(records), reached_end, empty_polls, self.client.max_empty_polls
+            ):
+                break
+
+        if not shard_iterator and cache is not None:
+            await asyncio.to_thread(cache.mark_closed, shard_id)
+
+    async def _get_shard_iterator(
+        self,
+        call: Any,
+        kinesis_client: Any,
+        shard_id: str,
+        last_sequence_number: Optional[int],
+        start_time: Optional[datetime.datetime],
+    ) -> str:
+        """starting_positionの開始位置でシャードイテレーターを取得する"""
+        position = starting_position(last_sequence_number, start_time)
+        kwargs: dict[str, Any] = {"ShardIteratorType": position["Type"]}
+        if "Timestamp" in position:
+            kwargs["Timestamp"] = position["Timestamp"]
+        if "SequenceNumber" in position:
+            kwargs["StartingSequenceNumber"] = position["SequenceNumber"]
+        try:
+            response = await call(
+                kinesis_client.get_shard_iterator,
+                StreamName=self.client.target_stream_name,
+                ShardId=shard_id,
+                **kwargs,
+            )
+        except ClientError as e:
+            # 指定したシーケンス番号が保持期間を過ぎている場合はシャードの先頭から読み取る
+            if (
+                position["Type"] != "AFTER_SEQUENCE_NUMBER"
+                or e.response.get("Error", {}).get("Code") != "InvalidArgumentException"
+            ):
+                raise
+            response = await call(
+                kinesis_client.get_shard_iterator,
+                StreamName=self.client.target_stream_name,
+                ShardId=shard_id,
+                ShardIteratorType="TRIM_HORIZON",
+            )
+        return response["ShardIterator"]
+
+    @staticmethod
+    async def _put(queue: Queue, item: tuple, stop: threading.Event) -> bool:
+        """イベントループを止めずにキューに要素を追加する、停止要求があればFalseを返す"""
+        import asyncio
+
+        while not stop.is_set():
+            try:
+                queue.put_nowait(item)
+                return True
+            except Full:
+                await asyncio.sleep(0.01)
+        return False
+
+    @staticmethod
+    def _put_blocking(queue: Queue, item: object, stop: threading.Event) -> None:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=_POLL_INTERVAL_SEC)
+                return
+            except Full:
+                continue
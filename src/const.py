@@ -1,8 +1,25 @@
 SEQ_NUM = "SequenceNumber"
 PARTITION_KEY = "PartitionKey"
 DATA = "Data"
+RAW_DATA = "RawData"
 TIMESTAMP = "ApproximateArrivalTimestamp"
 SHARD_ID = "ShardId"
 NUM_OF_RECORDS = "NumOfRecords"
 LAST_ADDED_TIME = "LastAddedTime"
 NUMBER = "No"
+STATE = "State"
+PARENT_SHARD_ID = "ParentShardId"
+HASH_KEY_SHARE = "HashKeyShare"
+AVG_DATA_SIZE = "AvgDataSize"
+TOTAL_BYTES = "TotalBytes"
+MIN_SIZE = "MinSize"
+P50_SIZE = "P50Size"
+P99_SIZE = "P99Size"
+MAX_SIZE = "MaxSize"
+FIRST_ADDED_TIME = "FirstAddedTime"
+ESTIMATED_COUNT = "EstimatedCount"
+TIME = "Time"
+RECORDS_PER_SEC = "RecordsPerSec"
+MILLIS_BEHIND_LATEST = "MillisBehindLatest"
+API_CALLS = "ApiCalls"
+THROTTLES = "Throttles"
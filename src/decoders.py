@@ -0,0 +1,139 @@
+import base64
+import binascii
+import gzip
+import hashlib
+import zlib
+from collections.abc import Callable, Iterator
+
+import src.msg as msg
+
+# KPL(Kinesis Producer Library)で集約されたレコードの先頭に付与されるマジックナンバー
+KPL_MAGIC = b"\xf3\x89\x9a\xc2"
+KPL_DIGEST_SIZE = 16
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def decode_gzip(payload: bytes) -> list[bytes]:
+    """gzip圧縮されたDataを展開する、gzip形式でない場合はそのまま返す"""
+    try:
+        return [gzip.decompress(payload)]
+    except (OSError, EOFError, zlib.error):
+        return [payload]
+
+
+def decode_base64(payload: bytes) -> list[bytes]:
+    """base64エンコードされたDataをデコードする、base64形式でない場合はそのまま返す"""
+    try:
+        return [base64.b64decode(payload, validate=True)]
+    except (binascii.Error, ValueError):
+        return [payload]
+
+
+def decode_kpl(payload: bytes) -> list[bytes]:
+    """KPLで集約されたDataを個々のユーザーレコードのDataに分解する
+
+    集約レコードの形式: マジックナンバー(4byte) + AggregatedRecord(protobuf) + MD5(16byte)
+    集約されていない、または形式が不正な場合はそのまま返す
+    """
+    if not payload.startswith(KPL_MAGIC) or len(payload) < len(KPL_MAGIC) + KPL_DIGEST_SIZE:
+        return [payload]
+    message = payload[len(KPL_MAGIC) : -KPL_DIGEST_SIZE]
+    if hashlib.md5(message).digest() != payload[-KPL_DIGEST_SIZE:]:
+        return [payload]
+
+    try:
+        # AggregatedRecordのフィールド3(records)がユーザーレコード、その中のフィールド3がData
+        return [
+            record_value
+            for field, value in _iter_protobuf_fields(message)
+            if field == 3 and isinstance(value, bytes)
+            for record_field, record_value in _iter_protobuf_fields(value)
+            if record_field == 3 and isinstance(record_value, bytes)
+        ]
+    except (IndexError, ValueError):
+        return [payload]
+
+
+def decode_auto(payload: bytes) -> list[bytes]:
+    """マジックナンバーからKPL集約、gzip圧縮を判別して展開する"""
+    payloads = decode_kpl(payload) if payload.startswith(KPL_MAGIC) else [payload]
+    return [decode_gzip(item)[0] if item.startswith(GZIP_MAGIC) else item for item in payloads]
+
+
+def _iter_protobuf_fields(message: bytes) -> Iterator[tuple[int, object]]:
+    """protobufのメッセージを(フィールド番号, 値)の組に分解する
+
+    可変長整数はint、長さ付きのフィールドはbytesとして返す
+    """
+    position = 0
+    while position < len(message):
+        key, position = _read_varint(message, position)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, position = _read_varint(message, position)
+            yield field, value
+        elif wire_type == 2:
+            length, position = _read_varint(message, position)
+            if position + length > len(message):
+                raise ValueError("truncated protobuf message")
+            yield field, message[position : position + length]
+            position += length
+        elif wire_type == 1:
+            position += 8
+        elif wire_type == 5:
+            position += 4
+        else:
+            raise ValueError(f"unsupported wire type: {wire_type}")
+
+
+def _read_varint(message: bytes, position: int) -> tuple[int, int]:
+    """protobufの可変長整数を読み取り、(値, 次の位置)を返す"""
+    value = 0
+    shift = 0
+    while True:
+        byte = message[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+# 選択可能なデコーダー、utf-8はDataを変換せずに文字列として表示する
+DECODERS: dict[str, Callable[[bytes], list[bytes]]] = {
+    "utf-8": lambda payload: [payload],
+    "gzip": decode_gzip,
+    "base64": decode_base64,
+    "kpl": decode_kpl,
+    "auto": decode_auto,
+}
+
+
+class DataDecoder:
+    """レコードのData(bytes)を表示、検索用の文字列に変換するクラス
+
+    デコーダーはカンマ区切りで複数指定でき、指定した順に適用する(例: 'kpl,gzip')
+    変換後にUTF-8として解釈できないバイトはエスケープして表示する
+    """
+
+    def __init__(self, names: str = "utf-8") -> None:
+        self.names = tuple(name.strip() for name in names.split(",") if name.strip())
+        if unknown := [name for name in self.names if name not in DECODERS]:
+            raise ValueError(f"{msg.INVALID_DECODER}: {', '.join(unknown)}")
+        self.steps = [DECODERS[name] for name in self.names if name != "utf-8"]
+
+    @property
+    def is_identity(self) -> bool:
+        """Dataを変換せずにそのまま扱うかどうか"""
+        return not self.steps
+
+    def decode_payloads(self, payload: bytes) -> list[str]:
+        """Dataを文字列に変換する、KPLで集約されている場合はユーザーレコードごとの文字列のリストを返す"""
+        payloads = [payload]
+        for step in self.steps:
+            payloads = [decoded for item in payloads for decoded in step(item)]
+        return [item.decode("utf-8", errors="backslashreplace") for item in payloads]
+
+    def decode(self, payload: bytes) -> str:
+        """Dataを文字列に変換する、KPLで集約されている場合はユーザーレコードごとに改行で区切る"""
+        return "\n".join(self.decode_payloads(payload))
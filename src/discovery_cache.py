@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import time
+from collections.abc import Callable, Iterable
+
+# リージョン、DataStream一覧のキャッシュの有効期間(秒)の既定値
+DEFAULT_DISCOVERY_TTL = 3600
+DEFAULT_DISCOVERY_CACHE_PATH = os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "kdv",
+    "discovery.json",
+)
+
+
+class DiscoveryCache:
+    """リージョン一覧、DataStream一覧を有効期間付きでJSONファイルに保存するキャッシュ
+
+    DataStream一覧はアカウントごとに異なるため、キーにはAWSプロファイル名を含める
+    ttlが0以下の場合はキャッシュを使用しない
+    """
+
+    def __init__(
+        self, path: str = DEFAULT_DISCOVERY_CACHE_PATH, ttl: int = DEFAULT_DISCOVERY_TTL
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        """AWSプロファイル名を含むキャッシュのキーを返す"""
+        profile = os.getenv("AWS_PROFILE") or "default"
+        return ":".join((profile, *parts))
+
+    def fetch(self, key: str, loader: Callable[[], Iterable[str]]) -> tuple[str, ...]:
+        """有効期間内のキャッシュがあればその値を、なければloaderで取得した値を返す
+
+        空の一覧は直後に作成される可能性があるためキャッシュしない
+        """
+        if self.ttl > 0:
+            entry = self._load().get(key)
+            if entry and time.time() - entry["fetched_at"] < self.ttl:
+                return tuple(entry["values"])
+
+        values = tuple(loader())
+        if self.ttl > 0 and values:
+            self._save(key, values)
+        return values
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _save(self, key: str, values: tuple[str, ...]) -> None:
+        """キャッシュファイルを更新する、書き込み途中のファイルを読み込まないよう置き換えで更新する"""
+        entries = self._load()
+        entries[key] = {"fetched_at": time.time(), "values": list(values)}
+        directory = os.path.dirname(self.path) or "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, delete=False, encoding="utf-8"
+            ) as file:
+                json.dump(entries, file)
+            os.replace(file.name, self.path)
+        except OSError:
+            # キャッシュに書き込めない場合も処理は継続する
+            pass
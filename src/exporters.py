@@ -0,0 +1,153 @@
+import abc
+import base64
+import csv
+import json
+import sys
+from collections.abc import Iterable
+from typing import IO, Any
+
+import src.const as const
+import src.msg as msg
+from src.decoders import DataDecoder
+from src.time_util import format_iso_timestamp, format_timestamp
+
+# Parquetの1つのRowGroupにまとめるレコード数
+PARQUET_ROW_GROUP_SIZE = 10000
+
+
+def format_record(record: dict[str, Any], decoder: DataDecoder) -> dict[str, Any]:
+    """レコードの各値を出力用の文字列に変換する"""
+    formatted = dict(record)
+    formatted[const.SEQ_NUM] = str(record[const.SEQ_NUM])
+    formatted[const.DATA] = decoder.decode(record[const.DATA])
+    formatted[const.TIMESTAMP] = format_timestamp(record[const.TIMESTAMP])
+    return formatted
+
+
+def export_record(record: dict[str, Any], decoder: DataDecoder) -> dict[str, Any]:
+    """レコードの各値をファイル出力用の文字列に変換する
+
+    Dataはデコード済みの文字列、RawDataは元のバイト列をbase64で符号化した文字列、
+    追加日時はUTCオフセット付きのISO 8601形式とする
+    """
+    exported = dict(record)
+    exported[const.SEQ_NUM] = str(record[const.SEQ_NUM])
+    exported[const.DATA] = decoder.decode(record[const.DATA])
+    exported[const.RAW_DATA] = base64.b64encode(record[const.DATA]).decode("ascii")
+    exported[const.TIMESTAMP] = format_iso_timestamp(record[const.TIMESTAMP])
+    return exported
+
+
+class RecordWriter(abc.ABC):
+    """レコードをバッチ単位でファイルに逐次書き込むクラスの基底クラス
+
+    path に '-' を指定した場合は標準出力に書き込む
+    """
+
+    extension = ""
+    binary = False
+
+    def __init__(self, path: str, fieldnames: tuple[str, ...], decoder: DataDecoder) -> None:
+        self.path = path
+        self.fieldnames = fieldnames
+        self.decoder = decoder
+        self.file: IO
+        if path == "-":
+            self.file = sys.stdout.buffer if self.binary else sys.stdout
+        elif self.binary:
+            self.file = open(path, mode="wb")
+        else:
+            self.file = open(path, mode="w", newline="", encoding="utf-8")
+
+    @abc.abstractmethod
+    def write(self, records: Iterable[dict[str, Any]]) -> None:
+        """レコードのバッチを書き込む"""
+
+    def close(self) -> None:
+        if self.path == "-":
+            self.file.flush()
+        else:
+            self.file.close()
+
+
+class CsvRecordWriter(RecordWriter):
+    extension = "csv"
+
+    def __init__(self, path: str, fieldnames: tuple[str, ...], decoder: DataDecoder) -> None:
+        super().__init__(path, fieldnames, decoder)
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction="ignore")
+        self.writer.writeheader()
+
+    def write(self, records: Iterable[dict[str, Any]]) -> None:
+        self.writer.writerows(export_record(record, self.decoder) for record in records)
+
+
+class JsonlRecordWriter(RecordWriter):
+    """1行に1レコードのJSONを書き込む"""
+
+    extension = "jsonl"
+
+    def write(self, records: Iterable[dict[str, Any]]) -> None:
+        for record in records:
+            exported = export_record(record, self.decoder)
+            row = {name: exported[name] for name in self.fieldnames}
+            self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+class ParquetRecordWriter(RecordWriter):
+    """列指向、zstd圧縮のParquetファイルを書き込む、pyarrowが必要
+
+    レコードはPARQUET_ROW_GROUP_SIZE件ごとに1つのRowGroupとして書き込み、
+    メモリ上に保持するレコード数を抑える
+    追加日時はUTCのタイムスタンプ型、シーケンス番号は桁数が大きいため文字列として格納する
+    RawDataは元のバイト列をバイナリ型として格納する
+    """
+
+    extension = "parquet"
+    binary = True
+
+    def __init__(self, path: str, fieldnames: tuple[str, ...], decoder: DataDecoder) -> None:
+        try:
+            import pyarrow as pa  # type: ignore
+            import pyarrow.parquet as pq  # type: ignore
+        except ImportError:
+            raise ValueError(msg.PARQUET_UNAVAILABLE)
+        super().__init__(path, fieldnames, decoder)
+        self.pa = pa
+        types = {const.TIMESTAMP: pa.timestamp("ms", tz="UTC"), const.RAW_DATA: pa.binary()}
+        self.schema = pa.schema([(name, types.get(name, pa.string())) for name in fieldnames])
+        self.writer = pq.ParquetWriter(self.file, self.schema, compression="zstd")
+        self.columns: dict[str, list] = {name: [] for name in fieldnames}
+
+    def write(self, records: Iterable[dict[str, Any]]) -> None:
+        for record in records:
+            for name, column in self.columns.items():
+                if name == const.SEQ_NUM:
+                    column.append(str(record[name]))
+                elif name == const.DATA:
+                    column.append(self.decoder.decode(record[name]))
+                elif name == const.RAW_DATA:
+                    column.append(record[const.DATA])
+                else:
+                    column.append(record[name])
+            if len(self.columns[const.SEQ_NUM]) >= PARQUET_ROW_GROUP_SIZE:
+                self._flush()
+
+    def _flush(self) -> None:
+        if not self.columns[const.SEQ_NUM]:
+            return
+        self.writer.write_table(self.pa.table(self.columns, schema=self.schema))
+        self.columns = {name: [] for name in self.columns}
+
+    def close(self) -> None:
+        self._flush()
+        self.writer.close()
+        super().close()
+
+
+# dump_recordsで選択可能なファイル形式
+RECORD_WRITERS: dict[str, type[RecordWriter]] = {
+    "csv": CsvRecordWriter,
+    "jsonl": JsonlRecordWriter,
+    "parquet": ParquetRecordWriter,
+}
@@ -0,0 +1,112 @@
+import time
+import uuid
+from collections.abc import Generator
+from typing import Any, Optional
+
+from botocore.exceptions import ClientError
+
+import src.msg as msg
+from src.read_scheduler import ShardReadScheduler
+
+# 一時的に登録するコンシューマー名の接頭辞
+CONSUMER_NAME_PREFIX = "kdv-"
+# 登録したコンシューマーがACTIVEになるまで待機する秒数の上限と、状態を確認する間隔(秒)
+CONSUMER_ACTIVE_TIMEOUT_SEC = 60
+CONSUMER_POLL_INTERVAL_SEC = 1.0
+
+
+class StreamConsumer:
+    """拡張ファンアウト(SubscribeToShard)で読み取るために一時的に登録するコンシューマー
+
+    コンシューマーにはシャードあたり2MB/秒の専用の読み取りスループットが割り当てられるため、
+    GetRecordsで読み取る他のコンシューマーのスループットを消費しない
+    登録中のコンシューマーには料金が発生するため、不要になった時点でderegisterで削除すること
+    """
+
+    def __init__(
+        self,
+        kinesis_client: Any,
+        stream_arn: str,
+        scheduler: ShardReadScheduler,
+        name: str = "",
+    ) -> None:
+        self.kinesis_client = kinesis_client
+        self.stream_arn = stream_arn
+        self.scheduler = scheduler
+        self.name = name or f"{CONSUMER_NAME_PREFIX}{uuid.uuid4().hex[:12]}"
+        self.arn: Optional[str] = None
+
+    def register(self) -> None:
+        """コンシューマーを登録し、ACTIVEになるまで待機する"""
+        response = self.kinesis_client.register_stream_consumer(
+            StreamARN=self.stream_arn, ConsumerName=self.name
+        )
+        self.arn = response["Consumer"]["ConsumerARN"]
+        status = response["Consumer"]["ConsumerStatus"]
+        deadline = time.monotonic() + CONSUMER_ACTIVE_TIMEOUT_SEC
+        while status != "ACTIVE":
+            if time.monotonic() > deadline:
+                self.deregister()
+                raise TimeoutError(msg.CONSUMER_NOT_ACTIVE)
+            time.sleep(CONSUMER_POLL_INTERVAL_SEC)
+            status = self.kinesis_client.describe_stream_consumer(ConsumerARN=self.arn)[
+                "ConsumerDescription"
+            ]["ConsumerStatus"]
+
+    def deregister(self) -> None:
+        """コンシューマーを削除する、削除済みの場合は何もしない"""
+        if self.arn is None:
+            return
+        try:
+            self.kinesis_client.deregister_stream_consumer(ConsumerARN=self.arn)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ResourceNotFoundException":
+                raise
+        self.arn = None
+
+    def subscribe(
+        self, shard_id: str, starting_position: dict[str, Any]
+    ) -> Generator[dict[str, Any], None, None]:
+        """シャードを購読し、受信したSubscribeToShardEventを順に返す
+
+        1回の購読は5分で終了するため、最後に受信したContinuationSequenceNumberの直後から購読し直す
+        クローズ済みのシャードの末尾まで受信した(ContinuationSequenceNumberが返却されない)時点で終了する
+        開始位置のシーケンス番号が保持期間を過ぎている場合はシャードの先頭から購読する
+        """
+        position = starting_position
+        subscribed = False
+        while True:
+            try:
+                response = self.scheduler.call(
+                    shard_id,
+                    self.kinesis_client.subscribe_to_shard,
+                    ConsumerARN=self.arn,
+                    ShardId=shard_id,
+                    StartingPosition=position,
+                )
+            except ClientError as e:
+                if (
+                    subscribed
+                    or position["Type"] != "AFTER_SEQUENCE_NUMBER"
+                    or e.response.get("Error", {}).get("Code") != "InvalidArgumentException"
+                ):
+                    raise
+                position = {"Type": "TRIM_HORIZON"}
+                continue
+            subscribed = True
+
+            event_stream = response["EventStream"]
+            try:
+                for event in event_stream:
+                    shard_event = event.get("SubscribeToShardEvent")
+                    if shard_event is None:
+                        continue
+                    yield shard_event
+                    continuation = shard_event.get("ContinuationSequenceNumber")
+                    if continuation is None:
+                        return
+                    position = {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": continuation}
+            finally:
+                # 購読を途中でやめた場合もHTTP接続を解放する
+                if hasattr(event_stream, "close"):
+                    event_stream.close()
@@ -1,104 +1,877 @@
+import datetime
+import heapq
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import closing
 from concurrent.futures import ThreadPoolExecutor
-from itertools import chain
+from queue import Empty, Full, Queue
+from typing import Any, NamedTuple, Optional
 
-import boto3
+from botocore.exceptions import ClientError
 
 import src.const as const
+from src.fanout import StreamConsumer
+from src.read_metrics import ReadHooks
+from src.read_scheduler import ShardReadScheduler
+from src.record_cache import RecordCache
+from src.shard_reading import (
+    DEFAULT_MAX_EMPTY_POLLS,
+    EndBound,
+    is_caught_up,
+    starting_position,
+    to_record,
+    trim_to_bound,
+    with_end_time,
+)
+from src.shard_topology import ShardInfo, ShardTopology
+from src.time_util import to_epoch_millis
+
+# シャード読み取りスレッドの終了を通知するための番兵
+_SHARD_DONE = object()
+# 最近のレコードを探す際の最初の読み取り期間(秒)と、見つからない場合に期間を広げる倍率
+RECENT_WINDOW_SEC = 60
+RECENT_WINDOW_GROWTH = 2
+# サンプリングによる概算時にシャードごとに読み取るGetRecordsのレスポンス数の既定値
+DEFAULT_SAMPLE_BATCHES = 3
+# 追跡中のシャードが最新のレコードに追いついた後、次にGetRecordsを呼び出すまでの間隔(秒)
+DEFAULT_FOLLOW_INTERVAL = 1.0
+# レコードの読み取り方式
+# polling: GetRecordsで読み取る、efo: 一時的なコンシューマーを登録し拡張ファンアウト(SubscribeToShard)で受信する
+READ_ENGINES = ("polling", "efo")
+# GetRecordsでの全件読み取りの実行方式
+# thread: シャードごとにスレッドで読み取る、async: 1つのイベントループで全シャードを並行に読み取る
+READ_BACKENDS = ("thread", "async")
+
+
+class ShardSample(NamedTuple):
+    """シャードの先頭から数バッチのみを読み取った結果、シャード全体のレコード数などの概算に使用する"""
+
+    num_of_records: int = 0
+    total_bytes: int = 0
+    first_timestamp: Optional[int] = None
+    last_timestamp: Optional[int] = None
+    millis_behind_latest: int = 0
+    # シャードの末尾まで読み取ったかどうか、Trueの場合は概算ではなく実際の値となる
+    complete: bool = False
+
+    def estimated_records(self) -> int:
+        """サンプル内の追加レートが末尾まで続くと仮定したシャードのレコード数を返す"""
+        if self.complete or self.first_timestamp is None or self.last_timestamp is None:
+            return self.num_of_records
+        span = self.last_timestamp - self.first_timestamp
+        if span <= 0:
+            return self.num_of_records
+        rate = self.num_of_records / span
+        return self.num_of_records + round(rate * self.millis_behind_latest)
+
+    def estimated_last_added(self) -> Optional[int]:
+        """シャードに最後にレコードが追加された日時(エポックミリ秒)を返す
+
+        MillisBehindLatestは最後に読み取ったレコードとシャードの末尾のレコードの追加日時の差を表す
+        """
+        if self.last_timestamp is None:
+            return None
+        return self.last_timestamp + (0 if self.complete else self.millis_behind_latest)
 
 
 class KinesisClient:
     """AWSとの通信を行う処理をまとめたクラス"""
 
-    def __init__(self, region: str, stream_name: str) -> None:
+    def __init__(
+        self,
+        region: str,
+        stream_name: str,
+        scheduler: Optional[ShardReadScheduler] = None,
+        snapshot_end: bool = False,
+        max_empty_polls: int = DEFAULT_MAX_EMPTY_POLLS,
+        cache_dir: str = "",
+        start_time: Optional[datetime.datetime] = None,
+        end_time: Optional[datetime.datetime] = None,
+        open_shards_only: bool = False,
+        read_engine: str = "polling",
+        read_backend: str = "thread",
+        async_concurrency: int = 0,
+        hooks: Optional[ReadHooks] = None,
+    ) -> None:
+        """
+        Args:
+            scheduler: シャード読み取りの並列数、レート制限を制御するスケジューラー
+            snapshot_end: 読み取り開始時点の終端を記録し、それ以降に追加されたレコードは読み取らない
+            max_empty_polls: 連続して空のレスポンスが返却された場合に読み取りを打ち切る回数
+            cache_dir: 取得済みレコードのキャッシュを保存するディレクトリ、空の場合はキャッシュしない
+                読み取り期間(start_time, end_time)を指定した場合はキャッシュを使用しない
+            start_time: 読み取り期間の開始日時、指定した場合はAT_TIMESTAMPで読み取りを開始する
+            end_time: 読み取り期間の終了日時、これより後に追加されたレコードは読み取らない
+            open_shards_only: オープン中のシャードのみを対象とし、リシャーディングで
+                クローズ済みとなったシャードは読み取らない
+            read_engine: レコードの読み取り方式(polling, efo)、efoの場合は全件の読み取りとレコードの追跡に
+                拡張ファンアウトを使用し、他のコンシューマーとGetRecordsのスループットを共有しない
+                使用後はcloseでコンシューマーを削除すること
+            read_backend: GetRecordsでの全件読み取り(iter_records)の実行方式(thread, async)、
+                asyncの場合はaiobotocoreを使用し、スレッドを増やさずに多数のシャードを並行に読み取る
+            async_concurrency: read_backendがasyncの場合の同時リクエスト数、0の場合は256
+                スケジューラーの同時実行数(スレッド数、boto3の接続プールのサイズ)とは別に設定する
+            hooks: API呼び出し、レコードの取得を通知するフック、スケジューラーのフックとしても使用する
+        """
         self.region = region
         self.target_stream_name = stream_name
-        self.kinesis_client = boto3.client("kinesis", region_name=region)
-        self.shard_ids: tuple = ()
-        self.all_records: dict = {}
+        self.scheduler = scheduler or ShardReadScheduler()
+        if hooks is not None:
+            self.scheduler.hooks = hooks
+        # boto3のクライアントは最初のAPI呼び出し時に生成する
+        self._kinesis_client: Any = None
+        self.client_lock = threading.Lock()
+        self.snapshot_end = snapshot_end
+        self.max_empty_polls = max_empty_polls
+        self.start_time = start_time
+        self.end_time = end_time
+        # キャッシュはシャードの先頭から連続したレコードのみを保持するため、期間指定時は使用しない
+        self.cache_dir = "" if start_time or end_time else cache_dir
+        self.cache: Optional[RecordCache] = None
+        self.cache_lock = threading.Lock()
+        self.open_shards_only = open_shards_only
+        self.stream_summary: Optional[dict] = None
+        self.shard_topology: Optional[ShardTopology] = None
+        self.read_engine = read_engine
+        self.read_backend = read_backend
+        self.async_concurrency = async_concurrency
+        self.stream_consumer: Optional[StreamConsumer] = None
+        self.consumer_lock = threading.Lock()
+
+    @property
+    def hooks(self) -> ReadHooks:
+        """API呼び出し、レコードの取得を通知するフック"""
+        return self.scheduler.hooks
+
+    @property
+    def kinesis_client(self) -> Any:
+        """boto3のKinesisクライアント、読み込みに時間がかかるためboto3は最初の使用時に読み込む
+
+        シャード読み取りスレッド数分のHTTP接続を保持し、スレッド間で接続を使い回す
+        """
+        if self._kinesis_client is None:
+            with self.client_lock:
+                if self._kinesis_client is None:
+                    import boto3
+                    from botocore.config import Config
+
+                    self._kinesis_client = boto3.client(
+                        "kinesis",
+                        region_name=self.region,
+                        config=Config(max_pool_connections=self.scheduler.max_concurrency),
+                    )
+        return self._kinesis_client
+
+    def consumer(self) -> StreamConsumer:
+        """拡張ファンアウトのコンシューマー、最初の使用時に登録する"""
+        with self.consumer_lock:
+            if self.stream_consumer is None:
+                consumer = StreamConsumer(
+                    self.kinesis_client,
+                    self.describe_stream_summary()["StreamARN"],
+                    self.scheduler,
+                )
+                consumer.register()
+                self.stream_consumer = consumer
+            return self.stream_consumer
+
+    def close(self) -> None:
+        """登録した拡張ファンアウトのコンシューマーを削除する"""
+        with self.consumer_lock:
+            if self.stream_consumer is not None:
+                self.stream_consumer.deregister()
+                self.stream_consumer = None
 
     @classmethod
     def get_regions(cls) -> list[str]:
+        import boto3
+
         ec2_client = boto3.client("ec2")
         regions = ec2_client.describe_regions()
         return [region["RegionName"] for region in regions["Regions"]]
 
     @classmethod
-    def get_stream_names(cls, region: str) -> tuple[str]:
-        """対象アカウント、リージョンに存在するKinesis Data Streams DataStreamを全て取得する"""
-        response = boto3.client("kinesis", region_name=region).list_streams(Limit=100)
-        return tuple(response["StreamNames"])
+    def get_stream_names(cls, region: str) -> tuple[str, ...]:
+        """対象アカウント、リージョンに存在するKinesis Data Streams DataStreamを全て取得する
+
+        ListStreamsは1回の呼び出しで最大100件までのため、HasMoreStreamsがFalseになるまで取得する
+        続きの指定はNextTokenを優先し、返却されない場合はExclusiveStartStreamNameを使用する
+        """
+        import boto3
+
+        kinesis_client = boto3.client("kinesis", region_name=region)
+        stream_names: list[str] = []
+        kwargs: dict[str, Any] = {"Limit": 100}
+        while True:
+            response = kinesis_client.list_streams(**kwargs)
+            stream_names.extend(response["StreamNames"])
+            if not response.get("HasMoreStreams") or not response["StreamNames"]:
+                return tuple(stream_names)
+            if next_token := response.get("NextToken"):
+                kwargs = {"NextToken": next_token}
+            else:
+                kwargs = {"Limit": 100, "ExclusiveStartStreamName": stream_names[-1]}
 
-    def list_shards(self) -> tuple[str]:
-        """処理対象DataStreamのシャードID一覧を取得する"""
+    def list_shards(self) -> tuple[str, ...]:
+        """処理対象DataStreamのシャードID一覧を親シャードが子シャードより前となる順序で取得する
+
+        open_shards_onlyの場合はオープン中のシャードのみを返す
+        """
+        return self.topology().ordered(open_only=self.open_shards_only)
+
+    def topology(self) -> ShardTopology:
+        """処理対象DataStreamのシャードの親子関係を取得する"""
+        if self.shard_topology is None:
+            self.shard_topology = ShardTopology(
+                ShardInfo.from_response(shard) for shard in self.describe_shards()
+            )
+        return self.shard_topology
+
+    def describe_shards(self) -> list[dict[str, Any]]:
+        """処理対象DataStreamのシャードの詳細(ハッシュキー範囲、シーケンス番号範囲など)を取得する
+
+        ListShardsは1回の呼び出しで最大1000シャードまでのため、NextTokenがなくなるまで取得する
+        """
+        shards: list[dict[str, Any]] = []
         response = self.kinesis_client.list_shards(StreamName=self.target_stream_name)
-        shard_ids = [shard[const.SHARD_ID] for shard in response["Shards"]]
-        return tuple(shard_ids)
+        shards.extend(response["Shards"])
+        while next_token := response.get("NextToken"):
+            # NextTokenを指定する場合はStreamNameを指定できない
+            response = self.kinesis_client.list_shards(NextToken=next_token)
+            shards.extend(response["Shards"])
+        return shards
+
+    def describe_stream_summary(self) -> dict:
+        """処理対象DataStreamの概要(作成日時、保持期間など)を取得する"""
+        if self.stream_summary is None:
+            self.stream_summary = self.kinesis_client.describe_stream_summary(
+                StreamName=self.target_stream_name
+            )["StreamDescriptionSummary"]
+        return self.stream_summary
 
-    def get_records(self, shard_ids: tuple[str]) -> dict[str, dict[int, dict[str, str]]]:
+    def open_cache(self) -> Optional[RecordCache]:
+        """レコードキャッシュを開く、cache_dirが指定されていない場合はNoneを返す"""
+        if not self.cache_dir:
+            return None
+        with self.cache_lock:
+            if self.cache is None:
+                cache = RecordCache(self.cache_dir, self.region, self.target_stream_name)
+                summary = self.describe_stream_summary()
+                cache.validate(
+                    str(summary["StreamCreationTimestamp"]), summary["RetentionPeriodHours"]
+                )
+                self.cache = cache
+        return self.cache
+
+    def snapshot_bounds(self, shard_ids: tuple[str, ...]) -> dict[str, EndBound]:
+        """読み取り開始時点でのシャードごとの終端を返す、snapshot_endが無効な場合は空
+
+        クローズ済みのシャードはListShardsのEndingSequenceNumberを終端とし、
+        オープン中のシャードは終端のシーケンス番号が確定しないため現在時刻を終端とする
+        """
+        if not self.snapshot_end:
+            return {}
+
+        snapshot_time = datetime.datetime.now(datetime.timezone.utc)
+        ending_sequence_numbers = {
+            shard[const.SHARD_ID]: shard["SequenceNumberRange"].get("EndingSequenceNumber")
+            for shard in self.describe_shards()
+        }
+        return {
+            shard_id: (
+                EndBound(sequence_number=int(ending_sequence_numbers[shard_id]))
+                if ending_sequence_numbers.get(shard_id)
+                else EndBound(timestamp=snapshot_time)
+            )
+            for shard_id in shard_ids
+        }
+
+    def get_records(self, shard_ids: tuple[str, ...]) -> dict[str, dict[int, dict[str, Any]]]:
         """処理対象DataStreamに格納されている全てのレコードを取得する
 
+        全レコードをメモリ上に展開するため、小さなストリーム向け
+        大きなストリームではiter_recordsを使用してバッチ単位で処理すること
+
         Return Example:
           {
             'shardId-000000000000': {
-              '49657051368801430459340561020608066337892395447780114434': {
-                'Data': '{"recordId":"RCS3ffmbiL","requestId":"1-3-diHOsUpMZsWnB5Bp",'
+              49657051368801430459340561020608066337892395447780114434: {
+                'Data': b'{"recordId":"RCS3ffmbiL","requestId":"1-3-diHOsUpMZsWnB5Bp",'
                 'PartitionKey': 'RCS3ffmbiL'
-                'ApproximateArrivalTimestamp': '2024-10-24 14:23:43.000'
+                'ApproximateArrivalTimestamp': 1729747423000
               }
-              '49657051368801430459340561020609275263712010076954820610': {
-                'Data': '{"recordId":"4l7RHBOOWj","requestId":"1-3-diHOsUpMZsWnB5Bp",'
+              49657051368801430459340561020609275263712010076954820610: {
+                'Data': b'{"recordId":"4l7RHBOOWj","requestId":"1-3-diHOsUpMZsWnB5Bp",'
                 'PartitionKey': '4l7RHBOOWj'
-                'ApproximateArrivalTimestamp': '2024-10-24 14:23:43.001'
+                'ApproximateArrivalTimestamp': 1729747423001
           │   },
             'shardId-000000000001': {
             ...
         """
-        shard_map = {}
-
-        # シャードからレコードの読み取り処理、マルチスレッドで実行
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            results = executor.map(self.read_shard_records, shard_ids)
-        shard_map = dict(chain.from_iterable(d.items() for d in list(results)))
+        shard_map: dict[str, dict[int, dict[str, Any]]] = {shard_id: {} for shard_id in shard_ids}
+        for shard_id, batch in self.iter_records(shard_ids):
+            for record in batch:
+                shard_map[shard_id][record[const.SEQ_NUM]] = {
+                    const.DATA: record[const.DATA],
+                    const.PARTITION_KEY: record[const.PARTITION_KEY],
+                    const.TIMESTAMP: record[const.TIMESTAMP],
+                }
         return shard_map
 
-    def read_shard_records(self, shard_id: str) -> dict[str, dict[int, dict[str, str]]]:
-        """シャード内の全てのレコードを取得する
+    def iter_records(
+        self, shard_ids: tuple[str, ...], after: Optional[dict[str, int]] = None
+    ) -> Iterator[tuple[str, list[dict[str, Any]]]]:
+        """複数シャードのレコードを(シャードID, レコードバッチ)の形式で逐次返す
 
-        Return Example:
-          {
-            'shardId-000000000000': {
-              '49657051368801430459340561020608066337892395447780114434': {
-                'Data': '{"recordId":"RCS3ffmbiL","requestId":"1-3-diHOsUpMZsWnB5Bp",'
-                'PartitionKey': 'RCS3ffmbiL'
-                'ApproximateArrivalTimestamp': '2024-10-24 14:23:43.000'
-              }
-            }
-          }
+        afterにシャードごとのシーケンス番号を指定した場合は、そのシーケンス番号より後のレコードのみを返す
+
+        シャードの読み取りはシャード数に応じたスレッド数で並列に実行し、読み取ったバッチは
+        上限付きのキューを経由して呼び出し元に渡すため、メモリ使用量はバッチサイズ程度に抑えられる
+        リシャーディングで作成されたシャードは、親シャードを最後まで読み取ってから読み取りを開始するため、
+        同じパーティションキーのレコードは追加された順に返る
+        それ以外のシャード間でのバッチの順序は保証しない
+        read_backendがasyncの場合は1つのイベントループで全シャードを読み取る
         """
-        response = self.kinesis_client.get_shard_iterator(
-            StreamName=self.target_stream_name,
-            ShardId=shard_id,
-            ShardIteratorType="TRIM_HORIZON",
+        if not shard_ids:
+            return
+        if self.read_backend == "async" and self.read_engine == "polling":
+            from src.async_reader import AsyncShardReader
+
+            yield from AsyncShardReader(self, self.async_concurrency).iter_records(shard_ids, after)
+            return
+
+        max_workers = self.scheduler.workers_for(len(shard_ids))
+        bounds = self.snapshot_bounds(shard_ids)
+        queue: Queue = Queue(maxsize=max_workers * 2)
+        stop = threading.Event()
+        # 親シャードを先に投入し、子シャードのスレッドは親シャードの読み取り完了を待機する
+        topology = self.topology()
+        ordered = tuple(
+            shard_id for shard_id in topology.ordered() if shard_id in shard_ids
+        ) + tuple(shard_id for shard_id in shard_ids if shard_id not in topology.shards)
+        finished = {shard_id: threading.Event() for shard_id in ordered}
+
+        def produce(shard_id: str) -> None:
+            try:
+                for parent in topology.parents(shard_id):
+                    if parent in finished and not self._wait(finished[parent], stop):
+                        return
+                for batch in self.iter_shard_records(
+                    shard_id, bounds.get(shard_id), (after or {}).get(shard_id)
+                ):
+                    if not self._put(queue, (shard_id, batch), stop):
+                        return
+            finally:
+                finished[shard_id].set()
+                self._put(queue, (shard_id, _SHARD_DONE), stop)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {shard_id: executor.submit(produce, shard_id) for shard_id in ordered}
+        try:
+            remaining = len(futures)
+            while remaining:
+                shard_id, batch = queue.get()
+                if batch is _SHARD_DONE:
+                    # シャードのスレッドで発生した例外は、他のシャードの読み取りを待たずに伝播させる
+                    futures[shard_id].result()
+                    remaining -= 1
+                    continue
+                yield shard_id, batch
+        finally:
+            # 呼び出し元が途中で読み取りをやめた場合、例外が発生した場合もスレッドを停止させ、
+            # 未着手のシャードの読み取りは取り消す
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def iter_shard_records(
+        self,
+        shard_id: str,
+        end_bound: Optional[EndBound] = None,
+        after_sequence_number: Optional[int] = None,
+    ) -> Iterator[list[dict[str, Any]]]:
+        """シャード内のレコードをGetRecordsのレスポンス単位で逐次返す
+
+        after_sequence_numberを指定した場合は、そのシーケンス番号より後のレコードのみを返す
+
+        以下のいずれかに該当した時点で読み取りを終了する
+          - MillisBehindLatestが0になった(シャードの最新レコードまで読み取った)
+          - NextShardIteratorが返却されない(クローズ済みシャードを最後まで読み取った)
+          - 空のレスポンスがmax_empty_polls回連続した
+          - 終端(end_bound)を超えるレコードに到達した
+
+        Yield Example:
+          [
+            {
+              'SequenceNumber': 49657051368801430459340561020608066337892395447780114434,
+              'Data': b'{"recordId":"RCS3ffmbiL","requestId":"1-3-diHOsUpMZsWnB5Bp",'
+              'PartitionKey': 'RCS3ffmbiL'
+              'ApproximateArrivalTimestamp': 1729747423000
+            },
+            ...
+          ]
+        """
+        if end_bound is None:
+            end_bound = self.snapshot_bounds((shard_id,)).get(shard_id)
+        end_bound = with_end_time(end_bound, self.end_time)
+
+        # キャッシュ済みのレコードを返した後、未取得のレコードのみをシャードから読み取る
+        cache = self.open_cache()
+        last_sequence_number = after_sequence_number
+        if cache is not None:
+            yield from cache.iter_batches(shard_id, after=after_sequence_number)
+            if cache.is_closed(shard_id):
+                return
+            cached_sequence_number = cache.last_sequence_number(shard_id)
+            if cached_sequence_number is not None and (
+                last_sequence_number is None or cached_sequence_number > last_sequence_number
+            ):
+                last_sequence_number = cached_sequence_number
+
+        start_time = None if last_sequence_number is not None else self.start_time
+        if self.read_engine == "efo":
+            position = starting_position(last_sequence_number, start_time)
+            yield from self._iter_subscription(shard_id, position, end_bound, cache)
+            return
+        shard_iterator = self._get_shard_iterator(
+            shard_id, last_sequence_number=last_sequence_number, start_time=start_time
         )
+        yield from self._iter_shard_iterator(shard_id, shard_iterator, end_bound, cache)
+
+    def follow_records(
+        self, stop: threading.Event, poll_interval: float = DEFAULT_FOLLOW_INTERVAL
+    ) -> Iterator[tuple[str, list[dict[str, Any]]]]:
+        """オープン中のシャードに追加されるレコードを(シャードID, レコードバッチ)の形式で逐次返す
+
+        start_timeを指定した場合はその日時から、指定しない場合は呼び出し時点(LATEST)以降のレコードを返す
+        シャードの読み取りはスケジューラーの同時実行数のスレッドで分担し、最新のレコードに追いついた
+        シャードはpoll_interval秒ごとにGetRecordsを呼び出す
+        追跡中にシャードの分割、マージでシャードがクローズされた場合は、親シャードを全て読み終えた
+        子シャードを先頭から追跡する
+        stopが設定されるまで返し続ける
+        read_engineがefoの場合は拡張ファンアウトでシャードを購読する
+        """
+        if self.read_engine == "efo":
+            yield from self._follow_subscriptions(stop)
+            return
+
+        shard_ids = self.topology().open_shard_ids()
+        # (次に読み取る時刻, シャードID, シャードイテレーター)のヒープ
+        tasks: list[tuple[float, str, str]] = []
+        started: set[str] = set()
+        finished: set[str] = set()
+        condition = threading.Condition()
+        queue: Queue = Queue(maxsize=len(shard_ids) * 2 + 1)
+
+        def start(shard_id: str, shard_iterator: str) -> None:
+            started.add(shard_id)
+            heapq.heappush(tasks, (time.monotonic(), shard_id, shard_iterator))
+            condition.notify()
+
+        def next_task() -> Optional[tuple[float, str, str]]:
+            """読み取り時刻に達したタスクを取り出す、停止要求があればNoneを返す"""
+            with condition:
+                while not stop.is_set():
+                    now = time.monotonic()
+                    if tasks and tasks[0][0] <= now:
+                        return heapq.heappop(tasks)
+                    condition.wait(timeout=min(0.1, tasks[0][0] - now) if tasks else 0.1)
+            return None
+
+        def close(shard_id: str) -> None:
+            """クローズされたシャードの子シャードのうち、親シャードを全て読み終えたものの追跡を開始する"""
+            self.shard_topology = None
+            topology = self.topology()
+            with condition:
+                children = self._startable_children(topology, shard_id, started, finished)
+            for child in children:
+                shard_iterator = self._get_shard_iterator(child)
+                with condition:
+                    start(child, shard_iterator)
+
+        def poll() -> None:
+            while (task := next_task()) is not None:
+                _, shard_id, shard_iterator = task
+                response = self.scheduler.call(
+                    shard_id, self.kinesis_client.get_records, ShardIterator=shard_iterator
+                )
+                records = response["Records"]
+                self.hooks.on_batch(shard_id, records, response.get("MillisBehindLatest"))
+                if records and not self._put(
+                    queue, (shard_id, [to_record(record) for record in records]), stop
+                ):
+                    return
+                next_iterator = response.get("NextShardIterator")
+                if not next_iterator:
+                    close(shard_id)
+                    continue
+                caught_up = not records or response.get("MillisBehindLatest") == 0
+                with condition:
+                    heapq.heappush(
+                        tasks,
+                        (
+                            time.monotonic() + (poll_interval if caught_up else 0),
+                            shard_id,
+                            next_iterator,
+                        ),
+                    )
+                    condition.notify()
+
+        for shard_id in shard_ids:
+            shard_iterator = self._get_shard_iterator(
+                shard_id, start_time=self.start_time, latest=self.start_time is None
+            )
+            with condition:
+                start(shard_id, shard_iterator)
+
+        max_workers = self.scheduler.workers_for(len(shard_ids))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(poll) for _ in range(max_workers)]
+        try:
+            while not stop.is_set():
+                try:
+                    yield queue.get(timeout=0.1)
+                except Empty:
+                    # スレッド内で発生した例外を呼び出し元に伝播させる
+                    for future in futures:
+                        if future.done():
+                            future.result()
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
+
+    def _follow_subscriptions(
+        self, stop: threading.Event
+    ) -> Iterator[tuple[str, list[dict[str, Any]]]]:
+        """拡張ファンアウトでオープン中のシャードを購読し、受信したレコードを逐次返す
+
+        購読中は接続を保持し続けるため、シャードごとに1つのスレッドで受信する
+        停止要求は次のイベント(レコードがない場合も約5秒ごとに届く)を受信した時点で反映される
+        """
+        shard_ids = self.topology().open_shard_ids()
+        started: set[str] = set()
+        finished: set[str] = set()
+        lock = threading.Lock()
+        queue: Queue = Queue(maxsize=len(shard_ids) * 2 + 1)
+        errors: list[BaseException] = []
 
-        shard_iterator = response["ShardIterator"]
-        shard_map = {}
-        records_in_shard = {}
+        def start(shard_id: str, position: dict[str, Any]) -> None:
+            started.add(shard_id)
+            threading.Thread(target=receive, args=(shard_id, position), daemon=True).start()
+
+        def receive(shard_id: str, position: dict[str, Any]) -> None:
+            try:
+                with closing(self.consumer().subscribe(shard_id, position)) as events:
+                    for event in events:
+                        records = event["Records"]
+                        self.hooks.on_batch(shard_id, records, event.get("MillisBehindLatest"))
+                        if records and not self._put(
+                            queue, (shard_id, [to_record(record) for record in records]), stop
+                        ):
+                            return
+                        if stop.is_set():
+                            return
+                # シャードの末尾まで受信した場合は、追跡を開始できる子シャードを先頭から購読する
+                self.shard_topology = None
+                topology = self.topology()
+                with lock:
+                    for child in self._startable_children(topology, shard_id, started, finished):
+                        start(child, starting_position())
+            except Exception as e:
+                errors.append(e)
+
+        with lock:
+            for shard_id in shard_ids:
+                start(
+                    shard_id,
+                    starting_position(start_time=self.start_time, latest=self.start_time is None),
+                )
+        try:
+            while not stop.is_set():
+                try:
+                    yield queue.get(timeout=0.1)
+                except Empty:
+                    # スレッド内で発生した例外を呼び出し元に伝播させる
+                    if errors:
+                        raise errors[0]
+        finally:
+            stop.set()
+
+    @staticmethod
+    def _startable_children(
+        topology: ShardTopology, shard_id: str, started: set[str], finished: set[str]
+    ) -> list[str]:
+        """クローズされたシャードの子シャードのうち、親シャードを全て読み終えたものを返す
+
+        子シャードの追跡は重複しないよう、返したシャードは開始済みとして記録する
+        """
+        finished.add(shard_id)
+        children = [
+            child
+            for child in topology.children(shard_id)
+            if child not in started
+            and all(p in finished or p not in started for p in topology.parents(child))
+        ]
+        started.update(children)
+        return children
+
+    def get_recent_records(self, shard_id: str, count: int) -> list[dict[str, Any]]:
+        """シャードに最近追加されたレコードをシーケンス番号の降順で最大count件返す
+
+        キャッシュを使用する場合は未取得のレコードのみを読み取った上でキャッシュから取得する
+        キャッシュを使用しない場合は現在時刻から過去に向かって期間を倍々に広げながらAT_TIMESTAMPで
+        読み取り、count件に達した時点で終了するため、シャード全体を読み取る必要がない
+        """
+        end_bound = with_end_time(None, self.end_time)
+        cache = self.open_cache()
+        if cache is not None:
+            if not cache.is_closed(shard_id):
+                shard_iterator = self._get_shard_iterator(
+                    shard_id, last_sequence_number=cache.last_sequence_number(shard_id)
+                )
+                for _ in self._iter_shard_iterator(shard_id, shard_iterator, end_bound, cache):
+                    pass
+            return cache.recent_records(shard_id, count)
+
+        # シーケンス番号の小さい順に上位count件のみを保持するヒープ
+        heap: list[tuple[int, dict[str, Any]]] = []
+        seen: set[int] = set()
+        window_end = self.end_time or datetime.datetime.now(datetime.timezone.utc)
+        window = datetime.timedelta(seconds=RECENT_WINDOW_SEC)
+        horizon = self._read_horizon()
 
         while True:
+            window_start = window_end - window
+            # 保持期間の先頭に到達した場合はシャードの先頭(start_time指定時はその日時)から読み取り、
+            # それ以上は期間を広げない
+            reached_horizon = window_start <= horizon
+            read_from = self.start_time if reached_horizon else window_start
+
+            shard_iterator = self._get_shard_iterator(shard_id, start_time=read_from)
+            bound = EndBound(timestamp=window_end)
+            for batch in self._iter_shard_iterator(shard_id, shard_iterator, bound, None):
+                for record in batch:
+                    sequence_number = record[const.SEQ_NUM]
+                    if sequence_number in seen:
+                        continue
+                    if len(heap) < count:
+                        heapq.heappush(heap, (sequence_number, record))
+                        seen.add(sequence_number)
+                    elif sequence_number > heap[0][0]:
+                        removed, _ = heapq.heapreplace(heap, (sequence_number, record))
+                        seen.discard(removed)
+                        seen.add(sequence_number)
+
+            if len(heap) >= count or reached_horizon:
+                break
+            window_end = window_start
+            window *= RECENT_WINDOW_GROWTH
+
+        return [record for _, record in sorted(heap, key=lambda item: item[0], reverse=True)]
+
+    def sample_shard(self, shard_id: str, max_batches: int = DEFAULT_SAMPLE_BATCHES) -> ShardSample:
+        """シャードの先頭(start_time指定時はその日時)から最大max_batches回だけGetRecordsを呼び出す
+
+        シャード全体を読み取らずに、サンプルの追加レートとMillisBehindLatestからレコード数と
+        最終追加日時を概算するために使用する、キャッシュは使用しない
+        """
+        shard_iterator: Optional[str] = self._get_shard_iterator(
+            shard_id, start_time=self.start_time
+        )
+        sample = ShardSample()
+        for _ in range(max_batches):
+            response = self.scheduler.call(
+                shard_id, self.kinesis_client.get_records, ShardIterator=shard_iterator, Limit=1000
+            )
+            records = response["Records"]
+            shard_iterator = response.get("NextShardIterator")
+            millis_behind_latest = response.get("MillisBehindLatest")
+            self.hooks.on_batch(shard_id, records, millis_behind_latest)
+            if records:
+                sample = sample._replace(
+                    num_of_records=sample.num_of_records + len(records),
+                    total_bytes=sample.total_bytes
+                    + sum(len(record[const.DATA]) for record in records),
+                    first_timestamp=(
+                        sample.first_timestamp
+                        if sample.first_timestamp is not None
+                        else to_epoch_millis(records[0][const.TIMESTAMP])
+                    ),
+                    last_timestamp=to_epoch_millis(records[-1][const.TIMESTAMP]),
+                )
+            sample = sample._replace(millis_behind_latest=millis_behind_latest or 0)
+            if not shard_iterator or millis_behind_latest == 0:
+                return sample._replace(complete=True)
+        return sample
+
+    def sample_shards(
+        self, shard_ids: tuple[str, ...], max_batches: int = DEFAULT_SAMPLE_BATCHES
+    ) -> dict[str, ShardSample]:
+        """複数シャードのサンプルを並列に読み取る"""
+        if not shard_ids:
+            return {}
+        max_workers = self.scheduler.workers_for(len(shard_ids))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            samples = executor.map(
+                lambda shard_id: self.sample_shard(shard_id, max_batches), shard_ids
+            )
+            return dict(zip(shard_ids, samples))
+
+    def _read_horizon(self) -> datetime.datetime:
+        """レコードが存在しうる最も古い日時(保持期間の先頭、ストリーム作成日時、start_time)を返す"""
+        summary = self.describe_stream_summary()
+        retention = datetime.timedelta(hours=summary["RetentionPeriodHours"])
+        horizon = max(
+            datetime.datetime.now(datetime.timezone.utc) - retention,
+            summary["StreamCreationTimestamp"],
+        )
+        if self.start_time is not None:
+            horizon = max(horizon, self.start_time)
+        return horizon
+
+    def _iter_shard_iterator(
+        self,
+        shard_id: str,
+        shard_iterator: Optional[str],
+        end_bound: Optional[EndBound],
+        cache: Optional[RecordCache],
+    ) -> Iterator[list[dict[str, Any]]]:
+        """シャードイテレーターからレコードをGetRecordsのレスポンス単位で逐次返す"""
+        empty_polls = 0
+
+        while shard_iterator:
             # レコードを取得
-            response = self.kinesis_client.get_records(ShardIterator=shard_iterator, Limit=1000)
-            if not response["Records"]:
+            response = self.scheduler.call(
+                shard_id, self.kinesis_client.get_records, ShardIterator=shard_iterator, Limit=1000
+            )
+            records = response["Records"]
+            # 次のイテレーターを取得、クローズ済みシャードの末尾に到達した場合はNone
+            shard_iterator = response.get("NextShardIterator")
+
+            # 終端を超えたレコードは除外し、以降の読み取りを行わない
+            records, reached_end = trim_to_bound(records, end_bound)
+            self.hooks.on_batch(shard_id, records, response.get("MillisBehindLatest"))
+
+            if records:
+                empty_polls = 0
+                batch = [to_record(record) for record in records]
+                if cache is not None:
+                    cache.append(shard_id, batch)
+                yield batch
+            else:
+                empty_polls += 1
+
+            if is_caught_up(
+                response, bool(records), reached_end, empty_polls, self.max_empty_polls
+            ):
                 break
 
-            for record in response["Records"]:
-                records_in_shard[record[const.SEQ_NUM]] = {
-                    const.DATA: record[const.DATA].decode("utf-8"),
-                    const.PARTITION_KEY: record["PartitionKey"],
-                    const.TIMESTAMP: record[const.TIMESTAMP].strftime("%Y-%m-%d %H:%M:%S.%f"),
-                }
+        if not shard_iterator and cache is not None:
+            cache.mark_closed(shard_id)
 
-            # 次のイテレーターを取得
-            shard_iterator = response["NextShardIterator"]
-        shard_map[shard_id] = records_in_shard
-        return shard_map
+    def _iter_subscription(
+        self,
+        shard_id: str,
+        starting_position: dict[str, Any],
+        end_bound: Optional[EndBound],
+        cache: Optional[RecordCache],
+    ) -> Iterator[list[dict[str, Any]]]:
+        """拡張ファンアウトでシャードを購読し、レコードをイベント単位で逐次返す
+
+        MillisBehindLatestが0になった、クローズ済みシャードの末尾に到達した、
+        または終端(end_bound)を超えるレコードに到達した時点で購読を終了する
+        """
+        closed = False
+        with closing(self.consumer().subscribe(shard_id, starting_position)) as events:
+            for event in events:
+                records, reached_end = trim_to_bound(event["Records"], end_bound)
+                self.hooks.on_batch(shard_id, records, event.get("MillisBehindLatest"))
+                if records:
+                    batch = [to_record(record) for record in records]
+                    if cache is not None:
+                        cache.append(shard_id, batch)
+                    yield batch
+                closed = event.get("ContinuationSequenceNumber") is None
+                if reached_end or event.get("MillisBehindLatest") == 0:
+                    break
+
+        if closed and cache is not None:
+            cache.mark_closed(shard_id)
+
+    def _get_shard_iterator(
+        self,
+        shard_id: str,
+        last_sequence_number: Optional[int] = None,
+        start_time: Optional[datetime.datetime] = None,
+        latest: bool = False,
+    ) -> str:
+        """シャードイテレーターを取得する
+
+        last_sequence_numberが指定された場合はその直後から、start_timeが指定された場合はその日時から、
+        latestの場合はこれ以降に追加されるレコードから、
+        いずれも指定がない場合はシャードの先頭から読み取る
+        指定したシーケンス番号が保持期間を過ぎている場合はシャードの先頭から読み取る
+        """
+        if latest:
+            response = self.scheduler.call(
+                shard_id,
+                self.kinesis_client.get_shard_iterator,
+                StreamName=self.target_stream_name,
+                ShardId=shard_id,
+                ShardIteratorType="LATEST",
+            )
+            return response["ShardIterator"]
+
+        if start_time is not None:
+            response = self.scheduler.call(
+                shard_id,
+                self.kinesis_client.get_shard_iterator,
+                StreamName=self.target_stream_name,
+                ShardId=shard_id,
+                ShardIteratorType="AT_TIMESTAMP",
+                Timestamp=start_time,
+            )
+            return response["ShardIterator"]
+
+        if last_sequence_number is not None:
+            try:
+                response = self.scheduler.call(
+                    shard_id,
+                    self.kinesis_client.get_shard_iterator,
+                    StreamName=self.target_stream_name,
+                    ShardId=shard_id,
+                    ShardIteratorType="AFTER_SEQUENCE_NUMBER",
+                    StartingSequenceNumber=str(last_sequence_number),
+                )
+                return response["ShardIterator"]
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "InvalidArgumentException":
+                    raise
+
+        response = self.scheduler.call(
+            shard_id,
+            self.kinesis_client.get_shard_iterator,
+            StreamName=self.target_stream_name,
+            ShardId=shard_id,
+            ShardIteratorType="TRIM_HORIZON",
+        )
+        return response["ShardIterator"]
+
+    @staticmethod
+    def _wait(event: threading.Event, stop: threading.Event) -> bool:
+        """停止要求を確認しながらイベントを待機する、停止要求があればFalseを返す"""
+        while not stop.is_set():
+            if event.wait(timeout=0.1):
+                return True
+        return False
+
+    @staticmethod
+    def _put(queue: Queue, item: tuple, stop: threading.Event) -> bool:
+        """停止要求を確認しながらキューに要素を追加する、停止要求があればFalseを返す"""
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
@@ -1,15 +1,56 @@
-import csv
 import datetime
 import os
 import sys
+import threading
+from collections.abc import Generator, Iterable
+from contextlib import AbstractContextManager, closing, nullcontext
+from typing import Any, Optional
 
-import questionary
 import rich
-from rich.table import Table
 
 import src.const as const
 import src.msg as msg
-from src.kinesis_client import KinesisClient
+from src.decoders import DataDecoder
+from src.discovery_cache import DEFAULT_DISCOVERY_TTL, DiscoveryCache
+from src.exporters import RECORD_WRITERS, JsonlRecordWriter, RecordWriter, format_record
+from src.kinesis_client import (
+    DEFAULT_MAX_EMPTY_POLLS,
+    DEFAULT_SAMPLE_BATCHES,
+    READ_BACKENDS,
+    READ_ENGINES,
+    KinesisClient,
+)
+from src.pager import (
+    DEFAULT_MAX_DATA_WIDTH,
+    DEFAULT_PAGE_SIZE,
+    RecordPager,
+    render_page,
+)
+from src.read_metrics import ReadHooks, ReadMetrics
+from src.read_scheduler import (
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_READS_PER_SEC,
+    ShardReadScheduler,
+)
+from src.record_store import RecordStore
+from src.search import SearchEngine, SearchQuery
+from src.snapshot_source import SnapshotSource
+from src.stream_stats import ShardStats, StreamStats
+from src.time_util import format_timestamp, parse_time
+
+# show_recent_recordsで表示するレコード数の既定値
+RECENT_RECORDS_COUNT = 100
+# dump_recordsで全シャードを対象とする場合のシャードの指定
+ALL_SHARDS = "all"
+# summaryの動作モード
+# full: 全レコードを読み取る、metadata: レコードを読み取らずシャードの情報のみ、sample: 数バッチから概算
+SUMMARY_MODES = ("full", "metadata", "sample")
+# summaryで表示するパーティションキー数の既定値
+TOP_KEYS_COUNT = 10
+# summaryのレコード数の推移のグラフの最大幅(文字数)
+THROUGHPUT_BAR_WIDTH = 40
+# スナップショットを対象とする場合に実行できないコマンド
+ONLINE_COMMANDS = ("tail", "refresh")
 
 
 class KinesisDataViewerCLI:
@@ -17,15 +58,53 @@ class KinesisDataViewerCLI:
         self.region = region
         self.target_stream_name = target_stream_name
         if region:
-            self.kds_client = KinesisClient(region, target_stream_name)
+            self.kds_client = self._create_client(region)
         self.shard_ids: tuple = ()
-        self.all_records: dict = {}
+        # 読み取り済みのレコード、コマンド間で共有する
+        self.records = RecordStore()
+        self.recent_count = RECENT_RECORDS_COUNT
+        self.summary_mode = "full"
+        self.sample_batches = DEFAULT_SAMPLE_BATCHES
+        self.top_keys = TOP_KEYS_COUNT
+        # summaryで読み取ったレコードをレコードストアに保持するかどうか
+        self.keep_records = False
+        # Dataは読み取り時には変換せず、表示、検索時にデコードする
+        self.decoder = DataDecoder()
+        # 読み取り済みのレコードの検索インデックス、コマンド間で共有する
+        self.search_engine = SearchEngine(self.decoder)
+        # 検索に使用するプロセス数(0の場合はCPU数)と表示件数の上限(0の場合は無制限)
+        self.search_workers = 0
+        self.search_limit = 0
+        # tailの出力先(terminal, jsonl)、出力するレコードの検索条件、追跡する秒数(0の場合は中断するまで)
+        self.tail_output = "terminal"
+        self.tail_filter = ""
+        self.tail_duration = 0.0
+        # ファイル出力時の列
+        self.csv_fieldnames = (
+            const.SEQ_NUM,
+            const.DATA,
+            const.PARTITION_KEY,
+            const.TIMESTAMP,
+            const.RAW_DATA,
+        )
+        # ファイル出力先のディレクトリ、'-'の場合は標準出力
+        self.dump_dir = "dist"
+        # ターミナル出力時の1ページのレコード数とDataの最大表示文字数
+        self.page_size = DEFAULT_PAGE_SIZE
+        self.max_data_width = DEFAULT_MAX_DATA_WIDTH
+        # 読み取り中にシャードごとの進捗を表示するかどうか、計測値の出力先のJSONファイル(空の場合は出力しない)
+        self.progress = True
+        self.metrics_out = ""
+        # 読み取りの計測値、進捗表示または計測値の出力を行う場合のみ集計する
+        self.metrics: Optional[ReadMetrics] = None
         # 選択可能なコマンドリスト
-        self.commands = (
+        self.commands: tuple[str, ...] = (
             "summary",
             "dump_records",
             "show_recent_records",
             "search_record",
+            "tail",
+            "refresh",
             "exit",
         )
 
@@ -36,114 +115,476 @@ class KinesisDataViewerCLI:
         command: str = "",
         target_shard: str = "",
         dump_output: str = "",
+        dump_dir: str = "dist",
         search_key: str = "",
+        recent_count: int = RECENT_RECORDS_COUNT,
+        summary_mode: str = "full",
+        sample_batches: int = DEFAULT_SAMPLE_BATCHES,
+        top_keys: int = TOP_KEYS_COUNT,
+        keep_records: bool = False,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        max_data_width: int = DEFAULT_MAX_DATA_WIDTH,
+        decoder: str = "utf-8",
+        search_workers: int = 0,
+        limit: int = 0,
+        max_concurrency: int = 0,
+        reads_per_sec: float = DEFAULT_READS_PER_SEC,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        snapshot_end: bool = False,
+        max_empty_polls: int = DEFAULT_MAX_EMPTY_POLLS,
+        cache_dir: str = "",
+        start_time: str = "",
+        end_time: str = "",
+        open_shards_only: bool = False,
+        discovery_ttl: int = DEFAULT_DISCOVERY_TTL,
+        tail_output: str = "terminal",
+        tail_filter: str = "",
+        tail_duration: float = 0.0,
+        read_engine: str = "polling",
+        read_backend: str = "thread",
+        source: str = "",
+        progress: bool = True,
+        metrics_out: str = "",
     ) -> None:
+        """操作対象のDataStreamとコマンドを選択して実行する
+
+        Args:
+            target_shard: dump_records、show_recent_recordsの対象シャード、
+                dump_recordsで'all'を指定した場合は全シャードを並列に読み取る
+            dump_output: dump_recordsの出力先(terminal, csv, jsonl, parquet)
+            dump_dir: dump_recordsのファイルの出力先ディレクトリ、シャードごとに1ファイルを作成する、
+                '-'の場合は標準出力に書き込む
+            recent_count: show_recent_recordsで表示するレコード数
+            summary_mode: summaryの動作モード(full, metadata, sample)、
+                metadataはレコードを読み取らずシャードの情報とキャッシュの統計のみを表示し、
+                sampleはシャードごとにsample_batches回だけ読み取ってレコード数などを概算する
+            sample_batches: summary_modeがsampleの場合にシャードごとに呼び出すGetRecordsの回数
+            top_keys: summaryで表示するレコード数の多いパーティションキーの数、0の場合は表示しない
+            keep_records: summaryで読み取ったレコードを後続のコマンドのために保持する、
+                Falseの場合は統計のみを集計するため、メモリに乗り切らないストリームも集計できる
+                (読み取り済みのシャードはいずれの場合も保持済みのレコードを使用する)
+            page_size: ターミナル出力時の1ページのレコード数
+            max_data_width: ターミナル出力時のDataの最大表示文字数、超過した部分は省略する、
+                0の場合は省略しない
+            decoder: Dataの表示、検索時に適用するデコーダー(utf-8, gzip, base64, kpl, auto)、
+                カンマ区切りで複数指定した場合は指定した順に適用する(例: kpl,gzip)
+            search_workers: search_recordで正規表現などの全件走査を並列に行うプロセス数、
+                0の場合はCPU数
+            limit: search_recordで表示するレコード数の上限、上限に達した時点で検索を打ち切る、
+                0の場合は無制限
+            max_concurrency: シャードを同時に読み取るスレッド数の上限、0の場合は既定値
+            reads_per_sec: シャードごとのGetRecords呼び出し回数の上限(回/秒)
+            max_retries: スロットリング時の再試行回数の上限
+            snapshot_end: 読み取り開始時点を終端とし、それ以降に追加されたレコードは読み取らない
+            max_empty_polls: 連続して空のレスポンスが返却された場合に読み取りを打ち切る回数
+            cache_dir: 取得済みレコードのキャッシュを保存するディレクトリ、
+                指定した場合は前回の続きから未取得のレコードのみを読み取る
+            start_time: 読み取り期間の開始日時、ISO 8601形式または相対時刻(例: -10m)
+            end_time: 読み取り期間の終了日時、ISO 8601形式または相対時刻(例: -5m)
+            open_shards_only: オープン中のシャードのみを対象とし、リシャーディングで
+                クローズ済みとなったシャードの履歴は読み取らない
+            discovery_ttl: リージョン一覧、DataStream一覧のキャッシュの有効期間(秒)、0の場合は毎回取得する
+                region、target_stream_nameを指定した場合は一覧を取得しない
+            tail_output: tailの出力先(terminal, jsonl)、jsonlの場合はdump_dirにファイルを作成する
+            tail_filter: tailで出力するレコードの検索条件、search_keyと同じ形式、空の場合は全て出力する
+            tail_duration: tailでレコードを追跡する秒数、0の場合はCtrl-Cで中断するまで追跡する
+            read_engine: レコードの読み取り方式(polling, efo)、efoの場合は一時的なコンシューマーを登録し
+                拡張ファンアウトで全件の読み取りとtailを行う、コンシューマーは終了時に削除する
+            read_backend: GetRecordsでの全件の読み取りの実行方式(thread, async)、
+                asyncの場合は1つのイベントループで全シャードを並行に読み取る(aiobotocoreが必要)、
+                max_concurrencyが0の場合の同時リクエスト数は256とする
+            source: DataStreamの代わりに読み取るスナップショット(dump_records、tailのJSONL/Parquetファイル、
+                またはそれらを含むディレクトリ、cache_dirのディレクトリ)、指定した場合はAWSにアクセスせず
+                summary(full)、dump_records、search_record、show_recent_recordsのみを実行できる
+            progress: summary、dump_recordsのファイル出力、search_record、refreshでの読み取り中に
+                シャードごとの読み取りレコード数、バイト数、MillisBehindLatestを標準エラー出力に表示する
+                標準エラー出力がターミナルでない場合は表示しない
+            metrics_out: 終了時にAPIの呼び出し回数、スロットリング回数、再試行回数と
+                シャードごとの応答時間のヒストグラム、レコード数/秒を書き込むJSONファイル
+        """
         self.target_shard = target_shard
         self.dump_output = dump_output
+        self.dump_dir = dump_dir
         self.search_key = search_key
+        self.recent_count = recent_count
+        if summary_mode not in SUMMARY_MODES:
+            raise ValueError(msg.INVALID_SUMMARY_MODE)
+        self.summary_mode = summary_mode
+        self.sample_batches = sample_batches
+        self.top_keys = top_keys
+        self.keep_records = keep_records
+        self.page_size = page_size
+        self.max_data_width = max_data_width
+        self.decoder = DataDecoder(decoder)
+        self.search_workers = search_workers
+        self.search_limit = limit
+        self.tail_output = tail_output
+        self.tail_filter = tail_filter
+        self.tail_duration = tail_duration
+        self.progress = progress
+        self.metrics_out = metrics_out
+        if read_engine not in READ_ENGINES:
+            raise ValueError(msg.INVALID_READ_ENGINE)
+        if read_backend not in READ_BACKENDS:
+            raise ValueError(msg.INVALID_READ_BACKEND)
+        # レコード読み取りの設定
+        read_args: dict[str, Any] = {
+            "max_concurrency": max_concurrency,
+            "reads_per_sec": reads_per_sec,
+            "max_retries": max_retries,
+            "snapshot_end": snapshot_end,
+            "max_empty_polls": max_empty_polls,
+            "cache_dir": cache_dir,
+            "start_time": start_time,
+            "end_time": end_time,
+            "open_shards_only": open_shards_only,
+            "read_engine": read_engine,
+            "read_backend": read_backend,
+        }
+
+        # 対話操作用のライブラリは読み込みに時間がかかるため、使用する時点で読み込む
+        import questionary
+
+        if source:
+            # スナップショットを対象とする場合はリージョン、DataStreamを選択しない
+            self.kds_client = SnapshotSource(source, self.target_stream_name or target_stream_name)
+            self.target_stream_name = self.kds_client.target_stream_name
+            self.commands = tuple(c for c in self.commands if c not in ONLINE_COMMANDS)
+            self._run_commands(command)
+            return
+
+        discovery = DiscoveryCache(ttl=discovery_ttl)
 
-        # リージョンの選択
-        region_names = KinesisClient.get_regions()
-        region_name = (
-            self.region
-            or region
-            or questionary.select(
+        # リージョンの選択、指定済みの場合は一覧を取得しない
+        region_name = self.region or region
+        if not region_name:
+            region_names = discovery.fetch(DiscoveryCache.key("regions"), KinesisClient.get_regions)
+            region_name = questionary.select(
                 "Target Region?", choices=region_names, default="ap-northeast-1"
             ).ask()
-        )
 
-        # 操作対象のDataStreamの選択
-        data_stream_names = KinesisClient.get_stream_names(region_name)
-        if not data_stream_names:
-            print(msg.NO_STREAM)
-            sys.exit(0)
-        self.target_stream_name = (
-            self.target_stream_name
-            or target_stream_name
-            or questionary.select(
+        # 操作対象のDataStreamの選択、指定済みの場合は一覧を取得しない
+        self.target_stream_name = self.target_stream_name or target_stream_name
+        if not self.target_stream_name:
+            data_stream_names = discovery.fetch(
+                DiscoveryCache.key(region_name, "streams"),
+                lambda: KinesisClient.get_stream_names(region_name),
+            )
+            if not data_stream_names:
+                print(msg.NO_STREAM)
+                sys.exit(0)
+            self.target_stream_name = questionary.select(
                 "Target Stream Name?",
                 choices=data_stream_names,
             ).ask()
+
+        # 進捗を表示しない場合の計測のオーバーヘッドを避けるため、必要な場合のみ集計する
+        if metrics_out or (progress and sys.stderr.isatty()):
+            self.metrics = ReadMetrics(self.target_stream_name)
+        # 同じセッション内ではクライアント(HTTP接続)、レコードストアをコマンド間で共有する
+        self.kds_client = self._create_client(region_name, **read_args, hooks=self.metrics)
+        self._run_commands(command)
+
+    def _run_commands(self, command: str) -> None:
+        """コマンドを実行し、exitが選択されるまで次のコマンドを選択して実行する"""
+        try:
+            while True:
+                # 操作コマンドの選択
+                command = command or self._select_command()
+                if not command or command == "exit":
+                    print(msg.EXIT)
+                    return
+                if command in ONLINE_COMMANDS and isinstance(self.kds_client, SnapshotSource):
+                    raise ValueError(msg.OFFLINE_UNSUPPORTED)
+                if command not in self.commands or (method := getattr(self, command, None)) is None:
+                    raise ValueError(msg.INVALID_COMMAND)
+                method()
+                # 2回目以降のコマンドと対象のシャードなどはターミナルで選択する
+                command = ""
+                self.target_shard = ""
+                self.dump_output = ""
+                self.search_key = ""
+        finally:
+            # 拡張ファンアウトのコンシューマーは中断、エラー時も含め必ず削除する
+            # スナップショットの場合は開いたファイルを閉じる
+            self.kds_client.close()
+            if self.metrics_out and self.metrics is not None:
+                self.metrics.write(self.metrics_out)
+                print(f"{msg.METRICS_FILE} '{self.metrics_out}'.", file=sys.stderr)
+
+    def _create_client(
+        self,
+        region_name: str,
+        max_concurrency: int = 0,
+        reads_per_sec: float = DEFAULT_READS_PER_SEC,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        snapshot_end: bool = False,
+        max_empty_polls: int = DEFAULT_MAX_EMPTY_POLLS,
+        cache_dir: str = "",
+        start_time: str = "",
+        end_time: str = "",
+        open_shards_only: bool = False,
+        read_engine: str = "polling",
+        read_backend: str = "thread",
+        hooks: Optional[ReadHooks] = None,
+    ) -> KinesisClient:
+        """レコード読み取りの設定を反映したKinesisClientを生成する"""
+        scheduler = ShardReadScheduler(max_concurrency, reads_per_sec, max_retries)
+        start = parse_time(start_time)
+        end = parse_time(end_time)
+        if start and end and start >= end:
+            raise ValueError(msg.INVALID_TIME_WINDOW)
+        return KinesisClient(
+            region_name,
+            self.target_stream_name,
+            scheduler,
+            snapshot_end=snapshot_end,
+            max_empty_polls=max_empty_polls,
+            cache_dir=cache_dir,
+            start_time=start,
+            end_time=end,
+            open_shards_only=open_shards_only,
+            read_engine=read_engine,
+            read_backend=read_backend,
+            async_concurrency=max_concurrency,
+            hooks=hooks,
         )
-        self.kds_client = KinesisClient(region_name, self.target_stream_name)
 
-        # 操作コマンドの選択
-        command = command or self._select_command()
-        if not command or command == "exit":
-            print(msg.EXIT)
-            return
-        if (method := getattr(self, command, None)) is None:
-            raise ValueError(msg.INVALID_COMMAND)
-        method()
-        self.main(region=region_name, target_stream_name=self.target_stream_name)
+    def _read_progress(self) -> AbstractContextManager:
+        """読み取り中のシャードごとの進捗を標準エラー出力に表示するコンテキストを返す
+
+        読み取り中に出力した内容は進捗表示の上に表示し、終了時に進捗表示は消去する
+        標準出力がパイプの場合(dump_dirが'-'など)は標準出力をそのまま書き込む
+        """
+        if self.metrics is None or not self.progress or not sys.stderr.isatty():
+            return nullcontext()
+
+        from rich.console import Console
+        from rich.live import Live
+
+        return Live(
+            get_renderable=self.metrics.render_progress,
+            console=Console(stderr=True),
+            transient=True,
+            redirect_stdout=sys.stdout.isatty(),
+        )
 
     def summary(self):
         """シャード一覧とシャードごとの格納レコード数などの情報を出力する"""
+        if self.summary_mode == "metadata":
+            self._summary_metadata()
+        elif self.summary_mode == "sample":
+            self._summary_sample()
+        else:
+            self._summary_full()
+
+    def _summary_full(self) -> None:
+        """全レコードを1度だけ走査し、シャードごとのレコード数、サイズ、追加日時などの統計を出力する"""
+        from rich.table import Table
+
         # シャード情報取得
         self.shard_ids = self.shard_ids or (self.kds_client.list_shards())
-        # レコード取得
-        self.all_records = self.all_records or (self.kds_client.get_records(self.shard_ids))
+        stats = StreamStats(self.shard_ids, self.top_keys)
+        with self._read_progress():
+            if self.keep_records:
+                # 読み取り済みのシャードはレコードストアのレコードを使用
+                for shard, start, stop in self.records.load(self.kds_client, self.shard_ids):
+                    stats.add_batch(shard.shard_id, shard.iter_records(start, stop))
+            else:
+                # 読み取り済みのシャード以外はレコードを保持せず、読み取ったバッチから順に集計のみ行う
+                pending = tuple(s for s in self.shard_ids if not self.records.is_loaded(s))
+                for shard_id in self.shard_ids:
+                    if shard_id not in pending:
+                        stats.add_batch(shard_id, self.records.shard(shard_id).iter_records())
+                for shard_id, batch in self.kds_client.iter_records(pending):
+                    stats.add_batch(shard_id, batch)
 
         #  出力
         table = Table(show_header=True, header_style="bold magenta", title=msg.SUMMARY_TITLE)
         table.add_column(const.SHARD_ID, style="bold", width=25)
+        table.add_column(const.NUM_OF_RECORDS, justify="right")
+        table.add_column(const.TOTAL_BYTES, justify="right")
+        table.add_column(const.MIN_SIZE, justify="right")
+        table.add_column(const.P50_SIZE, justify="right")
+        table.add_column(const.P99_SIZE, justify="right")
+        table.add_column(const.MAX_SIZE, justify="right")
+        table.add_column(const.FIRST_ADDED_TIME)
+        table.add_column(const.LAST_ADDED_TIME)
+        for shard_stats in stats.shards.values():
+            table.add_row(*self._stats_row(shard_stats))
+        table.add_section()
+        table.add_row(*self._stats_row(stats.total()))
+        rich.print(table)
+
+        if stats.hot_keys is not None and (top := stats.hot_keys.top()):
+            table = Table(show_header=True, header_style="bold magenta", title=msg.HOT_KEYS_TITLE)
+            table.add_column(const.PARTITION_KEY)
+            table.add_column(const.ESTIMATED_COUNT, justify="right")
+            for partition_key, count in top:
+                table.add_row(partition_key, str(count))
+            rich.print(table)
+
+        if rates := stats.throughput.rates():
+            peak = max(rate for _, rate in rates)
+            table = Table(show_header=True, header_style="bold magenta", title=msg.THROUGHPUT_TITLE)
+            table.add_column(const.TIME)
+            table.add_column(const.RECORDS_PER_SEC, justify="right")
+            table.add_column("")
+            for timestamp, rate in rates:
+                bar = "█" * round(THROUGHPUT_BAR_WIDTH * rate / peak) if peak else ""
+                table.add_row(format_timestamp(timestamp), f"{rate:.2f}", bar)
+            rich.print(table)
+
+    @staticmethod
+    def _stats_row(shard_stats: ShardStats) -> tuple[str, ...]:
+        """シャードの統計をsummaryのテーブルの行に変換する、レコードが１件もない場合は"-"とする"""
+        sizes = shard_stats.sizes
+        values = (sizes.min, sizes.percentile(0.5), sizes.percentile(0.99), sizes.max)
+        timestamps = (shard_stats.first_timestamp, shard_stats.last_timestamp)
+        return (
+            shard_stats.shard_id,
+            str(shard_stats.count),
+            str(shard_stats.total_bytes),
+            *("-" if value is None else str(value) for value in values),
+            *(
+                "-" if timestamp is None else format_timestamp(timestamp)
+                for timestamp in timestamps
+            ),
+        )
+
+    def _summary_metadata(self) -> None:
+        """レコードを読み取らず、DescribeStreamSummaryとListShardsの情報のみを出力する
+
+        キャッシュを使用している場合はキャッシュ済みのレコード数と最後に追加された日時も出力する
+        """
+        from rich.table import Table
+
+        stream = self.kds_client.describe_stream_summary()
+        topology = self.kds_client.topology()
+        self.shard_ids = self.shard_ids or (self.kds_client.list_shards())
+        cache = self.kds_client.open_cache()
+        cache_stats = cache.shard_stats() if cache is not None else {}
+
+        table = Table(
+            show_header=True,
+            header_style="bold magenta",
+            title=(
+                f"{msg.SUMMARY_TITLE}: {stream['StreamStatus']}, "
+                f"{stream['OpenShardCount']} open shards, "
+                f"retention {stream['RetentionPeriodHours']}h"
+            ),
+            caption=msg.SUMMARY_CACHED if cache is not None else None,
+        )
+        table.add_column(const.SHARD_ID, style="bold", width=25)
+        table.add_column(const.STATE)
+        table.add_column(const.PARENT_SHARD_ID)
+        table.add_column(const.HASH_KEY_SHARE, justify="right")
         table.add_column(const.NUM_OF_RECORDS)
         table.add_column(const.LAST_ADDED_TIME)
-        for shard_id, records_in_shard in self.all_records.items():
-            if not records_in_shard:
-                # レコードが１件もない場合
-                numOfRecords = "0"
-                last_added_time = "-"
-            else:
-                numOfRecords = str(len(records_in_shard))
-                maxSequenceNum = max(records_in_shard.keys())
-                latest_record = records_in_shard[maxSequenceNum]
-                last_added_time = latest_record[const.TIMESTAMP]
-            table.add_row(shard_id, numOfRecords, last_added_time)
+        for shard_id in self.shard_ids:
+            shard = topology[shard_id]
+            count, last_timestamp = cache_stats.get(shard_id, (None, None))
+            table.add_row(
+                shard_id,
+                "open" if shard.is_open else "closed",
+                ", ".join(shard.parents) or "-",
+                f"{shard.hash_key_share:.2%}",
+                "-" if count is None else str(count),
+                "-" if last_timestamp is None else format_timestamp(last_timestamp),
+            )
+        rich.print(table)
+
+    def _summary_sample(self) -> None:
+        """シャードごとに数バッチのみを読み取り、レコード数と最後に追加された日時を概算して出力する"""
+        from rich.table import Table
+
+        self.shard_ids = self.shard_ids or (self.kds_client.list_shards())
+        with self._read_progress():
+            samples = self.kds_client.sample_shards(self.shard_ids, self.sample_batches)
+
+        table = Table(
+            show_header=True,
+            header_style="bold magenta",
+            title=msg.SUMMARY_TITLE,
+            caption=msg.SUMMARY_ESTIMATED,
+        )
+        table.add_column(const.SHARD_ID, style="bold", width=25)
+        table.add_column(const.NUM_OF_RECORDS)
+        table.add_column(const.LAST_ADDED_TIME)
+        table.add_column(const.AVG_DATA_SIZE, justify="right")
+        for shard_id in self.shard_ids:
+            sample = samples[shard_id]
+            prefix = "" if sample.complete else "~"
+            last_added = sample.estimated_last_added()
+            avg_size = (
+                f"{sample.total_bytes / sample.num_of_records:.1f}"
+                if sample.num_of_records
+                else "-"
+            )
+            table.add_row(
+                shard_id,
+                f"{prefix}{sample.estimated_records()}",
+                "-" if last_added is None else f"{prefix}{format_timestamp(last_added)}",
+                avg_size,
+            )
         rich.print(table)
 
     def dump_records(self) -> None:
         """選択したシャードのレコード一覧を出力する"""
-        target_shard = self.target_shard or self._select_shard()
         output = self.dump_output or self._select_output()
+        target_shard = self.target_shard or self._select_shard(allow_all=output != "terminal")
         self._dump_records(target_shard, output)
 
     def _dump_records(self, target_shard: str, output: str) -> None:
         """選択したシャードのレコード一覧を出力する"""
-        # シャード情報取得
-        self.shard_ids = self.shard_ids or (self.kds_client.list_shards())
-        # レコード取得
-        self.all_records = self.all_records or (self.kds_client.get_records(self.shard_ids))
-
-        records_in_shard: list[dict] = self._dict_to_list(self.all_records[target_shard])
+        if output in RECORD_WRITERS:
+            if target_shard == ALL_SHARDS:
+                self.shard_ids = self.shard_ids or (self.kds_client.list_shards())
+                self._output_files(self.shard_ids, output)
+            else:
+                self._output_files((target_shard,), output)
+            return
 
-        # 結果を出力
-        if output == "terminal":
-            self._output_terminal(target_shard, records_in_shard)
-        elif output == "csv":
-            self._output_csv(target_shard, records_in_shard)
+        if output != "terminal":
+            return
+        # 表示するページに必要な分だけシャードを読み進めて出力する
+        pager = RecordPager(
+            self.records.shard(target_shard),
+            self.records.load(self.kds_client, (target_shard,)),
+            f"List Records: {self.target_stream_name}: {target_shard}",
+            self.decoder,
+            self.page_size,
+            self.max_data_width,
+        )
+        try:
+            if sys.stdin.isatty() and sys.stdout.isatty():
+                pager.browse()
+            else:
+                pager.print_all()
+        finally:
+            pager.close()
 
     def show_recent_records(self) -> None:
-        """選択したシャードの最近100レコードを出力する"""
+        """選択したシャードの最近追加されたレコードを出力する"""
         target_shard = self.target_shard or self._select_shard()
         self._show_recent_records(target_shard)
 
     def _show_recent_records(self, target_shard: str) -> None:
-        """選択したシャードの最近100レコードを出力する"""
-        # シャード情報取得
-        self.shard_ids = self.shard_ids or (self.kds_client.list_shards())
-        # レコード取得
-        self.all_records = self.all_records or (self.kds_client.get_records(self.shard_ids))
-
-        records_in_shard: list[dict] = self._dict_to_list(self.all_records[target_shard])
-        sorted_records = sorted(records_in_shard, key=lambda d: d[const.SEQ_NUM], reverse=True)
-        recent_records = [record for i, record in enumerate(sorted_records) if i <= 100]
+        """選択したシャードの最近追加されたレコードを新しい順に出力する"""
+        if self.records.is_loaded(target_shard):
+            # 読み取り済みのシャードは末尾から取得
+            shard = self.records.shard(target_shard)
+            start = max(0, len(shard) - self.recent_count)
+            recent_records = list(shard.iter_records(start))[::-1]
+        else:
+            # シャードの末尾付近のみを読み取り、上位のレコードを取得
+            recent_records = self.kds_client.get_recent_records(target_shard, self.recent_count)
 
         # 結果を出力
         self._output_terminal(target_shard, recent_records)
 
     def search_record(self) -> None:
-        """指定されたキーワードでレコードのData部を検索し、結果をターミナルに表示する"""
+        """指定された検索条件でレコードを検索し、結果をターミナルに表示する"""
         key = self.search_key or self._enter_key()
         self._search_record(key)
 
@@ -154,92 +595,208 @@ class KinesisDataViewerCLI:
 
         # シャード情報取得
         self.shard_ids = self.shard_ids or (self.kds_client.list_shards())
-        # レコード取得
-        self.all_records = self.all_records or (self.kds_client.get_records(self.shard_ids))
 
-        # 検索文字列を含むレコードを検索
-        if not (target_records := self._find_records_by_key(str(key))):
+        # 検索文字列を含むレコードを見つかった順に出力、上限に達した場合は残りの検索を取り消す
+        num_of_found = 0
+        with self._read_progress(), closing(self._find_records_by_key(str(key))) as found_records:
+            for target_record in found_records:
+                rich.print(self._format_record(target_record))
+                num_of_found += 1
+                if num_of_found == self.search_limit:
+                    break
+
+        if not num_of_found:
             print(msg.NO_RECORD)
             return
+        print(f"{num_of_found} record found")
+
+    def _find_records_by_key(self, key: str) -> Generator[dict[str, Any], None, None]:
+        """指定された検索条件に一致するレコードを検索して返す
+
+        検索条件の形式:
+          - 文字列: Dataに文字列を含むレコード
+          - パス=値: DataをJSONとして解釈し、フィールドの値が一致するレコード(例: recordId=RCS3ffmbiL)
+          - re:パターン: Dataが正規表現に一致するレコード
+          - pk:値: パーティションキーが一致するレコード
+        """
+        if self.search_engine.decoder.names != self.decoder.names:
+            # デコーダーが変更された場合はインデックスを作り直す
+            self.search_engine = SearchEngine(self.decoder)
+        ranges = self.records.load(self.kds_client, self.shard_ids)
+        for shard, index in self.search_engine.search(key, ranges, self.search_workers):
+            yield {const.SHARD_ID: shard.shard_id, **shard.record(index)}
+
+    def _format_record(self, record: dict[str, Any]) -> dict[str, str]:
+        """レコードの各値を出力用の文字列に変換する"""
+        return format_record(record, self.decoder)
+
+    def _output_terminal(self, shard_name: str, records_in_shard: Iterable[dict[str, Any]]) -> None:
+        """レコードリストをページ単位のテーブルでターミナルに出力"""
+        title = f"List Records: {self.target_stream_name}: {shard_name}"
+        page: list[tuple[int, dict[str, Any]]] = []
+        num_of_pages = 0
+        for index, record in enumerate(records_in_shard):
+            page.append((index, record))
+            if len(page) == self.page_size:
+                rich.print(render_page(title, page, self.decoder, self.max_data_width))
+                page = []
+                num_of_pages += 1
+        if page or not num_of_pages:
+            rich.print(render_page(title, page, self.decoder, self.max_data_width))
+
+    def _output_files(self, shard_ids: tuple[str, ...], output: str) -> None:
+        """レコードを指定した形式でシャードごとのファイル、または標準出力に書き込む
+
+        複数のシャードは並列に読み取り、読み取ったバッチから順にシャードのファイルに書き込む
+        読み取ったレコードはレコードストアに保持しない
+        標準出力に複数のシャードを書き込む場合は、ShardId列を追加して1つのストリームにまとめる
+        """
+        writer_class = RECORD_WRITERS[output]
+        to_stdout = self.dump_dir == "-"
+        fieldnames: tuple[str, ...] = self.csv_fieldnames
+        if to_stdout and len(shard_ids) > 1:
+            fieldnames = (const.SHARD_ID, *fieldnames)
 
-        for target_record in target_records:
-            rich.print(target_record)
-        print(f"{len(target_records)} record found")
-
-    def _find_records_by_key(self, key: str) -> list[dict[str, str]]:
-        """指定されたキーワードのレコードを検索して返す"""
-        target_records = []
-        for shard_id, records in self.all_records.items():
-            for seqNum, data_item in records.items():
-                if key in data_item[const.DATA]:
-                    target_records.append(
-                        {
-                            const.SHARD_ID: shard_id,
-                            const.SEQ_NUM: seqNum,
-                            const.DATA: data_item[const.DATA],
-                            const.PARTITION_KEY: data_item[const.PARTITION_KEY],
-                            const.TIMESTAMP: data_item[const.TIMESTAMP],
-                        }
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        writers: dict[str, RecordWriter] = {}
+        try:
+            if to_stdout:
+                writer = writer_class("-", fieldnames, self.decoder)
+                writers = {shard_id: writer for shard_id in shard_ids}
+            else:
+                os.makedirs(self.dump_dir, exist_ok=True)
+                for shard_id in shard_ids:
+                    output_filename = (
+                        f"kdv_output_{self.target_stream_name}_{shard_id}_{timestamp}"
+                        f".{writer_class.extension}"
+                    )
+                    writers[shard_id] = writer_class(
+                        os.path.join(self.dump_dir, output_filename), fieldnames, self.decoder
                     )
-        return target_records
 
-    def _output_terminal(self, shard_name: str, records_in_shard: list[dict[str, str]]) -> None:
-        """レコードリストをターミナルに出力"""
-        table = Table(
-            show_header=True,
-            header_style="bold magenta",
-            title=f"List Records: {self.target_stream_name}: {shard_name}",
-        )
-        table.add_column(const.NUMBER, justify="center")
-        table.add_column(const.SEQ_NUM, style="bold", width=60)
-        table.add_column(const.PARTITION_KEY)
-        table.add_column(const.DATA)
-        table.add_column(const.TIMESTAMP)
-        for index, record in enumerate(records_in_shard):
-            table.add_row(
-                str(index),
-                record[const.SEQ_NUM],
-                record[const.PARTITION_KEY],
-                record[const.DATA],
-                record[const.TIMESTAMP],
+            # 読み取り済みのシャードはレコードストアから書き込み、それ以外はレコードストアに保持せずに
+            # 読み取ったバッチをそのまま書き込むため、メモリ使用量はバッチサイズ程度に抑えられる
+            pending = tuple(s for s in shard_ids if not self.records.is_loaded(s))
+            for shard_id in shard_ids:
+                if shard_id not in pending:
+                    writers[shard_id].write(
+                        {const.SHARD_ID: shard_id, **record}
+                        for record in self.records.shard(shard_id).iter_records()
+                    )
+            with self._read_progress():
+                for shard_id, batch in self.kds_client.iter_records(pending):
+                    writers[shard_id].write(
+                        {const.SHARD_ID: shard_id, **record} for record in batch
+                    )
+        finally:
+            for writer in set(writers.values()):
+                writer.close()
+
+        if not to_stdout:
+            for writer in writers.values():
+                rich.print(f"{msg.OUTPUT_FILE} '{os.path.basename(writer.path)}'.")
+
+    def refresh(self) -> None:
+        """シャード一覧を取得し直し、読み取り済みのシャードに追加されたレコードのみを読み取る
+
+        リシャーディングで追加されたシャードは、後続のコマンドで必要になった時点で読み取る
+        """
+        self.kds_client.shard_topology = None
+        self.shard_ids = self.kds_client.list_shards()
+        loaded = tuple(shard_id for shard_id in self.shard_ids if self.records.is_loaded(shard_id))
+        with self._read_progress():
+            num_of_added = sum(
+                stop - start for _, start, stop in self.records.load(self.kds_client, loaded, True)
             )
-        rich.print(table)
-
-    def _output_csv(self, shard_name: str, records_in_shard: list[dict[str, str]]) -> None:
-        """レコードリストをcsvファイルに出力"""
+        rich.print(f"{num_of_added} {msg.REFRESHED}")
+
+    def tail(self) -> None:
+        """オープン中のシャードに追加されるレコードを追跡し、到着した順に出力する
+
+        start_timeを指定した場合はその日時から、指定しない場合は実行時点以降に追加されたレコードを出力する
+        tail_durationの秒数が経過するか、Ctrl-Cで中断するまで追跡する
+        """
+        if self.tail_output not in ("terminal", "jsonl"):
+            raise ValueError(msg.INVALID_TAIL_OUTPUT)
+        query = SearchQuery.parse(self.tail_filter) if self.tail_filter else None
+        engine = SearchEngine(self.decoder)
+        writer: Optional[RecordWriter] = None
+        if self.tail_output == "jsonl":
+            writer = self._create_tail_writer()
+
+        stop = threading.Event()
+        timer = threading.Timer(self.tail_duration, stop.set) if self.tail_duration > 0 else None
+        num_of_records = 0
+        rich.print(msg.TAIL_START)
+        try:
+            if timer is not None:
+                timer.start()
+            for shard_id, batch in self.kds_client.follow_records(stop):
+                records = [
+                    {const.SHARD_ID: shard_id, **record}
+                    for record in batch
+                    if query is None
+                    or engine.match(query, record[const.DATA], record[const.PARTITION_KEY])
+                ]
+                if writer is not None:
+                    writer.write(records)
+                    writer.file.flush()
+                else:
+                    for record in records:
+                        rich.print(self._format_record(record))
+                num_of_records += len(records)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            if timer is not None:
+                timer.cancel()
+            if writer is not None:
+                writer.close()
+
+        if writer is not None and writer.path != "-":
+            rich.print(f"{msg.OUTPUT_FILE} '{os.path.basename(writer.path)}'.")
+        print(f"{num_of_records} record received")
+
+    def _create_tail_writer(self) -> RecordWriter:
+        """tailのレコードを書き込むJSONLファイル、dump_dirが'-'の場合は標準出力を開く"""
+        fieldnames = (const.SHARD_ID, *self.csv_fieldnames)
+        if self.dump_dir == "-":
+            return JsonlRecordWriter("-", fieldnames, self.decoder)
+        os.makedirs(self.dump_dir, exist_ok=True)
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_filename = f"kdv_output_{self.target_stream_name}_{shard_name}_{timestamp}.csv"
-        output_path = os.path.join("dist", output_filename)
-        os.makedirs("dist", exist_ok=True)
-        with open(output_path, mode="w", newline="") as file:
-            writer = csv.DictWriter(file, fieldnames=records_in_shard[0].keys())
-            writer.writeheader()
-            writer.writerows(records_in_shard)
-
-        rich.print(f"{msg.OUTPUT_CSV} '{output_filename}'.")
-
-    def _dict_to_list(self, records_in_shard: dict[int, dict]) -> list[dict]:
-        """dictionaryのkeyとvalueを分解し、dictionaryのlistとして再構成する"""
-        return [
-            dict(**{const.SEQ_NUM: seqNum}, **record) for seqNum, record in records_in_shard.items()
-        ]
+        output_filename = f"kdv_tail_{self.target_stream_name}_{timestamp}.jsonl"
+        return JsonlRecordWriter(
+            os.path.join(self.dump_dir, output_filename), fieldnames, self.decoder
+        )
 
     def _select_command(self) -> str:
         """ターミナルで結果の出力方法を選択する"""
-        rich.print(msg.SELECT_EXIT)
+        import questionary
+
+        rich.print(msg.SELECT_REFRESH)
         return questionary.select("Command?", choices=self.commands).ask()
 
-    def _select_shard(self) -> str:
-        """ターミナルで対象のシャードを選択する"""
+    def _select_shard(self, allow_all: bool = False) -> str:
+        """ターミナルで対象のシャードを選択する、allow_allの場合は全シャードも選択可能"""
+        import questionary
+
         # シャード情報取得
         self.shard_ids = self.shard_ids or (self.kds_client.list_shards())
 
-        return questionary.select("Target Shard?", choices=self.shard_ids).ask()
+        choices = [ALL_SHARDS, *self.shard_ids] if allow_all else list(self.shard_ids)
+        return questionary.select("Target Shard?", choices=choices).ask()
 
     def _select_output(self) -> str:
         """ターミナルで結果の出力方法を選択する"""
-        return questionary.select("Output destination?", choices=["terminal", "csv"]).ask()
+        import questionary
+
+        return questionary.select(
+            "Output destination?", choices=["terminal", *RECORD_WRITERS]
+        ).ask()
 
     def _enter_key(self) -> str:
         """ターミナルでレコード検索に使うkeyを入力する"""
+        import questionary
+
         return questionary.text("Key?").ask()
@@ -2,6 +2,31 @@ NO_STREAM = "No data streams found"
 EXIT = "exit kinesis viewer cli"
 INVALID_COMMAND = "Invalid command name"
 NO_RECORD = "Could not find record"
-OUTPUT_CSV = "Output written to CSV file"
+OUTPUT_FILE = "Output written to file"
 SUMMARY_TITLE = "Data Stream Summary"
-SELECT_EXIT = "select 'exit' for data refresh"
+HOT_KEYS_TITLE = "Top Partition Keys"
+THROUGHPUT_TITLE = "Records per Second"
+SELECT_REFRESH = "select 'refresh' to read newly added records"
+REFRESHED = "records added since the last read"
+INVALID_TIME = (
+    "Invalid time format, use ISO 8601 (e.g. 2024-10-24T14:00:00) or relative (e.g. -10m)"
+)
+INVALID_TIME_WINDOW = "start_time must be earlier than end_time"
+INVALID_DECODER = "Unknown decoder, choose from utf-8, gzip, base64, kpl, auto"
+INVALID_REGEX = "Invalid regular expression"
+PARQUET_UNAVAILABLE = "Parquet files require pyarrow, install it with 'pip install pyarrow'"
+INVALID_SUMMARY_MODE = "Unknown summary mode, choose from full, metadata, sample"
+SUMMARY_CACHED = "NumOfRecords and LastAddedTime are taken from the local cache"
+SUMMARY_ESTIMATED = "Values prefixed with '~' are estimated from sampled records"
+INVALID_TAIL_OUTPUT = "Unknown tail output, choose from terminal, jsonl"
+TAIL_START = "Following new records, press Ctrl-C to stop"
+INVALID_READ_ENGINE = "Unknown read engine, choose from polling, efo"
+CONSUMER_NOT_ACTIVE = "Stream consumer did not become active in time"
+INVALID_READ_BACKEND = "Unknown read backend, choose from thread, async"
+ASYNC_UNAVAILABLE = (
+    "Async read backend requires aiobotocore, install it with 'pip install aiobotocore'"
+)
+SOURCE_NOT_FOUND = "No snapshot found at the source path"
+SOURCE_AMBIGUOUS = "The source contains several streams, specify --target_stream_name"
+OFFLINE_UNSUPPORTED = "This command needs access to the stream and is not available with --source"
+METRICS_FILE = "Read metrics written to file"
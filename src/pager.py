@@ -0,0 +1,178 @@
+from bisect import bisect_left
+from collections.abc import Iterable, Iterator
+from typing import TYPE_CHECKING, Any, Optional
+
+import rich
+
+import src.const as const
+import src.msg as msg
+from src.decoders import DataDecoder
+from src.exporters import format_record
+from src.record_store import ShardRecords
+
+if TYPE_CHECKING:
+    from rich.table import Table
+
+# 1ページに表示するレコード数の既定値
+DEFAULT_PAGE_SIZE = 100
+# テーブルに表示するDataの最大文字数の既定値、超過した部分は省略する
+DEFAULT_MAX_DATA_WIDTH = 200
+# ページ表示中に選択可能な操作
+PAGER_COMMANDS = ("next", "prev", "jump", "detail", "quit")
+
+
+def truncate(text: str, width: int) -> str:
+    """文字列を最大width文字に省略する、widthが0以下の場合は省略しない"""
+    if width <= 0 or len(text) <= width:
+        return text
+    return text[: max(width - 3, 0)] + "..."
+
+
+def render_page(
+    title: str,
+    rows: Iterable[tuple[int, dict[str, Any]]],
+    decoder: DataDecoder,
+    max_data_width: int = DEFAULT_MAX_DATA_WIDTH,
+) -> "Table":
+    """(行番号, レコード)のリストから1ページ分のテーブルを作成する
+
+    Dataのデコードと省略は表示する行に対してのみ行う
+    """
+    from rich.table import Table
+
+    table = Table(show_header=True, header_style="bold magenta", title=title)
+    table.add_column(const.NUMBER, justify="center")
+    table.add_column(const.SEQ_NUM, style="bold", width=60)
+    table.add_column(const.PARTITION_KEY)
+    table.add_column(const.DATA)
+    table.add_column(const.TIMESTAMP)
+    for index, record in rows:
+        formatted = format_record(record, decoder)
+        table.add_row(
+            str(index),
+            formatted[const.SEQ_NUM],
+            formatted[const.PARTITION_KEY],
+            truncate(formatted[const.DATA], max_data_width),
+            formatted[const.TIMESTAMP],
+        )
+    return table
+
+
+class RecordPager:
+    """シャードのレコードをページ単位で表示するクラス
+
+    表示するページに必要な分だけシャードを読み進め、表示中のページの行のみをテーブルに描画する
+    対話実行時は次/前のページ、シーケンス番号による移動、レコードの詳細表示を選択でき、
+    非対話実行時は全ページを先頭から順に出力する
+    """
+
+    def __init__(
+        self,
+        shard: ShardRecords,
+        ranges: Iterator[tuple[ShardRecords, int, int]],
+        title: str,
+        decoder: DataDecoder,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        max_data_width: int = DEFAULT_MAX_DATA_WIDTH,
+    ) -> None:
+        self.shard = shard
+        self.ranges: Optional[Iterator[tuple[ShardRecords, int, int]]] = ranges
+        self.title = title
+        self.decoder = decoder
+        self.page_size = max(page_size, 1)
+        self.max_data_width = max_data_width
+
+    def fill(self, count: int) -> bool:
+        """シャードのレコードがcount件以上になるまで読み進め、count件以上あるかどうかを返す"""
+        while len(self.shard) < count and self.ranges is not None:
+            if next(self.ranges, None) is None:
+                self.ranges = None
+        return len(self.shard) >= count
+
+    def has_page(self, number: int) -> bool:
+        """指定したページ(0始まり)にレコードが存在するかどうか"""
+        return number == 0 or (number > 0 and self.fill(number * self.page_size + 1))
+
+    def render(self, number: int) -> "Table":
+        """指定したページのテーブルを作成する"""
+        start = number * self.page_size
+        self.fill(start + self.page_size)
+        stop = min(start + self.page_size, len(self.shard))
+        rows = ((index, self.shard.record(index)) for index in range(start, stop))
+        title = f"{self.title} (page {number + 1})"
+        return render_page(title, rows, self.decoder, self.max_data_width)
+
+    def find_page(self, sequence_number: int) -> Optional[int]:
+        """シーケンス番号のレコードを含むページを返す、存在しない場合はNone
+
+        レコードはシーケンス番号の昇順に格納されているため、二分探索で位置を求める
+        """
+        while True:
+            sequence_numbers = self.shard.sequence_numbers
+            if sequence_numbers and sequence_numbers[-1] >= sequence_number:
+                index = bisect_left(sequence_numbers, sequence_number)
+                if sequence_numbers[index] != sequence_number:
+                    return None
+                return index // self.page_size
+            if not self.fill(len(self.shard) + 1):
+                return None
+
+    def print_all(self) -> None:
+        """全ページを先頭から順に出力する"""
+        number = 0
+        while self.has_page(number):
+            rich.print(self.render(number))
+            number += 1
+
+    def browse(self) -> None:
+        """ページを表示し、選択された操作に応じてページを移動する"""
+        import questionary
+
+        number = 0
+        rich.print(self.render(number))
+        while (command := questionary.select("Page?", choices=PAGER_COMMANDS).ask()) not in (
+            None,
+            "quit",
+        ):
+            if command == "next" and self.has_page(number + 1):
+                number += 1
+            elif command == "prev" and number > 0:
+                number -= 1
+            elif command == "jump":
+                found = self._ask_page()
+                if found is None:
+                    print(msg.NO_RECORD)
+                    continue
+                number = found
+            elif command == "detail":
+                self._show_detail(number)
+                continue
+            rich.print(self.render(number))
+
+    def close(self) -> None:
+        """読み取りを途中で終了する"""
+        if self.ranges is not None and hasattr(self.ranges, "close"):
+            self.ranges.close()
+        self.ranges = None
+
+    def _ask_page(self) -> Optional[int]:
+        import questionary
+
+        answer = questionary.text("Sequence Number?").ask()
+        if not answer or not answer.strip().isdigit():
+            return None
+        return self.find_page(int(answer))
+
+    def _show_detail(self, number: int) -> None:
+        """表示中のページのレコードをData全体を含めて表示する"""
+        import questionary
+
+        answer = questionary.text(f"{const.NUMBER}?").ask()
+        if not answer or not answer.strip().isdigit():
+            return
+        index = int(answer)
+        start = number * self.page_size
+        if not start <= index < min(start + self.page_size, len(self.shard)):
+            print(msg.NO_RECORD)
+            return
+        rich.print(format_record(self.shard.record(index), self.decoder))
@@ -0,0 +1,265 @@
+import datetime
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Sequence
+from typing import TYPE_CHECKING, Any, Optional
+
+import src.const as const
+
+if TYPE_CHECKING:
+    from rich.table import Table
+
+# APIの応答時間のヒストグラムのバケットの上限(ミリ秒)、最後のバケットは上限なし
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+# 進捗表示のバーの幅(文字数)
+PROGRESS_BAR_WIDTH = 30
+
+
+class ReadHooks:
+    """シャード読み取りの計測ポイントで呼び出されるフック、既定では何もしない
+
+    ShardReadSchedulerはAPIの呼び出しごとに、KinesisClientはレコードを取得するごとに呼び出す
+    複数のスレッド、イベントループから呼び出されるため、実装はスレッドセーフにすること
+    """
+
+    def on_api_call(
+        self, shard_id: str, operation: str, latency: float, throttled: bool = False
+    ) -> None:
+        """APIを1回呼び出した(再試行の場合は1回の試行)後に呼び出される、latencyは秒"""
+
+    def on_retry(self, shard_id: str, operation: str, attempt: int) -> None:
+        """スロットリングにより再試行する前に呼び出される"""
+
+    def on_batch(
+        self, shard_id: str, records: Sequence[dict], millis_behind_latest: Optional[int]
+    ) -> None:
+        """GetRecordsのレスポンス、SubscribeToShardのイベントを受信するごとに呼び出される
+
+        recordsはAPIのレスポンスのレコード(空の場合もある)
+        """
+
+
+class LatencyHistogram:
+    """APIの応答時間を固定のバケット(LATENCY_BUCKETS_MS)で数えるヒストグラム"""
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, latency_ms: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+        self.count += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def percentile(self, ratio: float) -> Optional[float]:
+        """指定した割合(0-1)のパーセンタイルをバケットの上限で返す、記録がない場合はNone"""
+        if not self.count:
+            return None
+        rank = max(1, round(self.count * ratio))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(
+                    (
+                        float(LATENCY_BUCKETS_MS[index])
+                        if index < len(LATENCY_BUCKETS_MS)
+                        else self.max_ms
+                    ),
+                    self.max_ms,
+                )
+        return self.max_ms
+
+    def to_dict(self) -> dict[str, Any]:
+        labels = [f"<={bound}" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+        return {
+            "count": self.count,
+            "mean": self.total_ms / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max_ms if self.count else None,
+            "histogram": dict(zip(labels, self.counts)),
+        }
+
+
+class ShardMetrics:
+    """シャードごとの読み取りの計測値"""
+
+    def __init__(self, shard_id: str) -> None:
+        self.shard_id = shard_id
+        self.records = 0
+        self.bytes = 0
+        self.api_calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.latency = LatencyHistogram()
+        # 最初に観測したMillisBehindLatestを読み取りの進捗の基準とする
+        self.initial_millis_behind: Optional[int] = None
+        self.millis_behind_latest: Optional[int] = None
+        self.started_at: Optional[float] = None
+        self.updated_at: Optional[float] = None
+
+    @property
+    def records_per_sec(self) -> Optional[float]:
+        if self.started_at is None or self.updated_at is None:
+            return None
+        elapsed = self.updated_at - self.started_at
+        return self.records / elapsed if elapsed > 0 else None
+
+    @property
+    def completed(self) -> float:
+        """MillisBehindLatestから求めた読み取りの進捗(0-1)"""
+        if self.millis_behind_latest is None:
+            return 0.0
+        if not self.initial_millis_behind:
+            return 1.0
+        return 1 - self.millis_behind_latest / self.initial_millis_behind
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "records": self.records,
+            "bytes": self.bytes,
+            "records_per_sec": self.records_per_sec,
+            "millis_behind_latest": self.millis_behind_latest,
+            "api_calls": self.api_calls,
+            "throttles": self.throttles,
+            "retries": self.retries,
+            "latency_ms": self.latency.to_dict(),
+        }
+
+
+class ReadMetrics(ReadHooks):
+    """シャード、APIごとの呼び出し回数、スロットリング回数、応答時間、読み取ったレコード数を集計するフック
+
+    集計結果は進捗表示(render_progress)とJSONファイル(write)に出力する
+    """
+
+    def __init__(self, stream_name: str = "") -> None:
+        self.stream_name = stream_name
+        self.started_at = time.monotonic()
+        self.created_at = datetime.datetime.now().astimezone()
+        self.shards: dict[str, ShardMetrics] = {}
+        self.operations: dict[str, ShardMetrics] = {}
+        self.lock = threading.Lock()
+
+    def _shard(self, shard_id: str) -> ShardMetrics:
+        if shard_id not in self.shards:
+            self.shards[shard_id] = ShardMetrics(shard_id)
+        return self.shards[shard_id]
+
+    def _operation(self, operation: str) -> ShardMetrics:
+        if operation not in self.operations:
+            self.operations[operation] = ShardMetrics(operation)
+        return self.operations[operation]
+
+    def on_api_call(
+        self, shard_id: str, operation: str, latency: float, throttled: bool = False
+    ) -> None:
+        now = time.monotonic()
+        with self.lock:
+            for metrics in (self._shard(shard_id), self._operation(operation)):
+                metrics.api_calls += 1
+                metrics.throttles += int(throttled)
+                metrics.latency.add(latency * 1000)
+                if metrics.started_at is None:
+                    metrics.started_at = now - latency
+
+    def on_retry(self, shard_id: str, operation: str, attempt: int) -> None:
+        with self.lock:
+            self._shard(shard_id).retries += 1
+            self._operation(operation).retries += 1
+
+    def on_batch(
+        self, shard_id: str, records: Sequence[dict], millis_behind_latest: Optional[int]
+    ) -> None:
+        now = time.monotonic()
+        with self.lock:
+            shard = self._shard(shard_id)
+            shard.records += len(records)
+            shard.bytes += sum(len(record[const.DATA]) for record in records)
+            shard.updated_at = now
+            if shard.started_at is None:
+                shard.started_at = now
+            if millis_behind_latest is not None:
+                if shard.initial_millis_behind is None:
+                    shard.initial_millis_behind = millis_behind_latest
+                shard.millis_behind_latest = millis_behind_latest
+
+    def to_dict(self) -> dict[str, Any]:
+        """集計結果をJSONに変換できる形式で返す"""
+        with self.lock:
+            elapsed = time.monotonic() - self.started_at
+            shards = list(self.shards.values())
+            total_records = sum(shard.records for shard in shards)
+            return {
+                "stream": self.stream_name,
+                "started_at": self.created_at.isoformat(timespec="seconds"),
+                "elapsed_sec": elapsed,
+                "total": {
+                    "records": total_records,
+                    "bytes": sum(shard.bytes for shard in shards),
+                    "records_per_sec": total_records / elapsed if elapsed > 0 else None,
+                    "api_calls": sum(shard.api_calls for shard in shards),
+                    "throttles": sum(shard.throttles for shard in shards),
+                    "retries": sum(shard.retries for shard in shards),
+                },
+                "operations": {
+                    name: {
+                        "api_calls": operation.api_calls,
+                        "throttles": operation.throttles,
+                        "retries": operation.retries,
+                        "latency_ms": operation.latency.to_dict(),
+                    }
+                    for name, operation in sorted(self.operations.items())
+                },
+                "shards": {shard.shard_id: shard.to_dict() for shard in shards},
+            }
+
+    def write(self, path: str) -> None:
+        """集計結果をJSONファイルに書き込む"""
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def render_progress(self) -> "Table":
+        """シャードごとの読み取りの進捗をテーブルとして返す"""
+        from rich.progress_bar import ProgressBar
+        from rich.table import Table
+
+        with self.lock:
+            shards = list(self.shards.values())
+            rows = [
+                (
+                    shard.shard_id,
+                    shard.completed,
+                    shard.records,
+                    shard.bytes,
+                    shard.millis_behind_latest,
+                    shard.api_calls,
+                    shard.throttles,
+                )
+                for shard in shards
+            ]
+        table = Table(show_header=True, header_style="bold magenta", box=None)
+        table.add_column(const.SHARD_ID, style="bold")
+        table.add_column("", width=PROGRESS_BAR_WIDTH)
+        table.add_column(const.NUM_OF_RECORDS, justify="right")
+        table.add_column(const.TOTAL_BYTES, justify="right")
+        table.add_column(const.MILLIS_BEHIND_LATEST, justify="right")
+        table.add_column(const.API_CALLS, justify="right")
+        table.add_column(const.THROTTLES, justify="right")
+        for shard_id, completed, records, num_bytes, behind, calls, throttles in rows:
+            table.add_row(
+                shard_id,
+                ProgressBar(total=1.0, completed=completed, width=PROGRESS_BAR_WIDTH),
+                str(records),
+                str(num_bytes),
+                "-" if behind is None else str(behind),
+                str(calls),
+                str(throttles),
+            )
+        return table
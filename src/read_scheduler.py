@@ -0,0 +1,152 @@
+import random
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional, TypeVar
+
+from botocore.exceptions import ClientError
+
+from src.read_metrics import ReadHooks
+
+T = TypeVar("T")
+
+# シャードあたりのGetRecords上限(5回/秒)
+DEFAULT_READS_PER_SEC = 5.0
+# シャード数が多い場合の同時読み取りスレッド数の上限
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_RETRIES = 10
+# スロットリング時のバックオフ(秒)
+BASE_BACKOFF_SEC = 0.2
+MAX_BACKOFF_SEC = 10.0
+# リトライ対象とするスロットリング系のエラーコード
+THROTTLING_ERROR_CODES = (
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+    "ThrottlingException",
+    "KMSThrottlingException",
+)
+
+
+class TokenBucket:
+    """一定レートでトークンを補充し、トークンがない場合は補充まで待機させるトークンバケット"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """トークンを1つ消費する、トークンが不足している場合は補充されるまで待機する
+
+        Returns:
+            待機した秒数
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self) -> float:
+        """トークンを1つ前借りし、不足分が補充されるまでの秒数を返す、待機は呼び出し元で行う"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class ShardReadScheduler:
+    """シャード読み取りの同時実行数、シャードごとのリクエストレート、スロットリング時の再試行を制御する"""
+
+    def __init__(
+        self,
+        max_concurrency: int = 0,
+        reads_per_sec: float = DEFAULT_READS_PER_SEC,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        base_backoff: float = BASE_BACKOFF_SEC,
+        max_backoff: float = MAX_BACKOFF_SEC,
+        hooks: Optional[ReadHooks] = None,
+    ) -> None:
+        self.max_concurrency = max_concurrency or DEFAULT_MAX_CONCURRENCY
+        self.reads_per_sec = reads_per_sec
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.buckets: dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+        # API呼び出しの応答時間、スロットリング、再試行を通知するフック
+        self.hooks = hooks or ReadHooks()
+
+    def workers_for(self, num_of_shards: int) -> int:
+        """シャード数に応じた同時読み取りスレッド数を返す"""
+        return max(1, min(num_of_shards, self.max_concurrency))
+
+    def bucket(self, shard_id: str) -> TokenBucket:
+        """シャードごとのトークンバケットを返す"""
+        with self.lock:
+            if shard_id not in self.buckets:
+                self.buckets[shard_id] = TokenBucket(self.reads_per_sec)
+            return self.buckets[shard_id]
+
+    def call(self, shard_id: str, func: Callable[..., T], **kwargs: Any) -> T:
+        """シャードのレート制限に従ってAPIを呼び出す
+
+        スロットリングされた場合はジッター付きの指数バックオフで再試行し、
+        再試行回数の上限に達した場合は例外をそのまま送出する
+        試行ごとの応答時間(レート制限、バックオフでの待機を除く)はフックに通知する
+        """
+        operation = getattr(func, "__name__", "")
+        attempt = 0
+        while True:
+            self.bucket(shard_id).acquire()
+            started = time.monotonic()
+            try:
+                result = func(**kwargs)
+            except ClientError as e:
+                throttled = self.is_throttling(e)
+                self.hooks.on_api_call(shard_id, operation, time.monotonic() - started, throttled)
+                if not throttled or attempt >= self.max_retries:
+                    raise
+            else:
+                self.hooks.on_api_call(shard_id, operation, time.monotonic() - started)
+                return result
+            self.hooks.on_retry(shard_id, operation, attempt + 1)
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def call_async(
+        self, shard_id: str, func: Callable[..., Awaitable[T]], **kwargs: Any
+    ) -> T:
+        """callと同じレート制限、再試行でコルーチンのAPIを呼び出す、待機中はイベントループを止めない"""
+        import asyncio
+
+        operation = getattr(func, "__name__", "")
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.bucket(shard_id).reserve())
+            started = time.monotonic()
+            try:
+                result = await func(**kwargs)
+            except ClientError as e:
+                throttled = self.is_throttling(e)
+                self.hooks.on_api_call(shard_id, operation, time.monotonic() - started, throttled)
+                if not throttled or attempt >= self.max_retries:
+                    raise
+            else:
+                self.hooks.on_api_call(shard_id, operation, time.monotonic() - started)
+                return result
+            self.hooks.on_retry(shard_id, operation, attempt + 1)
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def backoff(self, attempt: int) -> float:
+        """再試行までの待機秒数を返す(Full Jitter)"""
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2**attempt))
+
+    @staticmethod
+    def is_throttling(error: ClientError) -> bool:
+        """スロットリングによるエラーかどうかを判定する"""
+        return error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
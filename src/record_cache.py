@@ -0,0 +1,213 @@
+import datetime
+import os
+import sqlite3
+import threading
+from collections.abc import Iterator
+from typing import Any, Optional
+
+import src.const as const
+from src.time_util import to_epoch_millis
+
+# キャッシュのテーブル定義を変更した場合は値を更新し、既存のキャッシュを破棄する
+SCHEMA_VERSION = "3"
+# キャッシュから一度に読み出すレコード数
+DEFAULT_BATCH_SIZE = 1000
+CACHE_EXTENSION = ".sqlite3"
+
+
+def encode_sequence_number(sequence_number: int) -> bytes:
+    """シーケンス番号をバイト長 + ビッグエンディアンのバイト列に変換する
+
+    桁数の異なるシーケンス番号でもバイト列の比較結果が数値の大小と一致する
+    """
+    length = (sequence_number.bit_length() + 7) // 8
+    return bytes([length]) + sequence_number.to_bytes(length, "big")
+
+
+def decode_sequence_number(value: bytes) -> int:
+    """encode_sequence_numberで変換したバイト列をシーケンス番号に戻す"""
+    return int.from_bytes(value[1:], "big")
+
+
+def cache_filename(region: str, stream_name: str) -> str:
+    """DataStreamのキャッシュのファイル名を返す、リージョン名は'_'を含まないため先頭の'_'で分割できる"""
+    return f"{region}_{stream_name}{CACHE_EXTENSION}"
+
+
+class RecordCache:
+    """取得済みのレコードをDataStreamごとのSQLiteファイルに保存するローカルキャッシュ
+
+    シャードごとに最後に保存したシーケンス番号を記録し、
+    次回の読み取りはそのシーケンス番号の直後(AFTER_SEQUENCE_NUMBER)から行う
+    シーケンス番号はバイト長を先頭に付与したビッグエンディアンのBLOBとして保存し、
+    主キーのインデックス上でバイト列の比較がそのまま数値順となるようにする
+    """
+
+    def __init__(self, cache_dir: str, region: str, stream_name: str, mmap_size: int = 0) -> None:
+        """
+        Args:
+            mmap_size: SQLiteファイルをメモリマップで読み込むサイズ(バイト)、0の場合はメモリマップを使用しない
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, cache_filename(region, stream_name))
+        # シャード読み取りスレッドから共有するため、操作はロックで直列化する
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        if mmap_size > 0:
+            self.conn.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+        self._create_tables()
+
+    def _create_tables(self) -> None:
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS shards ("
+                " shard_id TEXT PRIMARY KEY, last_seq BLOB, closed INTEGER DEFAULT 0)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                " shard_id TEXT NOT NULL, seq BLOB NOT NULL, partition_key TEXT NOT NULL,"
+                " data BLOB NOT NULL, timestamp INTEGER NOT NULL,"
+                " PRIMARY KEY (shard_id, seq)) WITHOUT ROWID"
+            )
+
+    def validate(self, stream_created_at: str, retention_hours: int) -> None:
+        """キャッシュと対象のDataStreamの整合性を確認する
+
+        DataStreamが再作成されている、またはキャッシュの形式が古い場合はキャッシュを破棄し、
+        保持期間を過ぎたレコードはキャッシュからも削除する
+        """
+        version = f"{SCHEMA_VERSION}:{stream_created_at}"
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:
+            with self.lock, self.conn:
+                self.conn.execute("DROP TABLE IF EXISTS records")
+                self.conn.execute("DROP TABLE IF EXISTS shards")
+            self._create_tables()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,)
+            )
+            expired = datetime.datetime.now() - datetime.timedelta(hours=retention_hours)
+            self.conn.execute(
+                "DELETE FROM records WHERE timestamp < ?", (to_epoch_millis(expired),)
+            )
+
+    def last_sequence_number(self, shard_id: str) -> Optional[int]:
+        """シャードで最後にキャッシュしたレコードのシーケンス番号を返す"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT last_seq FROM shards WHERE shard_id = ?", (shard_id,)
+            ).fetchone()
+        return decode_sequence_number(row[0]) if row and row[0] is not None else None
+
+    def is_closed(self, shard_id: str) -> bool:
+        """クローズ済みシャードを最後までキャッシュ済みかどうかを返す"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT closed FROM shards WHERE shard_id = ?", (shard_id,)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def shard_ids(self) -> tuple[str, ...]:
+        """キャッシュ済みのシャードIDを昇順で返す"""
+        with self.lock:
+            rows = self.conn.execute("SELECT shard_id FROM shards ORDER BY shard_id").fetchall()
+        return tuple(row[0] for row in rows)
+
+    def shard_stats(self) -> dict[str, tuple[int, int]]:
+        """シャードごとのキャッシュ済みレコード数と最後に追加されたレコードの日時を返す
+
+        Return Example:
+          {'shardId-000000000000': (30, 1729747423001)}
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT shard_id, COUNT(*), MAX(timestamp) FROM records GROUP BY shard_id"
+            ).fetchall()
+        return {shard_id: (count, last_timestamp) for shard_id, count, last_timestamp in rows}
+
+    def iter_batches(
+        self, shard_id: str, batch_size: int = DEFAULT_BATCH_SIZE, after: Optional[int] = None
+    ) -> Iterator[list[dict[str, Any]]]:
+        """シャードのキャッシュ済みレコードをシーケンス番号順にバッチ単位で返す
+
+        afterを指定した場合は、そのシーケンス番号より後のレコードのみを返す
+        """
+        last_seq = b"" if after is None else encode_sequence_number(after)
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT seq, data, partition_key, timestamp FROM records"
+                    " WHERE shard_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                    (shard_id, last_seq, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            yield self._to_records(rows)
+            last_seq = rows[-1][0]
+
+    def recent_records(self, shard_id: str, count: int) -> list[dict[str, Any]]:
+        """シャードのキャッシュ済みレコードをシーケンス番号の降順で最大count件返す"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT seq, data, partition_key, timestamp FROM records WHERE shard_id = ?"
+                " ORDER BY seq DESC LIMIT ?",
+                (shard_id, count),
+            ).fetchall()
+        return self._to_records(rows)
+
+    def append(self, shard_id: str, batch: list[dict[str, Any]]) -> None:
+        """シャードから読み取ったレコードをキャッシュに追加する"""
+        if not batch:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO records (shard_id, seq, partition_key, data, timestamp)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        shard_id,
+                        encode_sequence_number(record[const.SEQ_NUM]),
+                        record[const.PARTITION_KEY],
+                        record[const.DATA],
+                        record[const.TIMESTAMP],
+                    )
+                    for record in batch
+                ],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO shards (shard_id, last_seq) VALUES (?, ?)",
+                (shard_id, encode_sequence_number(batch[-1][const.SEQ_NUM])),
+            )
+
+    def mark_closed(self, shard_id: str) -> None:
+        """クローズ済みシャードを最後まで読み取ったことを記録する"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO shards (shard_id, last_seq) VALUES (?, NULL)", (shard_id,)
+            )
+            self.conn.execute("UPDATE shards SET closed = 1 WHERE shard_id = ?", (shard_id,))
+
+    def reset_shard(self, shard_id: str) -> None:
+        """シャードのキャッシュを破棄する"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM records WHERE shard_id = ?", (shard_id,))
+            self.conn.execute("DELETE FROM shards WHERE shard_id = ?", (shard_id,))
+
+    @staticmethod
+    def _to_records(rows: list[tuple]) -> list[dict[str, Any]]:
+        """SELECT結果の行を出力用のdictionaryに変換する"""
+        return [
+            {
+                const.SEQ_NUM: decode_sequence_number(seq),
+                const.DATA: data,
+                const.PARTITION_KEY: partition_key,
+                const.TIMESTAMP: timestamp,
+            }
+            for seq, data, partition_key, timestamp in rows
+        ]
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,135 @@
+import sys
+from array import array
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+import src.const as const
+from src.kinesis_client import KinesisClient
+
+
+class ShardRecords:
+    """シャード内のレコードを列ごとに保持するクラス
+
+    レコードごとのdictionaryを作らず、シーケンス番号(int)、追加日時(エポックミリ秒)、
+    パーティションキー(intern済みの文字列)、Data(bytes)をそれぞれ1つのリストまたは配列で保持する
+    レコードはシャードから読み取った順、つまりシーケンス番号の昇順で格納される
+    """
+
+    __slots__ = (
+        "shard_id",
+        "sequence_numbers",
+        "timestamps",
+        "partition_keys",
+        "data",
+        "complete",
+    )
+
+    def __init__(self, shard_id: str) -> None:
+        self.shard_id = shard_id
+        self.sequence_numbers: list[int] = []
+        self.timestamps = array("q")
+        self.partition_keys: list[str] = []
+        self.data: list[bytes] = []
+        # シャードを最後まで読み取ったかどうか
+        self.complete = False
+
+    def __len__(self) -> int:
+        return len(self.sequence_numbers)
+
+    def extend(self, batch: Iterable[dict[str, Any]]) -> None:
+        """シャードから読み取ったレコードのバッチを追加する"""
+        for record in batch:
+            self.sequence_numbers.append(record[const.SEQ_NUM])
+            self.timestamps.append(record[const.TIMESTAMP])
+            self.partition_keys.append(sys.intern(record[const.PARTITION_KEY]))
+            self.data.append(record[const.DATA])
+
+    def clear(self) -> None:
+        self.sequence_numbers.clear()
+        self.timestamps = array("q")
+        self.partition_keys.clear()
+        self.data.clear()
+        self.complete = False
+
+    def record(self, index: int) -> dict[str, Any]:
+        """指定した位置のレコードを出力用のdictionaryとして返す"""
+        return {
+            const.SEQ_NUM: self.sequence_numbers[index],
+            const.DATA: self.data[index],
+            const.PARTITION_KEY: self.partition_keys[index],
+            const.TIMESTAMP: self.timestamps[index],
+        }
+
+    def iter_records(self, start: int = 0, stop: int = -1) -> Iterator[dict[str, Any]]:
+        """指定した範囲のレコードをdictionaryとして順に返す、stopが負の場合は末尾まで"""
+        stop = len(self) if stop < 0 else stop
+        for index in range(start, stop):
+            yield self.record(index)
+
+
+class RecordStore:
+    """読み取り済みのレコードをシャードごとに保持するクラス
+
+    コマンドはこのクラスを経由してレコードを参照し、シャードを最後まで読み取った後は
+    同じセッション内の後続のコマンドでAPIを呼び出さずに再利用する
+    """
+
+    def __init__(self) -> None:
+        self.shards: dict[str, ShardRecords] = {}
+
+    def shard(self, shard_id: str) -> ShardRecords:
+        """シャードのレコードを返す、存在しない場合は空のShardRecordsを作成する"""
+        if shard_id not in self.shards:
+            self.shards[shard_id] = ShardRecords(shard_id)
+        return self.shards[shard_id]
+
+    def is_loaded(self, shard_id: str) -> bool:
+        """シャードを最後まで読み取り済みかどうかを返す"""
+        return shard_id in self.shards and self.shards[shard_id].complete
+
+    def load(
+        self, client: KinesisClient, shard_ids: tuple[str, ...], refresh: bool = False
+    ) -> Iterator[tuple[ShardRecords, int, int]]:
+        """未読み取りのシャードを読み取りながら、追加されたレコードの範囲を逐次返す
+
+        読み取り済みのシャードは全体を1つの範囲として返す
+        refreshの場合は読み取り済みのシャードも最後に読み取ったレコードの続きから読み取り、
+        新たに追加されたレコードの範囲のみを返す
+        途中で読み取りをやめた場合、そのシャードは未読み取りのままとなり次回は先頭から読み直す
+
+        Yields:
+            (シャードのレコード, 範囲の開始位置, 範囲の終了位置)
+        """
+        pending = tuple(
+            shard_id for shard_id in shard_ids if refresh or not self.is_loaded(shard_id)
+        )
+        after: dict[str, int] = {}
+        for shard_id in shard_ids:
+            if shard_id not in pending:
+                shard = self.shards[shard_id]
+                yield shard, 0, len(shard)
+            elif self.is_loaded(shard_id) and len(self.shards[shard_id]):
+                # 読み取り済みのレコードは残し、その続きから読み取る
+                after[shard_id] = self.shards[shard_id].sequence_numbers[-1]
+            else:
+                self.shard(shard_id).clear()
+        if not pending:
+            return
+
+        batches = (
+            client.iter_records(pending, after)
+            if len(pending) > 1
+            else (
+                (pending[0], batch)
+                for batch in client.iter_shard_records(
+                    pending[0], after_sequence_number=after.get(pending[0])
+                )
+            )
+        )
+        for shard_id, batch in batches:
+            shard = self.shards[shard_id]
+            start = len(shard)
+            shard.extend(batch)
+            yield shard, start, len(shard)
+        for shard_id in pending:
+            self.shards[shard_id].complete = True
@@ -0,0 +1,510 @@
+import json
+import multiprocessing
+import os
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, NamedTuple, Optional
+
+import src.msg as msg
+from src.decoders import DataDecoder
+from src.record_store import ShardRecords
+
+# 転置インデックスのトークン(ASCIIの英数字とアンダースコアの連続)
+TOKEN_PATTERN = re.compile(r"[0-9A-Za-z_]+")
+# フィールド検索のパス(例: recordId, detail.items[0].id)
+FIELD_PATH_PATTERN = re.compile(r"^[A-Za-z_][\w-]*(?:\.[A-Za-z_][\w-]*|\[\d+\])*$")
+FIELD_PATH_PART_PATTERN = re.compile(r"([A-Za-z_][\w-]*)|\[(\d+)\]")
+# インデックスの種類(トークン、パーティションキー)、フィールドのインデックスはパスを付与する
+TOKEN_INDEX = "token"
+PARTITION_KEY_INDEX = "partition_key"
+FIELD_INDEX_PREFIX = "field:"
+# 転置リストのシャード内の位置の型(符号なし32bit)
+POSITION_TYPECODE = "I"
+# 並列検索で1つのプロセスに渡すレコード数、総レコード数がこれより少ない場合は並列化しない
+PARALLEL_CHUNK_SIZE = 10000
+# 並列検索のプロセスの開始方式、シャード読み取りスレッドの実行中にforkすると
+# fork時点で保持されていたロックによりデッドロックしうるため、forkは使用しない
+PROCESS_START_METHODS = ("forkserver", "spawn")
+
+
+class SearchQuery(NamedTuple):
+    """検索条件
+
+    kind:
+      - text: Dataに指定の文字列を含む(既定)
+      - field: JSONのフィールドの値が一致する('recordId=RCS3ffmbiL')
+      - regex: Dataが正規表現に一致する('re:^{"recordId":"RCS')
+      - partition_key: パーティションキーが一致する('pk:RCS3ffmbiL')
+    """
+
+    kind: str
+    value: str
+    path: str = ""
+    pattern: Optional[re.Pattern] = None
+
+    @classmethod
+    def parse(cls, key: str) -> "SearchQuery":
+        if key.startswith("re:"):
+            try:
+                return cls("regex", key[3:], pattern=re.compile(key[3:]))
+            except re.error as e:
+                raise ValueError(f"{msg.INVALID_REGEX}: {e}")
+        if key.startswith("pk:"):
+            return cls("partition_key", key[3:])
+        path, separator, value = key.partition("=")
+        if separator and FIELD_PATH_PATTERN.match(path.strip()):
+            return cls("field", value.strip(), path=path.strip())
+        return cls("text", key)
+
+
+def extract_field(document: Any, path: str) -> Any:
+    """JSONオブジェクトからパスで指定された値を取り出す、存在しない場合はNoneを返す"""
+    for name, index in FIELD_PATH_PART_PATTERN.findall(path):
+        if name:
+            if not isinstance(document, dict) or name not in document:
+                return None
+            document = document[name]
+        else:
+            if not isinstance(document, list) or int(index) >= len(document):
+                return None
+            document = document[int(index)]
+    return document
+
+
+def field_value_key(value: Any) -> Optional[str]:
+    """フィールドの値を比較用の文字列に変換する、文字列以外はJSON表記とする"""
+    if value is None:
+        return None
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def scan_chunk(
+    key: str, decoder_names: str, data: list[bytes], partition_keys: list[str], build_index: bool
+) -> tuple[list[int], Optional[dict[str, list[int]]]]:
+    """チャンク内で検索条件に一致するレコードの位置を返す、並列検索時に子プロセスで実行する
+
+    build_indexの場合は検索条件の種類のインデックスに追加する値と位置もあわせて返す
+    """
+    engine = SearchEngine(DataDecoder(decoder_names))
+    return engine.scan_chunk(SearchQuery.parse(key), data, partition_keys, build_index)
+
+
+def process_context() -> multiprocessing.context.BaseContext:
+    """並列検索のプロセスの開始方式を返す、利用可能なものをPROCESS_START_METHODSの順に選択する"""
+    available = multiprocessing.get_all_start_methods()
+    method = next(method for method in PROCESS_START_METHODS if method in available)
+    return multiprocessing.get_context(method)
+
+
+class ShardIndex:
+    """1シャード分の転置インデックス(値からシャード内の位置の配列)
+
+    インデックスの種類ごとに、その種類を使用する検索が行われた時点で先頭から構築し、
+    以降はレコードが追加された範囲のみを差分で更新する
+    """
+
+    def __init__(self, shard: ShardRecords) -> None:
+        self.shard = shard
+        self.postings: dict[str, dict[str, array]] = {}
+        # インデックスの種類ごとのインデックス済みのレコード数
+        self.indexed: dict[str, int] = {}
+
+    def merge(self, kind: str, start: int, stop: int, postings: dict[str, list[int]]) -> bool:
+        """範囲のレコードの値と範囲内の位置をインデックスに追加する
+
+        インデックス済みの範囲の直後から連続しない範囲は追加せず、Falseを返す
+        """
+        if self.indexed.get(kind, 0) != start:
+            return False
+        kind_postings = self.postings.setdefault(kind, {})
+        for value, positions in postings.items():
+            value_positions = kind_postings.get(value)
+            if value_positions is None:
+                value_positions = kind_postings[value] = array(POSITION_TYPECODE)
+            value_positions.extend(start + position for position in positions)
+        self.indexed[kind] = stop
+        return True
+
+    def positions(self, kind: str, value: str, start: int, stop: int) -> list[int]:
+        """値を持つレコードのうち、範囲内のものの位置を昇順で返す"""
+        positions = self.postings.get(kind, {}).get(value)
+        if positions is None:
+            return []
+        return list(positions[bisect_left(positions, start) : bisect_left(positions, stop)])
+
+
+class SearchEngine:
+    """レコードストアのレコードに対する検索を行うクラス
+
+    検索条件の種類ごとに以下の方法で検索する
+      - 文字列、パーティションキー、JSONのフィールド: シャードごとの転置インデックスを使用する
+        デコーダーがutf-8の場合、文字列の照合はDataのバイト列に対して行う
+        インデックス未構築の範囲は走査と同時にインデックスに追加するため、
+        同じセッション内での2回目以降の検索は全件走査せずに回答する
+      - 正規表現、単語を含まない文字列: インデックスを使用せず、チャンクに分割して複数のプロセスで並列に走査する
+    """
+
+    def __init__(self, decoder: DataDecoder) -> None:
+        self.decoder = decoder
+        self.indexes: dict[str, ShardIndex] = {}
+        # 全シャードのトークン、部分一致するトークンを検索ごとに1度だけ求めるため、ソート済みの一覧を保持する
+        self.vocabulary: set[str] = set()
+        self._sorted_tokens: Optional[list[str]] = None
+        self._reversed_tokens: list[str] = []
+        self._joined_tokens = ""
+        self._token_offsets: list[int] = []
+
+    def search(
+        self, key: str, ranges: Iterable[tuple[ShardRecords, int, int]], workers: int = 1
+    ) -> Iterator[tuple[ShardRecords, int]]:
+        """指定された範囲のレコードから検索条件に一致するレコードを(シャード, 位置)の形式で返す
+
+        走査が必要な範囲は読み取り中のシャードも含めてworkers個のプロセスで並列に走査する(0の場合はCPU数)
+        途中で読み出しをやめた場合、未実行の並列検索は取り消される
+        """
+        query = SearchQuery.parse(key)
+        workers = workers or os.cpu_count() or 1
+        if self._needs_scan(query):
+            work = ((shard, start, stop, None) for shard, start, stop in ranges)
+            yield from self._scan_chunks(query, key, work, workers, None)
+            return
+        kind = self._index_kind(query)
+        yield from self._scan_chunks(
+            query, key, self._index_lookups(query, kind, ranges), workers, kind
+        )
+
+    def _index_lookups(
+        self, query: SearchQuery, kind: str, ranges: Iterable[tuple[ShardRecords, int, int]]
+    ) -> Iterator[tuple[ShardRecords, int, int, Optional[list[int]]]]:
+        """範囲のうちインデックス済みの部分はインデックスから検索した位置を、
+        未インデックスの部分は走査する範囲として(シャード, 開始位置, 終了位置, 検索済みの位置)の形式で返す
+        """
+        candidates: Optional[list[list[str]]] = None
+        for shard, start, stop in ranges:
+            index = self._shard_index(shard, start)
+            indexed = min(index.indexed.get(kind, 0), stop)
+            if start < indexed:
+                if kind == TOKEN_INDEX:
+                    if candidates is None:
+                        # 部分一致するトークンはシャードごとではなく検索ごとに1度だけ求める
+                        candidates = self._token_matches(query.value)
+                    found = self._text_positions(query, index, candidates, start, indexed)
+                else:
+                    found = index.positions(kind, query.value, start, indexed)
+                yield shard, start, indexed, found
+            if max(start, indexed) < stop:
+                yield shard, max(start, indexed), stop, None
+
+    def _scan_chunks(
+        self,
+        query: SearchQuery,
+        key: str,
+        work: Iterable[tuple[ShardRecords, int, int, Optional[list[int]]]],
+        workers: int,
+        kind: Optional[str],
+    ) -> Iterator[tuple[ShardRecords, int]]:
+        """走査する範囲をシャードごとにPARALLEL_CHUNK_SIZE件のチャンクにまとめ、複数のプロセスで走査する
+
+        読み取り中のシャードの範囲も読み取った順にチャンクにまとめて投入するため、
+        読み取りと並行して走査が進む、一致したレコードは同じシャード内では位置の順に返す
+        kindを指定した場合は走査と同時にインデックスを構築し、子プロセスが返した値をシャードのインデックスに追加する
+        子プロセスに渡すデータ量を抑えるため、同時に投入するチャンクはプロセス数の2倍までとする
+        1チャンクに満たない範囲、パーティションキーの検索はこのプロセスで走査する
+        """
+        parallel = workers > 1 and query.kind != "partition_key"
+        decoder_names = ",".join(self.decoder.names)
+        executor: Optional[ProcessPoolExecutor] = None
+        pending: deque[tuple[ShardRecords, int, int, Future]] = deque()
+        # シャードごとの投入前のチャンク(シャード, 開始位置, 終了位置)
+        open_chunks: dict[str, tuple[ShardRecords, int, int]] = {}
+
+        def run(shard: ShardRecords, start: int, stop: int) -> Iterator[tuple[ShardRecords, int]]:
+            nonlocal executor
+            data, partition_keys = shard.data[start:stop], shard.partition_keys[start:stop]
+            if not parallel or (executor is None and stop - start < PARALLEL_CHUNK_SIZE):
+                positions, postings = self.scan_chunk(query, data, partition_keys, kind is not None)
+                yield from self._chunk_results(kind, shard, start, stop, positions, postings)
+                return
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=workers, mp_context=process_context())
+            future = executor.submit(
+                scan_chunk, key, decoder_names, data, partition_keys, kind is not None
+            )
+            pending.append((shard, start, stop, future))
+            # 完了したチャンク、または投入数の上限に達した場合は先頭のチャンクの結果を返す
+            while pending and (pending[0][3].done() or len(pending) >= workers * 2):
+                yield from drain()
+
+        def drain() -> Iterator[tuple[ShardRecords, int]]:
+            shard, start, stop, future = pending.popleft()
+            positions, postings = future.result()
+            yield from self._chunk_results(kind, shard, start, stop, positions, postings)
+
+        try:
+            for shard, start, stop, found in work:
+                if found is not None:
+                    yield from ((shard, position) for position in found)
+                    continue
+                if not parallel:
+                    yield from run(shard, start, stop)
+                    continue
+                chunk = open_chunks.pop(shard.shard_id, None)
+                if chunk is not None and (chunk[0] is not shard or chunk[2] != start):
+                    # 連続しない範囲は別のチャンクとする
+                    yield from run(*chunk)
+                    chunk = None
+                chunk_start = start if chunk is None else chunk[1]
+                while stop - chunk_start >= PARALLEL_CHUNK_SIZE:
+                    yield from run(shard, chunk_start, chunk_start + PARALLEL_CHUNK_SIZE)
+                    chunk_start += PARALLEL_CHUNK_SIZE
+                if chunk_start < stop:
+                    open_chunks[shard.shard_id] = (shard, chunk_start, stop)
+            for chunk in open_chunks.values():
+                yield from run(*chunk)
+            while pending:
+                yield from drain()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def _chunk_results(
+        self,
+        kind: Optional[str],
+        shard: ShardRecords,
+        start: int,
+        stop: int,
+        positions: list[int],
+        postings: Optional[dict[str, list[int]]],
+    ) -> Iterator[tuple[ShardRecords, int]]:
+        """チャンクの走査結果をインデックスに追加し、一致したレコードを(シャード, 位置)の形式で返す"""
+        if kind is not None and postings is not None:
+            index = self.indexes.get(shard.shard_id)
+            if (
+                index is not None
+                and index.shard is shard
+                and index.merge(kind, start, stop, postings)
+            ):
+                if kind == TOKEN_INDEX:
+                    self._add_vocabulary(postings)
+        return ((shard, start + position) for position in positions)
+
+    def scan_chunk(
+        self, query: SearchQuery, data: list[bytes], partition_keys: list[str], build_index: bool
+    ) -> tuple[list[int], Optional[dict[str, list[int]]]]:
+        """チャンク内で検索条件に一致するレコードの位置を返す、Dataのデコードはレコードごとに1度だけ行う
+
+        build_indexの場合は検索条件の種類のインデックスに追加する値とチャンク内の位置もあわせて返す
+        """
+        if not build_index:
+            return [
+                position
+                for position, (payload, partition_key) in enumerate(zip(data, partition_keys))
+                if self.match(query, payload, partition_key)
+            ], None
+        found: list[int] = []
+        postings: dict[str, list[int]] = {}
+        for position, (payload, partition_key) in enumerate(zip(data, partition_keys)):
+            matched, values = self.index_record(query, payload, partition_key)
+            for value in values:
+                value_positions = postings.get(value)
+                if value_positions is None:
+                    value_positions = postings[value] = []
+                value_positions.append(position)
+            if matched:
+                found.append(position)
+        return found, postings
+
+    def match(self, query: SearchQuery, data: bytes, partition_key: str) -> bool:
+        """レコードが検索条件に一致するかどうかを判定する"""
+        if query.kind == "partition_key":
+            return partition_key == query.value
+        if query.kind == "text" and self.decoder.is_identity:
+            return query.value.encode("utf-8") in data
+
+        if query.kind == "field":
+            return query.value in self._field_values(self.decoder.decode_payloads(data), query.path)
+        text = self.decoder.decode(data)
+        if query.kind == "text":
+            return query.value in text
+        return query.pattern is not None and query.pattern.search(text) is not None
+
+    def index_record(
+        self, query: SearchQuery, data: bytes, partition_key: str
+    ) -> tuple[bool, set[str]]:
+        """レコードが検索条件に一致するかどうかと、検索条件の種類のインデックスに追加する値を返す"""
+        if query.kind == "partition_key":
+            return partition_key == query.value, {partition_key}
+        if query.kind == "field":
+            values = self._field_values(self.decoder.decode_payloads(data), query.path)
+            return query.value in values, values
+        if self.decoder.is_identity:
+            # トークンはASCII文字のみのため、UTF-8としてデコードせずに1バイト1文字として分割する
+            tokens = set(TOKEN_PATTERN.findall(data.decode("latin-1")))
+            return query.value.encode("utf-8") in data, tokens
+        text = self.decoder.decode(data)
+        return query.value in text, set(TOKEN_PATTERN.findall(text))
+
+    def _scan(self, query: SearchQuery, shard: ShardRecords, positions: Iterable[int]) -> list[int]:
+        """指定した位置のレコードのうち、検索条件に一致するものの位置を返す"""
+        data, partition_keys = shard.data, shard.partition_keys
+        return [
+            index for index in positions if self.match(query, data[index], partition_keys[index])
+        ]
+
+    @staticmethod
+    def _index_kind(query: SearchQuery) -> str:
+        """検索条件が使用するインデックスの種類を返す"""
+        if query.kind == "partition_key":
+            return PARTITION_KEY_INDEX
+        if query.kind == "field":
+            return f"{FIELD_INDEX_PREFIX}{query.path}"
+        return TOKEN_INDEX
+
+    def _shard_index(self, shard: ShardRecords, start: int) -> ShardIndex:
+        """シャードのインデックスを返す、シャードが読み直された場合は作り直す"""
+        index = self.indexes.get(shard.shard_id)
+        reloaded = index is not None and (
+            index.shard is not shard or (start == 0 and not shard.complete)
+        )
+        if index is None or reloaded:
+            index = self.indexes[shard.shard_id] = ShardIndex(shard)
+        return index
+
+    @staticmethod
+    def _needs_scan(query: SearchQuery) -> bool:
+        """インデックスで候補を絞り込めず、全件の走査が必要な検索条件かどうか"""
+        return query.kind == "regex" or (
+            query.kind == "text" and TOKEN_PATTERN.search(query.value) is None
+        )
+
+    def _add_vocabulary(self, tokens: Iterable[str]) -> None:
+        """トークンを全シャードのトークン一覧に追加する、新しいトークンがあればソート済みの一覧を破棄する"""
+        for token in tokens:
+            if token not in self.vocabulary:
+                self.vocabulary.add(token)
+                self._sorted_tokens = None
+
+    def _sorted_vocabulary(self) -> list[str]:
+        """ソート済みのトークン一覧を返す、前方一致、後方一致、部分一致の検索用の一覧もあわせて作成する"""
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self.vocabulary)
+            self._reversed_tokens = sorted(token[::-1] for token in self.vocabulary)
+            # 部分一致は改行で連結した文字列を検索し、一致した位置からトークンを求める
+            self._joined_tokens = "\n".join(self._sorted_tokens)
+            self._token_offsets = []
+            offset = 0
+            for token in self._sorted_tokens:
+                self._token_offsets.append(offset)
+                offset += len(token) + 1
+        return self._sorted_tokens
+
+    def _token_matches(self, key: str) -> list[list[str]]:
+        """検索文字列の単語ごとに、一致しうるトークンを全シャードのトークン一覧から求める
+
+        前後が単語以外の文字で区切られた単語はトークンと完全一致、先頭の単語はトークンの末尾、
+        末尾の単語はトークンの先頭、検索文字列全体が1つの単語の場合はトークンの一部と一致する必要がある
+        """
+        tokens = self._sorted_vocabulary()
+        matches = []
+        for match in TOKEN_PATTERN.finditer(key):
+            word = match.group()
+            left_open, right_open = match.start() == 0, match.end() == len(key)
+            if not left_open and not right_open:
+                matches.append([word] if word in self.vocabulary else [])
+            elif right_open and not left_open:
+                matches.append(self._prefixed(tokens, word))
+            elif left_open and not right_open:
+                matches.append(
+                    [token[::-1] for token in self._prefixed(self._reversed_tokens, word[::-1])]
+                )
+            else:
+                matches.append(self._containing(word))
+        return matches
+
+    @staticmethod
+    def _prefixed(tokens: list[str], prefix: str) -> list[str]:
+        """ソート済みのトークンのうち、接頭辞が一致するものを返す"""
+        start = bisect_left(tokens, prefix)
+        stop = start
+        while stop < len(tokens) and tokens[stop].startswith(prefix):
+            stop += 1
+        return tokens[start:stop]
+
+    def _containing(self, word: str) -> list[str]:
+        """単語を含むトークンを返す"""
+        assert self._sorted_tokens is not None
+        found: list[str] = []
+        position = self._joined_tokens.find(word)
+        while position >= 0:
+            token_number = bisect_right(self._token_offsets, position) - 1
+            found.append(self._sorted_tokens[token_number])
+            # 同じトークン内の2回目以降の一致は読み飛ばす
+            next_offset = (
+                self._token_offsets[token_number + 1]
+                if token_number + 1 < len(self._token_offsets)
+                else len(self._joined_tokens)
+            )
+            position = self._joined_tokens.find(word, next_offset)
+        return found
+
+    def _text_positions(
+        self,
+        query: SearchQuery,
+        index: ShardIndex,
+        candidates: list[list[str]],
+        start: int,
+        stop: int,
+    ) -> list[int]:
+        """トークンのインデックスで候補を絞り込み、実際の文字列で確認した位置を返す
+
+        候補のレコード数が最も少ない単語のみで絞り込み、候補が範囲の半分を超える場合は範囲を走査する
+        """
+        postings = index.postings.get(TOKEN_INDEX, {})
+        best: Optional[list[tuple[array, int, int]]] = None
+        best_count = 0
+        for tokens in candidates:
+            slices = []
+            count = 0
+            for token in tokens:
+                positions = postings.get(token)
+                if positions is None:
+                    continue
+                low, high = bisect_left(positions, start), bisect_left(positions, stop)
+                if low < high:
+                    slices.append((positions, low, high))
+                    count += high - low
+            if best is None or count < best_count:
+                best, best_count = slices, count
+            if not best_count:
+                return []
+        if best is None or best_count > (stop - start) // 2:
+            return self._scan(query, index.shard, range(start, stop))
+        found = {position for positions, low, high in best for position in positions[low:high]}
+        return self._scan(query, index.shard, sorted(found))
+
+    @staticmethod
+    def _field_values(payloads: list[str], path: str) -> set[str]:
+        """Data(KPLで集約されている場合は各ユーザーレコード)からフィールドの値を取り出す
+
+        ペイロード全体を1つのJSONとして解釈し(改行を含む整形済みのJSONも可)、
+        解釈できない場合は1行に1つのJSONを並べたペイロードとして行ごとに解釈する
+        """
+        values = set()
+        for payload in payloads:
+            try:
+                documents = [json.loads(payload)]
+            except ValueError:
+                documents = []
+                for line in payload.splitlines():
+                    try:
+                        documents.append(json.loads(line))
+                    except ValueError:
+                        continue
+            for document in documents:
+                if (value := field_value_key(extract_field(document, path))) is not None:
+                    values.add(value)
+        return values
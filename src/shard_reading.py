@@ -0,0 +1,89 @@
+import datetime
+from typing import Any, NamedTuple, Optional
+
+import src.const as const
+from src.time_util import to_epoch_millis
+
+# 連続して空のレスポンスが返却された場合にシャードの読み取りを打ち切る回数の既定値
+DEFAULT_MAX_EMPTY_POLLS = 50
+
+
+class EndBound(NamedTuple):
+    """シャード読み取りの終端、いずれかを超えたレコードは読み取らない"""
+
+    sequence_number: Optional[int] = None
+    timestamp: Optional[datetime.datetime] = None
+
+    def exceeded_by(self, record: dict) -> bool:
+        """GetRecordsのレコードが終端を超えているかどうかを判定する"""
+        if self.sequence_number is not None and int(record[const.SEQ_NUM]) > self.sequence_number:
+            return True
+        return self.timestamp is not None and record[const.TIMESTAMP] > self.timestamp
+
+
+def with_end_time(
+    end_bound: Optional[EndBound], end_time: Optional[datetime.datetime]
+) -> Optional[EndBound]:
+    """読み取り期間の終了日時を終端に反映する"""
+    if end_time is None:
+        return end_bound
+    if end_bound is None:
+        return EndBound(timestamp=end_time)
+    if end_bound.timestamp is not None and end_bound.timestamp < end_time:
+        return end_bound
+    return end_bound._replace(timestamp=end_time)
+
+
+def trim_to_bound(
+    records: list[dict[str, Any]], end_bound: Optional[EndBound]
+) -> tuple[list[dict[str, Any]], bool]:
+    """終端を超えたレコードを除外する、終端に到達したかどうかも返す"""
+    if end_bound is not None and records and end_bound.exceeded_by(records[-1]):
+        return [record for record in records if not end_bound.exceeded_by(record)], True
+    return records, False
+
+
+def is_caught_up(
+    response: dict,
+    has_records: bool,
+    reached_end: bool,
+    empty_polls: int,
+    max_empty_polls: int = DEFAULT_MAX_EMPTY_POLLS,
+) -> bool:
+    """GetRecordsのレスポンスからシャードの読み取りを終了するかどうかを判定する"""
+    millis_behind_latest = response.get("MillisBehindLatest")
+    return (
+        reached_end
+        or millis_behind_latest == 0
+        or (millis_behind_latest is None and not has_records)
+        or empty_polls >= max_empty_polls
+    )
+
+
+def starting_position(
+    last_sequence_number: Optional[int] = None,
+    start_time: Optional[datetime.datetime] = None,
+    latest: bool = False,
+) -> dict[str, Any]:
+    """シャードの読み取りの開始位置をSubscribeToShardのStartingPositionの形式で返す
+
+    latest、start_time、last_sequence_numberの順に優先し、いずれも指定がない場合はシャードの先頭とする
+    """
+    if latest:
+        return {"Type": "LATEST"}
+    if start_time is not None:
+        return {"Type": "AT_TIMESTAMP", "Timestamp": start_time}
+    if last_sequence_number is not None:
+        return {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": str(last_sequence_number)}
+    return {"Type": "TRIM_HORIZON"}
+
+
+def to_record(record: dict) -> dict[str, Any]:
+    """GetRecordsのレコードをシーケンス番号(int)、Data(bytes)、追加日時(エポックミリ秒)の
+    dictionaryに変換する"""
+    return {
+        const.SEQ_NUM: int(record[const.SEQ_NUM]),
+        const.DATA: record[const.DATA],
+        const.PARTITION_KEY: record[const.PARTITION_KEY],
+        const.TIMESTAMP: to_epoch_millis(record[const.TIMESTAMP]),
+    }
@@ -0,0 +1,107 @@
+from collections.abc import Iterable
+from typing import Any, NamedTuple, Optional
+
+import src.const as const
+
+
+class ShardInfo(NamedTuple):
+    """ListShardsで取得したシャードの情報"""
+
+    shard_id: str
+    parent_shard_id: Optional[str] = None
+    # マージで作成されたシャードのもう一方の親シャード
+    adjacent_parent_shard_id: Optional[str] = None
+    starting_hash_key: int = 0
+    ending_hash_key: int = 2**128 - 1
+    starting_sequence_number: int = 0
+    # クローズ済みのシャードのみ設定される
+    ending_sequence_number: Optional[int] = None
+
+    @classmethod
+    def from_response(cls, shard: dict[str, Any]) -> "ShardInfo":
+        """ListShardsのレスポンスのシャードから生成する"""
+        hash_key_range = shard["HashKeyRange"]
+        sequence_number_range = shard["SequenceNumberRange"]
+        ending_sequence_number = sequence_number_range.get("EndingSequenceNumber")
+        return cls(
+            shard_id=shard[const.SHARD_ID],
+            parent_shard_id=shard.get("ParentShardId"),
+            adjacent_parent_shard_id=shard.get("AdjacentParentShardId"),
+            starting_hash_key=int(hash_key_range["StartingHashKey"]),
+            ending_hash_key=int(hash_key_range["EndingHashKey"]),
+            starting_sequence_number=int(sequence_number_range["StartingSequenceNumber"]),
+            ending_sequence_number=(
+                int(ending_sequence_number) if ending_sequence_number else None
+            ),
+        )
+
+    @property
+    def is_open(self) -> bool:
+        return self.ending_sequence_number is None
+
+    @property
+    def parents(self) -> tuple[str, ...]:
+        """親シャードのID、分割で作成されたシャードは1つ、マージで作成されたシャードは2つ"""
+        return tuple(
+            shard_id
+            for shard_id in (self.parent_shard_id, self.adjacent_parent_shard_id)
+            if shard_id
+        )
+
+    @property
+    def hash_key_share(self) -> float:
+        """ハッシュキー空間全体に対するシャードのハッシュキー範囲の割合"""
+        return (self.ending_hash_key - self.starting_hash_key + 1) / 2**128
+
+
+class ShardTopology:
+    """DataStreamのシャードの親子関係(リシャーディングの履歴)を表すクラス
+
+    親シャードは保持期間を過ぎるとListShardsに含まれなくなるため、
+    一覧に存在しない親シャードは無視する
+    """
+
+    def __init__(self, shards: Iterable[ShardInfo]) -> None:
+        self.shards = {shard.shard_id: shard for shard in shards}
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def __getitem__(self, shard_id: str) -> ShardInfo:
+        return self.shards[shard_id]
+
+    def parents(self, shard_id: str) -> tuple[str, ...]:
+        """一覧に存在する親シャードのIDを返す"""
+        if shard_id not in self.shards:
+            return ()
+        return tuple(parent for parent in self.shards[shard_id].parents if parent in self.shards)
+
+    def children(self, shard_id: str) -> tuple[str, ...]:
+        """子シャードのIDを返す"""
+        return tuple(shard.shard_id for shard in self.shards.values() if shard_id in shard.parents)
+
+    def open_shard_ids(self) -> tuple[str, ...]:
+        return tuple(shard.shard_id for shard in self.shards.values() if shard.is_open)
+
+    def ordered(self, open_only: bool = False) -> tuple[str, ...]:
+        """親シャードが子シャードより前となる順序でシャードIDを返す
+
+        親子関係のないシャード間はListShardsの順序を維持する
+        open_onlyの場合はクローズ済みのシャードを除外する
+        """
+        ordered: list[str] = []
+        visited: set[str] = set()
+
+        def visit(shard_id: str) -> None:
+            if shard_id in visited:
+                return
+            visited.add(shard_id)
+            for parent in self.parents(shard_id):
+                visit(parent)
+            ordered.append(shard_id)
+
+        for shard_id in self.shards:
+            visit(shard_id)
+        if open_only:
+            return tuple(shard_id for shard_id in ordered if self.shards[shard_id].is_open)
+        return tuple(ordered)
@@ -0,0 +1,339 @@
+import abc
+import base64
+import heapq
+import json
+import mmap
+import os
+import re
+from array import array
+from collections import deque
+from collections.abc import Iterator
+from operator import itemgetter
+from typing import Any, Optional
+
+import src.const as const
+import src.msg as msg
+from src.kinesis_client import KinesisClient
+from src.record_cache import CACHE_EXTENSION, DEFAULT_BATCH_SIZE, RecordCache
+from src.shard_reading import EndBound
+from src.shard_topology import ShardInfo, ShardTopology
+from src.time_util import parse_timestamp, to_epoch_millis
+
+# スナップショットとして読み込むダンプファイルの拡張子
+SNAPSHOT_EXTENSIONS = (".jsonl", ".parquet")
+# キャッシュのSQLiteファイルをメモリマップで読み込むサイズの上限(バイト)
+CACHE_MMAP_SIZE = 1 << 30
+# ダンプファイル名からシャードIDを取得するパターン、ShardId列がないファイルに使用する
+_SHARD_ID_PATTERN = re.compile(r"shardId-\d+")
+# JSONLの行の先頭のShardIdフィールド、行全体をJSONとして解釈せずにシャードIDを取得する
+# (文字列中の引用符はエスケープされるため、Dataの値の中には一致しない)
+_SHARD_ID_FIELD_PATTERN = re.compile(rb'^\{"ShardId":\s*"([^"\\]*)"')
+
+
+class SnapshotFile(abc.ABC):
+    """ダンプファイル1つ分のレコードをシャードごとに返すクラスの基底クラス"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # ShardId列がない場合はファイル名のシャードID、なければファイル名をシャードIDとする
+        match = _SHARD_ID_PATTERN.search(os.path.basename(path))
+        self.default_shard_id = match.group(0) if match else os.path.basename(path)
+
+    @abc.abstractmethod
+    def shard_ids(self) -> tuple[str, ...]:
+        """ファイルに含まれるシャードのIDを返す"""
+
+    @abc.abstractmethod
+    def iter_batches(self, shard_id: str) -> Iterator[list[dict[str, Any]]]:
+        """シャードのレコードをファイル内の順にバッチ単位で返す"""
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def _to_record(row: dict[str, Any]) -> dict[str, Any]:
+        """ダンプファイルの1行をKinesisClientと同じ形式のレコードに変換する
+
+        Dataは元のバイト列(RawData列)を使用し、RawData列がない古いダンプファイルの場合のみ
+        デコード済みの文字列をバイト列に戻す
+        追加日時はUTCオフセット付きの文字列、またはタイムスタンプ型として読み込み、
+        UTCオフセットがない古いダンプファイルの場合のみローカルタイムとして扱う
+        """
+        raw_data = row.get(const.RAW_DATA)
+        if isinstance(raw_data, str):
+            data = base64.b64decode(raw_data)
+        elif raw_data is not None:
+            data = raw_data
+        else:
+            data = row[const.DATA].encode("utf-8")
+        timestamp = row[const.TIMESTAMP]
+        return {
+            const.SEQ_NUM: int(row[const.SEQ_NUM]),
+            const.DATA: data,
+            const.PARTITION_KEY: row[const.PARTITION_KEY],
+            const.TIMESTAMP: (
+                parse_timestamp(timestamp)
+                if isinstance(timestamp, str)
+                else to_epoch_millis(timestamp)
+            ),
+        }
+
+
+class JsonlSnapshotFile(SnapshotFile):
+    """dump_records、tailで出力したJSONLファイルをメモリマップで読み込む
+
+    開く際に1度だけ走査してシャードごとの行の開始位置を記録し、
+    以降はシャードの行のみを必要な分だけ読み込むため、ファイル全体をメモリに展開しない
+    走査時は行の先頭のShardIdフィールドのみを読み取り、行全体はJSONとして解釈しない
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+        self.file = open(path, "rb")
+        self.map: Optional[mmap.mmap] = None
+        self.offsets: dict[str, array] = {}
+        if os.path.getsize(path) == 0:
+            return
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        position = 0
+        while line := self.map.readline():
+            if line.strip():
+                self.offsets.setdefault(self._shard_id(line), array("q")).append(position)
+            position = self.map.tell()
+
+    def _shard_id(self, line: bytes) -> str:
+        """行のShardIdフィールドの値を返す、ShardIdフィールドがない場合はファイルのシャードID"""
+        if match := _SHARD_ID_FIELD_PATTERN.match(line):
+            return match.group(1).decode("utf-8")
+        if b'"ShardId"' not in line:
+            return self.default_shard_id
+        # ShardIdが先頭にない形式の行のみJSONとして解釈する
+        return json.loads(line).get(const.SHARD_ID) or self.default_shard_id
+
+    def shard_ids(self) -> tuple[str, ...]:
+        return tuple(self.offsets)
+
+    def iter_batches(self, shard_id: str) -> Iterator[list[dict[str, Any]]]:
+        if self.map is None:
+            return
+        batch: list[dict[str, Any]] = []
+        for offset in self.offsets.get(shard_id, ()):
+            end = self.map.find(b"\n", offset)
+            row = json.loads(self.map[offset : end if end >= 0 else len(self.map)])
+            batch.append(self._to_record(row))
+            if len(batch) >= DEFAULT_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class ParquetSnapshotFile(SnapshotFile):
+    """dump_recordsで出力したParquetファイルをメモリマップで読み込む、pyarrowが必要
+
+    開く際にShardId列のみをRowGroup単位で読み込み、シャードを含むRowGroupを記録する
+    シャードのレコードはそのRowGroupのみを必要な列だけバッチ単位で読み込むため、
+    ファイル全体をメモリに展開しない
+    """
+
+    def __init__(self, path: str) -> None:
+        try:
+            import pyarrow.compute as pc  # type: ignore
+            import pyarrow.parquet as pq  # type: ignore
+        except ImportError:
+            raise ValueError(msg.PARQUET_UNAVAILABLE)
+        super().__init__(path)
+        self.pc = pc
+        self.parquet = pq.ParquetFile(path, memory_map=True)
+        names = self.parquet.schema_arrow.names
+        self.has_shard_id = const.SHARD_ID in names
+        self.columns = [const.SEQ_NUM, const.PARTITION_KEY, const.TIMESTAMP]
+        self.columns.append(const.RAW_DATA if const.RAW_DATA in names else const.DATA)
+        # シャードごとのシャードのレコードを含むRowGroupの番号
+        self.row_groups: dict[str, list[int]] = {}
+        for row_group in range(self.parquet.num_row_groups):
+            if not self.has_shard_id:
+                self.row_groups.setdefault(self.default_shard_id, []).append(row_group)
+                continue
+            shard_ids = self.parquet.read_row_group(row_group, columns=[const.SHARD_ID])
+            for shard_id in pc.unique(shard_ids.column(0)).to_pylist():
+                self.row_groups.setdefault(shard_id, []).append(row_group)
+
+    def shard_ids(self) -> tuple[str, ...]:
+        return tuple(self.row_groups) if self.has_shard_id else (self.default_shard_id,)
+
+    def iter_batches(self, shard_id: str) -> Iterator[list[dict[str, Any]]]:
+        row_groups = self.row_groups.get(shard_id)
+        if not row_groups:
+            return
+        columns = [*self.columns, const.SHARD_ID] if self.has_shard_id else self.columns
+        for record_batch in self.parquet.iter_batches(
+            batch_size=DEFAULT_BATCH_SIZE, row_groups=row_groups, columns=columns
+        ):
+            if self.has_shard_id:
+                shard_column = record_batch.column(columns.index(const.SHARD_ID))
+                record_batch = record_batch.filter(self.pc.equal(shard_column, shard_id))
+            if record_batch.num_rows:
+                yield [self._to_record(row) for row in record_batch.to_pylist()]
+
+    def close(self) -> None:
+        self.parquet.close()
+
+
+class SnapshotSource(KinesisClient):
+    """取得済みのスナップショットからKinesisClientと同じインターフェースでレコードを返す読み取り元
+
+    スナップショットには以下を指定できる
+      - dump_records、tailで出力したJSONL/Parquetファイル、またはそれらを含むディレクトリ
+      - --cache_dirのディレクトリ、またはその中のSQLiteファイル
+    DataStreamへのAPI呼び出しは行わず、ストリームの読み取りスループットを消費しない
+    ストリームへのアクセスが必要な操作(tail、summaryのmetadata/sampleなど)はValueErrorとする
+    ダンプファイルのDataは元のバイト列(RawData列)として読み込むため、出力時と同じデコーダーで検索できる
+    """
+
+    def __init__(self, path: str, stream_name: str = "") -> None:
+        self.source_path = path
+        self.record_cache: Optional[RecordCache] = None
+        self.files: list[SnapshotFile] = []
+        region = ""
+        cache_path = self._find_cache(path, stream_name)
+        if cache_path is not None:
+            filename = os.path.basename(cache_path)[: -len(CACHE_EXTENSION)]
+            region, stream_name = filename.split("_", 1)
+            self.record_cache = RecordCache(
+                os.path.dirname(cache_path), region, stream_name, mmap_size=CACHE_MMAP_SIZE
+            )
+        else:
+            self.files = [self._open_file(file) for file in self._find_files(path, stream_name)]
+        super().__init__(region, stream_name or os.path.basename(os.path.normpath(path)))
+        self.shard_files: dict[str, list[SnapshotFile]] = {}
+        for file in self.files:
+            for shard_id in file.shard_ids():
+                self.shard_files.setdefault(shard_id, []).append(file)
+
+    @property
+    def kinesis_client(self) -> Any:
+        raise ValueError(msg.OFFLINE_UNSUPPORTED)
+
+    @staticmethod
+    def _find_cache(path: str, stream_name: str) -> Optional[str]:
+        """キャッシュのSQLiteファイルを探す、キャッシュでない場合はNoneを返す"""
+        if os.path.isfile(path):
+            return path if path.endswith(CACHE_EXTENSION) else None
+        if not os.path.isdir(path):
+            raise ValueError(f"{msg.SOURCE_NOT_FOUND}: '{path}'")
+        candidates = sorted(
+            name
+            for name in os.listdir(path)
+            if name.endswith(CACHE_EXTENSION)
+            and (not stream_name or name.endswith(f"_{stream_name}{CACHE_EXTENSION}"))
+        )
+        if not candidates:
+            return None
+        if len(candidates) > 1:
+            raise ValueError(msg.SOURCE_AMBIGUOUS)
+        return os.path.join(path, candidates[0])
+
+    @staticmethod
+    def _find_files(path: str, stream_name: str) -> list[str]:
+        """ダンプファイルを名前順に返す、ストリーム名を指定した場合はファイル名に含むもののみ"""
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = [
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith(SNAPSHOT_EXTENSIONS)
+                and (not stream_name or f"_{stream_name}_" in name)
+            ]
+        if not files or not all(file.endswith(SNAPSHOT_EXTENSIONS) for file in files):
+            raise ValueError(f"{msg.SOURCE_NOT_FOUND}: '{path}'")
+        return files
+
+    @staticmethod
+    def _open_file(path: str) -> SnapshotFile:
+        if path.endswith(".parquet"):
+            return ParquetSnapshotFile(path)
+        return JsonlSnapshotFile(path)
+
+    def list_shards(self) -> tuple[str, ...]:
+        if self.record_cache is not None:
+            return self.record_cache.shard_ids()
+        return tuple(sorted(self.shard_files))
+
+    def topology(self) -> ShardTopology:
+        """スナップショットには親子関係の情報がないため、親子関係のないシャードとして返す"""
+        if self.shard_topology is None:
+            self.shard_topology = ShardTopology(
+                ShardInfo(shard_id) for shard_id in self.list_shards()
+            )
+        return self.shard_topology
+
+    def iter_records(
+        self, shard_ids: tuple[str, ...], after: Optional[dict[str, int]] = None
+    ) -> Iterator[tuple[str, list[dict[str, Any]]]]:
+        """シャードごとに順にレコードを返す、ディスクから読み込むためスレッドでの並列化は行わない"""
+        for shard_id in shard_ids:
+            for batch in self.iter_shard_records(
+                shard_id, after_sequence_number=(after or {}).get(shard_id)
+            ):
+                yield shard_id, batch
+
+    def iter_shard_records(
+        self,
+        shard_id: str,
+        end_bound: Optional[EndBound] = None,
+        after_sequence_number: Optional[int] = None,
+    ) -> Iterator[list[dict[str, Any]]]:
+        """シャードのレコードをシーケンス番号順に返す
+
+        同じシャードを含む複数のダンプファイルは、ファイルごとのシーケンス番号順のレコードを
+        シーケンス番号で併合する(k-way merge)、期間が重複するファイルで同じシーケンス番号の
+        レコードが複数ある場合は1件のみを返す
+        """
+        if self.record_cache is not None:
+            yield from self.record_cache.iter_batches(shard_id, after=after_sequence_number)
+            return
+        files = self.shard_files.get(shard_id, ())
+        records = heapq.merge(
+            *(
+                (record for batch in file.iter_batches(shard_id) for record in batch)
+                for file in files
+            ),
+            key=itemgetter(const.SEQ_NUM),
+        )
+        last_sequence_number = after_sequence_number
+        batch: list[dict[str, Any]] = []
+        for record in records:
+            if last_sequence_number is not None and record[const.SEQ_NUM] <= last_sequence_number:
+                continue
+            last_sequence_number = record[const.SEQ_NUM]
+            batch.append(record)
+            if len(batch) >= DEFAULT_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def get_recent_records(self, shard_id: str, count: int) -> list[dict[str, Any]]:
+        """シャードのレコードをシーケンス番号の降順で最大count件返す"""
+        if self.record_cache is not None:
+            return self.record_cache.recent_records(shard_id, count)
+        recent: deque[dict[str, Any]] = deque(maxlen=count)
+        for batch in self.iter_shard_records(shard_id):
+            recent.extend(batch)
+        return list(reversed(recent))
+
+    def follow_records(self, *args: Any, **kwargs: Any) -> Iterator:
+        raise ValueError(msg.OFFLINE_UNSUPPORTED)
+
+    def close(self) -> None:
+        for file in self.files:
+            file.close()
+        if self.record_cache is not None:
+            self.record_cache.close()
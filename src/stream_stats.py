@@ -0,0 +1,225 @@
+import hashlib
+import math
+from array import array
+from collections.abc import Iterable
+from typing import Any, Optional
+
+import src.const as const
+
+# Dataのサイズのヒストグラムのバケットの幅(相対誤差が約1%となる)
+SIZE_HISTOGRAM_GAMMA = 1.02
+# レコード数の推移を表すヒストグラムのバケット数の上限、超えた場合はバケットの幅を倍にする
+DEFAULT_MAX_TIME_BUCKETS = 60
+# Count-Min Sketchの幅と深さ
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+# 上位のパーティションキーを探すために保持する候補数の下限
+MIN_HOT_KEY_CANDIDATES = 100
+
+
+class SizeHistogram:
+    """Dataのサイズを対数スケールのバケットで数え、パーセンタイルを一定のメモリで概算するクラス
+
+    バケットの数はサイズの桁数に比例するため、レコード数によらずメモリ使用量は一定となる
+    """
+
+    def __init__(self) -> None:
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.min: Optional[int] = None
+        self.max: Optional[int] = None
+
+    def add(self, size: int) -> None:
+        index = math.ceil(math.log(size, SIZE_HISTOGRAM_GAMMA)) if size > 0 else -1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.min = size if self.min is None else min(self.min, size)
+        self.max = size if self.max is None else max(self.max, size)
+
+    def merge(self, other: "SizeHistogram") -> None:
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, ratio: float) -> Optional[int]:
+        """指定した割合(0-1)のパーセンタイルを返す、レコードがない場合はNone"""
+        if not self.count or self.min is None or self.max is None:
+            return None
+        rank = max(1, math.ceil(self.count * ratio))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                value = 0 if index < 0 else round(SIZE_HISTOGRAM_GAMMA**index)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+class ThroughputHistogram:
+    """レコードの追加日時をバケットごとに数え、時間ごとのレコード数の推移を表すクラス
+
+    最初と最後のバケットの間隔がmax_bucketsを超えた場合はバケットの幅を倍にして統合するため、
+    保持するバケット数はmax_buckets以下となる
+    """
+
+    def __init__(self, max_buckets: int = DEFAULT_MAX_TIME_BUCKETS) -> None:
+        self.max_buckets = max_buckets
+        # バケットの幅(ミリ秒)
+        self.width = 1000
+        self.buckets: dict[int, int] = {}
+        # 最初と最後のバケットのキー
+        self.first_key = 0
+        self.last_key = -1
+
+    def add(self, timestamp: int) -> None:
+        key = timestamp // self.width
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        if self.last_key < self.first_key:
+            self.first_key = self.last_key = key
+        else:
+            self.first_key = min(self.first_key, key)
+            self.last_key = max(self.last_key, key)
+        while self.last_key - self.first_key >= self.max_buckets:
+            self._coarsen()
+
+    def _coarsen(self) -> None:
+        self.width *= 2
+        buckets: dict[int, int] = {}
+        for key, count in self.buckets.items():
+            buckets[key // 2] = buckets.get(key // 2, 0) + count
+        self.buckets = buckets
+        self.first_key //= 2
+        self.last_key //= 2
+
+    def rates(self) -> list[tuple[int, float]]:
+        """(バケットの開始日時(エポックミリ秒), 秒あたりのレコード数)を古い順に返す
+
+        レコードのない期間も0として返す
+        """
+        if not self.buckets:
+            return []
+        return [
+            (key * self.width, self.buckets.get(key, 0) * 1000 / self.width)
+            for key in range(self.first_key, self.last_key + 1)
+        ]
+
+
+class CountMinSketch:
+    """要素ごとの出現回数を一定のメモリで概算するCount-Min Sketch、概算値は実際の値以上となる"""
+
+    def __init__(self, width: int = SKETCH_WIDTH, depth: int = SKETCH_DEPTH) -> None:
+        self.width = width
+        self.tables = [array("q", bytes(8 * width)) for _ in range(depth)]
+
+    def add(self, key: str) -> int:
+        """要素の出現回数を1つ増やし、増やした後の概算値を返す
+
+        各行の位置は1つの64bitハッシュを2つに分けたダブルハッシュで求める
+        """
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        first, second = int.from_bytes(digest[:4], "little"), int.from_bytes(digest[4:], "little")
+        estimate = None
+        for row, table in enumerate(self.tables):
+            index = (first + row * second) % self.width
+            table[index] += 1
+            estimate = table[index] if estimate is None else min(estimate, table[index])
+        return estimate or 0
+
+
+class HotKeys:
+    """出現回数の多いパーティションキーを一定のメモリで探すクラス
+
+    出現回数はCount-Min Sketchで概算し、上位の候補のみを保持する
+    候補数が上限の2倍に達した時点で概算値の大きい順に上限まで間引く
+    """
+
+    def __init__(self, top_n: int) -> None:
+        self.top_n = top_n
+        self.capacity = max(top_n * 10, MIN_HOT_KEY_CANDIDATES)
+        self.sketch = CountMinSketch()
+        self.candidates: dict[str, int] = {}
+        # 候補に追加するために必要な概算値の下限
+        self.threshold = 0
+
+    def add(self, key: str) -> None:
+        estimate = self.sketch.add(key)
+        if key in self.candidates or estimate > self.threshold:
+            self.candidates[key] = estimate
+            if len(self.candidates) >= self.capacity * 2:
+                self._prune()
+
+    def _prune(self) -> None:
+        kept = sorted(self.candidates.items(), key=lambda item: item[1], reverse=True)
+        kept = kept[: self.capacity]
+        self.candidates = dict(kept)
+        self.threshold = kept[-1][1]
+
+    def top(self) -> list[tuple[str, int]]:
+        """(パーティションキー, 出現回数の概算値)を概算値の大きい順に最大top_n件返す"""
+        return sorted(self.candidates.items(), key=lambda item: item[1], reverse=True)[: self.top_n]
+
+
+class ShardStats:
+    """シャードのレコード数、Dataの合計サイズ、サイズの分布、追加日時の範囲を集計するクラス"""
+
+    def __init__(self, shard_id: str) -> None:
+        self.shard_id = shard_id
+        self.total_bytes = 0
+        self.sizes = SizeHistogram()
+        self.first_timestamp: Optional[int] = None
+        self.last_timestamp: Optional[int] = None
+
+    @property
+    def count(self) -> int:
+        return self.sizes.count
+
+    def add(self, size: int, timestamp: int) -> None:
+        self.total_bytes += size
+        self.sizes.add(size)
+        self.add_timestamp_bound(timestamp)
+
+    def merge(self, other: "ShardStats") -> None:
+        self.total_bytes += other.total_bytes
+        self.sizes.merge(other.sizes)
+        for timestamp in (other.first_timestamp, other.last_timestamp):
+            if timestamp is not None:
+                self.add_timestamp_bound(timestamp)
+
+    def add_timestamp_bound(self, timestamp: int) -> None:
+        if self.first_timestamp is None or timestamp < self.first_timestamp:
+            self.first_timestamp = timestamp
+        if self.last_timestamp is None or timestamp > self.last_timestamp:
+            self.last_timestamp = timestamp
+
+
+class StreamStats:
+    """レコードのバッチを1度だけ走査し、シャードごと、ストリーム全体の統計を集計するクラス
+
+    レコード自体は保持しないため、メモリに乗り切らないストリームでも集計できる
+    """
+
+    def __init__(self, shard_ids: Iterable[str], top_n: int = 10) -> None:
+        self.shards = {shard_id: ShardStats(shard_id) for shard_id in shard_ids}
+        self.throughput = ThroughputHistogram()
+        self.hot_keys = HotKeys(top_n) if top_n > 0 else None
+
+    def add_batch(self, shard_id: str, batch: Iterable[dict[str, Any]]) -> None:
+        """シャードから読み取ったレコードのバッチを集計に加える"""
+        shard = self.shards[shard_id]
+        for record in batch:
+            timestamp = record[const.TIMESTAMP]
+            shard.add(len(record[const.DATA]), timestamp)
+            self.throughput.add(timestamp)
+            if self.hot_keys is not None:
+                self.hot_keys.add(record[const.PARTITION_KEY])
+
+    def total(self) -> ShardStats:
+        """全シャードの統計をまとめた結果を返す"""
+        total = ShardStats("total")
+        for shard in self.shards.values():
+            total.merge(shard)
+        return total
@@ -0,0 +1,58 @@
+import datetime
+import re
+from typing import Optional
+
+import src.msg as msg
+
+# 出力時の日時の書式
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+# 相対時刻の単位と秒数の対応
+_UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_RELATIVE_PATTERN = re.compile(r"^-(\d+)([smhd])$")
+
+
+def parse_time(value: str) -> Optional[datetime.datetime]:
+    """CLIで指定された日時文字列をタイムゾーン付きのdatetimeに変換する
+
+    以下の形式に対応する、空文字の場合はNoneを返す
+      - ISO 8601形式: '2024-10-24T14:23:43', '2024-10-24 14:23:43+09:00'
+        タイムゾーンの指定がない場合はローカルタイムとして扱う
+      - 現在時刻からの相対時刻: '-10m', '-2h', '-1d'
+    """
+    if not value:
+        return None
+    value = str(value).strip()
+
+    if match := _RELATIVE_PATTERN.match(value):
+        seconds = int(match.group(1)) * _UNIT_SECONDS[match.group(2)]
+        return datetime.datetime.now().astimezone() - datetime.timedelta(seconds=seconds)
+
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{msg.INVALID_TIME}: '{value}'")
+    return parsed if parsed.tzinfo else parsed.astimezone()
+
+
+def to_epoch_millis(value: datetime.datetime) -> int:
+    """datetimeをエポックミリ秒に変換する"""
+    return int(value.timestamp() * 1000)
+
+
+def format_timestamp(epoch_millis: int) -> str:
+    """エポックミリ秒を出力用のローカルタイムの文字列に変換する"""
+    return datetime.datetime.fromtimestamp(epoch_millis / 1000).strftime(TIMESTAMP_FORMAT)
+
+
+def format_iso_timestamp(epoch_millis: int) -> str:
+    """エポックミリ秒をUTCオフセット付きのISO 8601形式の文字列に変換する、ファイル出力に使用する"""
+    utc = datetime.datetime.fromtimestamp(epoch_millis / 1000, tz=datetime.timezone.utc)
+    return utc.astimezone().isoformat(timespec="milliseconds")
+
+
+def parse_timestamp(value: str) -> int:
+    """format_iso_timestamp、format_timestampで出力した文字列をエポックミリ秒に戻す
+
+    UTCオフセットがない文字列(format_timestampの出力)はローカルタイムとして扱う
+    """
+    return round(datetime.datetime.fromisoformat(value).astimezone().timestamp() * 1000)
@@ -0,0 +1,228 @@
+"""motoの擬似DataStreamに対して主要な処理の実行時間とメモリ使用量を計測するベンチマーク
+
+使い方:
+  python -m test.bench_kdv --shards 4 --records 20000 --payload_size 512
+  python -m test.bench_kdv --baseline dist/kdv_bench_20241024_140000.json
+
+結果はdump_dir(既定はdist)にJSONファイルとして出力し、baselineを指定した場合は前回の結果との差分を表示する
+AWSのレート制限ではなくツール自体の処理時間を計測するため、シャードごとの呼び出し回数の上限は緩和する
+"""
+
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+from contextlib import redirect_stdout
+from typing import Any, Optional
+
+import boto3
+from moto import mock_aws
+
+from src.kinesis_client import KinesisClient
+from src.kinesis_data_viewer import KinesisDataViewerCLI
+from src.read_scheduler import ShardReadScheduler
+
+REGION = os.getenv("KDV_REGION") or "ap-northeast-1"
+STREAM_NAME = "kdv-bench-stream"
+# ベンチマークで使用するシャードごとのGetRecords呼び出し回数の上限(回/秒)
+BENCH_READS_PER_SEC = 10000.0
+# 検索対象とするレコードの割合と、検索に使用する文字列
+NEEDLE_RATIO = 100
+NEEDLE = "kdv-bench-needle"
+# PutRecordsで一度に追加できるレコード数の上限
+PUT_RECORDS_BATCH = 500
+
+
+def populate_stream(client: Any, shards: int, records: int, payload_size: int) -> list[str]:
+    """シャード数を指定してDataStreamを作成し、指定サイズのDataのレコードを追加する
+
+    NEEDLE_RATIO件に1件はDataにNEEDLEを含める
+    """
+    client.create_stream(StreamName=STREAM_NAME, ShardCount=shards)
+    filler = "x" * max(payload_size - len(NEEDLE) - 32, 0)
+    for start in range(0, records, PUT_RECORDS_BATCH):
+        batch = []
+        for n in range(start, min(start + PUT_RECORDS_BATCH, records)):
+            marker = NEEDLE if n % NEEDLE_RATIO == 0 else ""
+            data = json.dumps({"id": n, "marker": marker, "body": filler})
+            batch.append({"Data": data.encode(), "PartitionKey": f"key-{n % 1000}"})
+        client.put_records(StreamName=STREAM_NAME, Records=batch)
+    return [shard["ShardId"] for shard in client.list_shards(StreamName=STREAM_NAME)["Shards"]]
+
+
+def create_viewer(dump_dir: str) -> KinesisDataViewerCLI:
+    """レート制限を緩和したクライアントを持つビューアーを生成する、読み取り済みのレコードは共有しない"""
+    viewer = KinesisDataViewerCLI()
+    viewer.target_stream_name = STREAM_NAME
+    viewer.kds_client = KinesisClient(
+        REGION, STREAM_NAME, ShardReadScheduler(reads_per_sec=BENCH_READS_PER_SEC)
+    )
+    viewer.dump_dir = dump_dir
+    return viewer
+
+
+def measure(run: Callable[[], Any], repeat: int) -> dict[str, float]:
+    """処理をrepeat回実行した実行時間(秒)と、トレース下で1回実行したメモリ使用量のピーク(バイト)を返す
+
+    tracemallocは実行時間に影響するため、メモリ使用量は実行時間とは別に計測する
+    """
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "min_sec": min(durations),
+        "median_sec": statistics.median(durations),
+        "peak_memory_bytes": peak,
+    }
+
+
+def run_benchmarks(
+    shards: int = 4, records: int = 10000, payload_size: int = 256, repeat: int = 3
+) -> dict[str, Any]:
+    """擬似DataStreamを作成し、各処理を計測した結果を返す
+
+    各処理は読み取り済みのレコードを持たない新しいビューアーで実行するため、ストリームの読み取りを含む
+    """
+    results: dict[str, dict[str, float]] = {}
+    with mock_aws(), tempfile.TemporaryDirectory() as dump_dir:
+        client = boto3.client("kinesis", region_name=REGION)
+        shard_ids = populate_stream(client, shards, records, payload_size)
+
+        def get_records() -> None:
+            create_viewer(dump_dir).kds_client.get_records(tuple(shard_ids))
+
+        def summary() -> None:
+            create_viewer(dump_dir).summary()
+
+        def search_record() -> None:
+            create_viewer(dump_dir)._search_record(NEEDLE)
+
+        def dump_records_csv() -> None:
+            create_viewer(dump_dir)._dump_records("all", "csv")
+
+        def show_recent_records() -> None:
+            create_viewer(dump_dir)._show_recent_records(shard_ids[0])
+
+        operations: dict[str, Callable[[], None]] = {
+            "get_records": get_records,
+            "summary": summary,
+            "search_record": search_record,
+            "dump_records_csv": dump_records_csv,
+            "show_recent_records": show_recent_records,
+        }
+        # ターミナルへの出力は計測結果に含めない
+        with redirect_stdout(io.StringIO()):
+            for name, run in operations.items():
+                result = measure(run, repeat)
+                result["records_per_sec"] = records / result["median_sec"]
+                results[name] = result
+
+    return {
+        "meta": {
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "shards": shards,
+            "records": records,
+            "payload_size": payload_size,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def format_report(report: dict[str, Any], baseline: Optional[dict[str, Any]] = None) -> str:
+    """計測結果を表形式の文字列に変換する、baselineを指定した場合は実行時間とメモリの増減率を付与する"""
+    meta = report["meta"]
+    lines = [
+        f"commit={meta['commit'] or '-'} python={meta['python']} shards={meta['shards']} "
+        f"records={meta['records']} payload_size={meta['payload_size']}",
+        f"{'operation':<22}{'median(s)':>12}{'records/s':>14}{'peak(MiB)':>12}",
+    ]
+    for name, result in report["results"].items():
+        line = (
+            f"{name:<22}{result['median_sec']:>12.3f}{result['records_per_sec']:>14.0f}"
+            f"{result['peak_memory_bytes'] / 2**20:>12.1f}"
+        )
+        previous = (baseline or {}).get("results", {}).get(name)
+        if previous:
+            line += (
+                f"  time {_change(result['median_sec'], previous['median_sec'])}"
+                f"  memory {_change(result['peak_memory_bytes'], previous['peak_memory_bytes'])}"
+            )
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _change(value: float, previous: float) -> str:
+    if not previous:
+        return "-"
+    return f"{(value - previous) / previous:+.1%}"
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main(
+    shards: int = 4,
+    records: int = 10000,
+    payload_size: int = 256,
+    repeat: int = 3,
+    dump_dir: str = "dist",
+    baseline: str = "",
+) -> None:
+    """ベンチマークを実行し、結果を表示してJSONファイルに出力する
+
+    Args:
+        shards: 擬似DataStreamのシャード数
+        records: 追加するレコード数
+        payload_size: 1レコードのDataのおおよそのサイズ(バイト)
+        repeat: 実行時間を計測する繰り返し回数、中央値を結果とする
+        dump_dir: 結果のJSONファイルの出力先ディレクトリ
+        baseline: 比較対象とする以前の結果のJSONファイル
+    """
+    # motoを使用するため、AWSの認証情報が設定されていない環境でも実行できるようにする
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(name, "testing")
+
+    report = run_benchmarks(shards, records, payload_size, repeat)
+    previous = None
+    if baseline:
+        with open(baseline, encoding="utf-8") as file:
+            previous = json.load(file)
+    print(format_report(report, previous))
+
+    os.makedirs(dump_dir, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_path = os.path.join(dump_dir, f"kdv_bench_{timestamp}.json")
+    with open(output_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Report written to file '{output_path}'.")
+
+
+if __name__ == "__main__":
+    import jsonargparse
+
+    jsonargparse.CLI(main)
@@ -1,19 +1,55 @@
+import asyncio
+import base64
+import datetime
 import glob
+import gzip
+import hashlib
+import json
 import os
+import subprocess
+import sys
+import test.bench_kdv as bench
 import test.util as util
+import threading
+import time
+from typing import TYPE_CHECKING
 
 import boto3
 import pytest
+import rich
+from botocore.exceptions import ClientError
 from moto import mock_aws
 
 import src.const as const
 import src.msg as msg
-from src.kinesis_client import KinesisClient
+import src.search as search
+from src.async_reader import DEFAULT_ASYNC_CONCURRENCY, AsyncShardReader
+from src.decoders import KPL_MAGIC, DataDecoder
+from src.discovery_cache import DiscoveryCache
+from src.exporters import JsonlRecordWriter, ParquetRecordWriter
+from src.kinesis_client import KinesisClient, ShardSample
 from src.kinesis_data_viewer import KinesisDataViewerCLI
+from src.pager import RecordPager, truncate
+from src.read_metrics import LatencyHistogram, ReadMetrics
+from src.read_scheduler import DEFAULT_MAX_CONCURRENCY, ShardReadScheduler, TokenBucket
+from src.record_cache import RecordCache, decode_sequence_number, encode_sequence_number
+from src.record_store import ShardRecords
+from src.search import SearchEngine, SearchQuery
+from src.shard_topology import ShardInfo, ShardTopology
+from src.snapshot_source import JsonlSnapshotFile, ParquetSnapshotFile, SnapshotSource
+from src.stream_stats import HotKeys, SizeHistogram, StreamStats, ThroughputHistogram
+from src.time_util import parse_time
+
+if TYPE_CHECKING:
+    from mypy_boto3_kinesis.type_defs import PutRecordsRequestEntryTypeDef
 
 REGION = os.getenv("KDV_REGION") or "ap-northeast-1"
 STREAM_NAME = os.getenv("STREAM_NAME") or "kdv-unit-test-stream"
 NUM_OF_TEST_RECORDS = int(os.getenv("NUM_OF_TEST_RECORDS") or 30)
+# CLIのモジュールの読み込みにかけられる時間の上限(秒)
+STARTUP_BUDGET_SEC = float(os.getenv("STARTUP_BUDGET_SEC") or 0.3)
+# CLIの起動時には読み込まない、読み込みに時間がかかるライブラリ
+HEAVY_MODULES = ("boto3", "questionary", "rich.table", "pyarrow")
 
 
 class TestKinesisDataViewer:
@@ -67,9 +103,9 @@ class TestKinesisDataViewer:
             return []
 
         with pytest.raises(SystemExit) as exc_info:
-            kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+            kdv = KinesisDataViewerCLI(region=self.region)
             monkeypatch.setattr(KinesisClient, "get_stream_names", return_empty_list)
-            kdv.main(region=self.region)
+            kdv.main(region=self.region, discovery_ttl=0)
 
             captured = capsys.readouterr()
             assert msg.NO_STREAM in captured.out
@@ -90,6 +126,112 @@ class TestKinesisDataViewer:
         captured = capsys.readouterr()
         assert msg.EXIT in captured.out
 
+    @mock_aws
+    def test_main_loop_refresh(self, capsys, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        commands = iter(["refresh", "exit"])
+        clients = []
+        setup_sample_records = self.setup_sample_records
+
+        def select_command(self) -> str:
+            """レコードを追加してからrefresh、exitの順にコマンドを返却するスタブ"""
+            clients.append(self.kds_client)
+            setup_sample_records()
+            return next(commands)
+
+        monkeypatch.setattr(
+            kdv, "_select_command", select_command.__get__(kdv, KinesisDataViewerCLI)
+        )
+        iterator_types = []
+        get_shard_iterator = KinesisClient._get_shard_iterator
+
+        def spy_get_shard_iterator(self, shard_id, last_sequence_number=None, start_time=None):
+            """読み取り開始位置を記録するスパイ"""
+            iterator_types.append(last_sequence_number)
+            return get_shard_iterator(self, shard_id, last_sequence_number, start_time)
+
+        monkeypatch.setattr(KinesisClient, "_get_shard_iterator", spy_get_shard_iterator)
+        kdv.main(command="summary", keep_records=True)
+
+        # コマンド間で同じクライアントを使用し、refreshは追加されたレコードのみを読み取ることを確認
+        captured = capsys.readouterr()
+        assert clients[0] is clients[1]
+        assert f"{NUM_OF_TEST_RECORDS} {msg.REFRESHED}" in captured.out
+        assert sum(len(kdv.records.shard(shard_id)) for shard_id in self.shard_ids) == (
+            NUM_OF_TEST_RECORDS * 2
+        )
+        assert any(last_sequence_number is not None for last_sequence_number in iterator_types)
+        assert msg.EXIT in captured.out
+
+    @mock_aws
+    def test_main_skip_discovery(self, monkeypatch):
+        self.setup_kinesis()
+
+        def raise_error(*args, **kwargs):
+            """一覧の取得が呼び出されたら失敗させるスタブ"""
+            raise AssertionError("discovery should be skipped")
+
+        # リージョンとDataStreamを指定した場合は一覧を取得しないことを確認
+        monkeypatch.setattr(KinesisClient, "get_regions", raise_error)
+        monkeypatch.setattr(KinesisClient, "get_stream_names", raise_error)
+        kdv = KinesisDataViewerCLI()
+        kdv.main(region=self.region, target_stream_name=self.stream_name, command="exit")
+
+    @mock_aws
+    def test_main_metrics_out(self, capsys, tmp_path, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+        metrics_path = tmp_path / "metrics.json"
+
+        # summaryの読み取りで集計した計測値が終了時にJSONファイルに書き込まれることを確認
+        monkeypatch.setattr(KinesisDataViewerCLI, "_select_command", lambda self: "exit")
+        KinesisDataViewerCLI().main(
+            region=self.region,
+            target_stream_name=self.stream_name,
+            command="summary",
+            metrics_out=str(metrics_path),
+        )
+        assert msg.METRICS_FILE in capsys.readouterr().err
+        metrics = json.loads(metrics_path.read_text())
+        assert metrics["stream"] == self.stream_name
+        assert metrics["total"]["records"] == NUM_OF_TEST_RECORDS
+        assert metrics["total"]["bytes"] == NUM_OF_TEST_RECORDS * len(b"hello world")
+        assert metrics["total"]["throttles"] == 0
+        assert set(metrics["shards"]) == set(self.shard_ids)
+        get_records = metrics["operations"]["get_records"]
+        assert get_records["api_calls"] == get_records["latency_ms"]["count"] > 0
+        for shard in metrics["shards"].values():
+            assert shard["millis_behind_latest"] == 0
+            assert sum(shard["latency_ms"]["histogram"].values()) == shard["api_calls"]
+
+    @mock_aws
+    def test_get_stream_names_pagination(self):
+        for n in range(101):
+            self.client.create_stream(StreamName=f"{self.stream_name}-{n}", ShardCount=1)
+
+        # 1ページの上限を超えるDataStreamも全て取得することを確認
+        assert len(KinesisClient.get_stream_names(self.region)) == 101
+
+    def test_discovery_cache(self, tmp_path):
+        cache = DiscoveryCache(str(tmp_path / "discovery.json"), ttl=60)
+        calls = []
+
+        def load() -> list[str]:
+            calls.append(None)
+            return ["stream-a", "stream-b"]
+
+        # 有効期間内は保存した一覧を返し、空の一覧と無効なキャッシュは保存しないことを確認
+        assert cache.fetch("key", load) == ("stream-a", "stream-b")
+        assert DiscoveryCache(cache.path, ttl=60).fetch("key", load) == ("stream-a", "stream-b")
+        assert len(calls) == 1
+        assert DiscoveryCache(cache.path, ttl=0).fetch("key", load) == ("stream-a", "stream-b")
+        assert len(calls) == 2
+        assert cache.fetch("empty", list) == ()
+        assert "empty" not in cache._load()
+
     @mock_aws
     def test_main_invalid_command(self, monkeypatch):
         self.setup_kinesis()
@@ -122,6 +264,31 @@ class TestKinesisDataViewer:
         assert const.LAST_ADDED_TIME in captured.out
         assert captured.out.count("shardId-") == 4
 
+    @mock_aws
+    def test_record_store_reuse(self, capsys, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.keep_records = True
+        kdv.summary()
+        assert all(kdv.records.is_loaded(shard_id) for shard_id in self.shard_ids)
+
+        def raise_error(*args, **kwargs):
+            """APIが呼び出されたら失敗させるスタブ"""
+            raise AssertionError("records should be read from RecordStore")
+
+        # 2回目以降のコマンドはレコードストアのレコードを使用することを確認
+        monkeypatch.setattr(kdv.kds_client, "iter_records", raise_error)
+        monkeypatch.setattr(kdv.kds_client, "iter_shard_records", raise_error)
+        monkeypatch.setattr(kdv.kds_client, "get_recent_records", raise_error)
+        kdv._search_record(key="hello world")
+        kdv._show_recent_records(target_shard=self.shard_ids[0])
+        kdv._dump_records(target_shard=self.shard_ids[0], output="terminal")
+
+        captured = capsys.readouterr()
+        assert f"{NUM_OF_TEST_RECORDS} record found" in captured.out
+
     @mock_aws
     @pytest.mark.no_records
     def test_summary_no_records(self, capsys):
@@ -138,6 +305,100 @@ class TestKinesisDataViewer:
         assert const.LAST_ADDED_TIME in captured.out
         assert captured.out.count("shardId-") == 4
 
+    @mock_aws
+    def test_summary_without_keeping_records(self, capsys):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        # 既定ではレコードを保持せずに統計のみを集計することを確認
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.summary()
+
+        captured = capsys.readouterr()
+        assert const.TOTAL_BYTES in captured.out
+        assert const.P99_SIZE in captured.out
+        assert msg.HOT_KEYS_TITLE in captured.out
+        assert msg.THROUGHPUT_TITLE in captured.out
+        assert str(NUM_OF_TEST_RECORDS * len(b"hello world")) in captured.out
+        assert kdv.records.shards == {}
+
+        # keep_recordsの場合は後続のコマンドのためにレコードを保持することを確認
+        kdv.keep_records = True
+        kdv.summary()
+        assert sum(len(shard) for shard in kdv.records.shards.values()) == NUM_OF_TEST_RECORDS
+        kdv.keep_records = False
+        kdv.summary()
+        assert str(NUM_OF_TEST_RECORDS * len(b"hello world")) in capsys.readouterr().out
+
+    @mock_aws
+    def test_summary_metadata(self, capsys, tmp_path, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+        KinesisClient(self.region, self.stream_name, cache_dir=str(tmp_path)).get_records(
+            tuple(self.shard_ids)
+        )
+
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.kds_client = KinesisClient(self.region, self.stream_name, cache_dir=str(tmp_path))
+        kdv.summary_mode = "metadata"
+
+        def raise_error(*args, **kwargs):
+            """APIが呼び出されたら失敗させるスタブ"""
+            raise AssertionError("records should not be read in metadata mode")
+
+        # レコードを読み取らず、シャード情報とキャッシュの統計のみを出力することを確認
+        monkeypatch.setattr(kdv.kds_client.kinesis_client, "get_records", raise_error)
+        kdv.summary()
+
+        captured = capsys.readouterr()
+        assert captured.out.count("shardId-") == 4
+        assert captured.out.count("25.00%") == 4
+        assert const.HASH_KEY_SHARE in captured.out
+        assert msg.SUMMARY_CACHED in captured.out
+        assert kdv.records.shards == {}
+
+    @mock_aws
+    def test_summary_sample(self, capsys, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.summary_mode = "sample"
+        kdv.sample_batches = 1
+        calls = []
+        get_records = kdv.kds_client.kinesis_client.get_records
+
+        def spy_get_records(**kwargs) -> dict:
+            """呼び出し回数を記録するスパイ"""
+            calls.append(kwargs)
+            return get_records(**kwargs)
+
+        # シャードごとに指定した回数のみGetRecordsを呼び出すことを確認
+        monkeypatch.setattr(kdv.kds_client.kinesis_client, "get_records", spy_get_records)
+        kdv.summary()
+
+        captured = capsys.readouterr()
+        assert captured.out.count("shardId-") == 4
+        assert const.AVG_DATA_SIZE in captured.out
+        assert len(calls) == len(self.shard_ids)
+
+    def test_shard_sample_estimate(self):
+        sample = ShardSample(
+            num_of_records=100,
+            total_bytes=1000,
+            first_timestamp=1729747423000,
+            last_timestamp=1729747424000,
+            millis_behind_latest=9000,
+        )
+
+        # サンプル内の追加レートとMillisBehindLatestから概算することを確認
+        assert sample.estimated_records() == 1000
+        assert sample.estimated_last_added() == 1729747433000
+        complete = sample._replace(complete=True)
+        assert complete.estimated_records() == 100
+        assert complete.estimated_last_added() == 1729747424000
+        assert ShardSample().estimated_last_added() is None
+
     @mock_aws
     def test_dump_records_terminal(self, capsys):
         self.setup_kinesis()
@@ -155,6 +416,22 @@ class TestKinesisDataViewer:
         assert const.TIMESTAMP in captured.out
         assert "hello world" in captured.out
 
+    @mock_aws
+    def test_dump_records_terminal_pages(self, capsys):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        # 非対話実行時は全ページが順に出力されることを確認
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.page_size = 1
+        kdv._dump_records(target_shard=self.shard_ids[0], output="terminal")
+
+        captured = capsys.readouterr()
+        num_of_records = len(kdv.records.shard(self.shard_ids[0]))
+        assert captured.out.count("hello world") == num_of_records
+        assert f"(page {max(num_of_records, 1)})" in captured.out
+        assert f"(page {num_of_records + 1})" not in captured.out
+
     @mock_aws
     @pytest.mark.no_records
     def test_dump_records_terminal_no_records(self, capsys):
@@ -183,6 +460,725 @@ class TestKinesisDataViewer:
         files = [file for file in glob.glob(f"dist/kdv_output_{self.stream_name}_*.csv")]
         assert len(files) == 1
 
+    @mock_aws
+    @pytest.mark.no_records
+    def test_dump_records_csv_no_records(self):
+        self.setup_kinesis()
+
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv._dump_records(target_shard=self.shard_ids[0], output="csv")
+
+        # ヘッダーのみのファイルが1つ出力されることを確認
+        files = [file for file in glob.glob(f"dist/kdv_output_{self.stream_name}_*.csv")]
+        assert len(files) == 1
+        with open(files[0]) as file:
+            assert len(file.readlines()) == 1
+
+    @mock_aws
+    @pytest.mark.parametrize("output", ["jsonl", "parquet"])
+    def test_dump_records_all_shards(self, output, tmp_path):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.dump_dir = str(tmp_path)
+        kdv._dump_records(target_shard="all", output=output)
+
+        # シャードごとに1ファイル出力され、合計で全レコードが含まれることを確認
+        files = glob.glob(str(tmp_path / f"kdv_output_{self.stream_name}_*.{output}"))
+        assert len(files) == len(self.shard_ids)
+        if output == "jsonl":
+            rows = [json.loads(line) for file in files for line in open(file)]
+        else:
+            pq = pytest.importorskip("pyarrow.parquet")
+            rows = [row for file in files for row in pq.read_table(file).to_pylist()]
+        assert len(rows) == NUM_OF_TEST_RECORDS
+        assert all(row[const.DATA] == "hello world" for row in rows)
+        # ファイル出力ではレコードストアにレコードを保持しないことを確認
+        assert not any(len(shard) for shard in kdv.records.shards.values())
+        # 元のバイト列と、UTCオフセット付きの追加日時が出力されることを確認
+        if output == "jsonl":
+            assert all(base64.b64decode(row[const.RAW_DATA]) == b"hello world" for row in rows)
+            timestamps = [datetime.datetime.fromisoformat(row[const.TIMESTAMP]) for row in rows]
+        else:
+            assert all(row[const.RAW_DATA] == b"hello world" for row in rows)
+            timestamps = [row[const.TIMESTAMP] for row in rows]
+        assert all(timestamp.utcoffset() is not None for timestamp in timestamps)
+
+    @mock_aws
+    @pytest.mark.parametrize("output", ["jsonl", "parquet"])
+    def test_source_dump(self, output, capsys, tmp_path, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+        if output == "parquet":
+            pytest.importorskip("pyarrow.parquet")
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.dump_dir = str(tmp_path)
+        kdv._dump_records(target_shard="all", output=output)
+        expected = kdv.kds_client.get_records(tuple(self.shard_ids))
+
+        def raise_error(*args, **kwargs):
+            """AWSにアクセスした場合に失敗させるスタブ"""
+            raise AssertionError("AWS must not be accessed")
+
+        # スナップショットのみからシャード、レコードを読み取れることを確認
+        monkeypatch.setattr(boto3, "client", raise_error)
+        source = SnapshotSource(str(tmp_path), self.stream_name)
+        assert source.list_shards() == tuple(sorted(s for s in self.shard_ids if expected[s]))
+        for shard_id in source.list_shards():
+            records = [r for batch in source.iter_shard_records(shard_id) for r in batch]
+            assert [r[const.SEQ_NUM] for r in records] == sorted(expected[shard_id])
+            assert all(
+                r[const.TIMESTAMP] == expected[shard_id][r[const.SEQ_NUM]][const.TIMESTAMP]
+                for r in records
+            )
+            recent = source.get_recent_records(shard_id, 2)
+            assert [r[const.SEQ_NUM] for r in recent] == sorted(expected[shard_id])[::-1][:2]
+
+        # 各コマンドをスナップショットに対して実行できることを確認
+        monkeypatch.setattr(KinesisDataViewerCLI, "_select_command", lambda self: "exit")
+        capsys.readouterr()
+        KinesisDataViewerCLI().main(
+            source=str(tmp_path), command="search_record", search_key="hello"
+        )
+        assert f"{NUM_OF_TEST_RECORDS} record found" in capsys.readouterr().out
+        with pytest.raises(ValueError, match=msg.OFFLINE_UNSUPPORTED):
+            KinesisDataViewerCLI().main(source=str(tmp_path), command="tail")
+        with pytest.raises(ValueError, match=msg.OFFLINE_UNSUPPORTED):
+            KinesisDataViewerCLI().main(
+                source=str(tmp_path), command="summary", summary_mode="metadata"
+            )
+
+    @mock_aws
+    @pytest.mark.parametrize("output", ["jsonl", "parquet"])
+    def test_source_raw_data(self, output, capsys, tmp_path, monkeypatch):
+        self.setup_kinesis()
+        records: list["PutRecordsRequestEntryTypeDef"] = [
+            {"Data": gzip.compress(b"hello gzip"), "PartitionKey": util.get_random_string()}
+            for _ in range(NUM_OF_TEST_RECORDS)
+        ]
+        self.client.put_records(Records=records, StreamARN=self.stream_arn)
+        if output == "parquet":
+            pytest.importorskip("pyarrow.parquet")
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.decoder = DataDecoder("gzip")
+        kdv.dump_dir = str(tmp_path)
+        kdv._dump_records(target_shard="all", output=output)
+        expected = kdv.kds_client.get_records(tuple(self.shard_ids))
+
+        # 出力時と異なるタイムゾーンでも追加日時、元のバイト列を復元できることを確認
+        monkeypatch.setenv("TZ", "America/Los_Angeles" if time.timezone < 0 else "Asia/Tokyo")
+        time.tzset()
+        try:
+            source = SnapshotSource(str(tmp_path), self.stream_name)
+            for shard_id in source.list_shards():
+                for record in (r for batch in source.iter_shard_records(shard_id) for r in batch):
+                    original = expected[shard_id][record[const.SEQ_NUM]]
+                    assert record[const.DATA] == original[const.DATA]
+                    assert record[const.TIMESTAMP] == original[const.TIMESTAMP]
+        finally:
+            monkeypatch.undo()
+            time.tzset()
+
+        # 出力時と同じデコーダーで検索できることを確認
+        monkeypatch.setattr(KinesisDataViewerCLI, "_select_command", lambda self: "exit")
+        capsys.readouterr()
+        KinesisDataViewerCLI().main(
+            source=str(tmp_path), command="search_record", search_key="hello gzip", decoder="gzip"
+        )
+        assert f"{NUM_OF_TEST_RECORDS} record found" in capsys.readouterr().out
+
+    @pytest.mark.parametrize("output", ["jsonl", "parquet"])
+    def test_snapshot_file_lazy(self, output, tmp_path, monkeypatch):
+        if output == "parquet":
+            pq = pytest.importorskip("pyarrow.parquet")
+            monkeypatch.setattr("src.exporters.PARQUET_ROW_GROUP_SIZE", 4)
+        shard_ids = ("shardId-000000000000", "shardId-000000000001", "shardId-000000000002")
+        records = [
+            {
+                const.SHARD_ID: shard_ids[n % 2],
+                const.SEQ_NUM: n,
+                const.DATA: b'{"ShardId": "shardId-000000000002"}',
+                const.PARTITION_KEY: "key",
+                const.TIMESTAMP: 1729747423000 + n,
+            }
+            for n in range(10)
+        ]
+        path = str(tmp_path / f"snapshot.{output}")
+        writer_class = JsonlRecordWriter if output == "jsonl" else ParquetRecordWriter
+        fieldnames = (
+            const.SHARD_ID,
+            const.SEQ_NUM,
+            const.DATA,
+            const.PARTITION_KEY,
+            const.TIMESTAMP,
+            const.RAW_DATA,
+        )
+        writer = writer_class(path, fieldnames, DataDecoder())
+        writer.write(records)
+        writer.close()
+
+        # ファイル全体を読み込まずに、ShardIdの値のみでシャードごとのレコードを返すことを確認
+        if output == "parquet":
+            monkeypatch.setattr(pq.ParquetFile, "read", None)
+            file = ParquetSnapshotFile(path)
+            assert file.parquet.num_row_groups == 3
+        else:
+            file = JsonlSnapshotFile(path)
+        assert sorted(file.shard_ids()) == list(shard_ids[:2])
+        for shard_id in shard_ids[:2]:
+            read = [r for batch in file.iter_batches(shard_id) for r in batch]
+            expected = [r for r in records if r[const.SHARD_ID] == shard_id]
+            assert [r[const.SEQ_NUM] for r in read] == [r[const.SEQ_NUM] for r in expected]
+            assert all(r[const.DATA] == records[0][const.DATA] for r in read)
+        assert list(file.iter_batches(shard_ids[2])) == []
+        file.close()
+
+    def test_source_overlapping_files(self, tmp_path):
+        shard_id = "shardId-000000000000"
+        fieldnames = (
+            const.SEQ_NUM,
+            const.DATA,
+            const.PARTITION_KEY,
+            const.TIMESTAMP,
+            const.RAW_DATA,
+        )
+
+        def write(name: str, sequence_numbers: range) -> None:
+            writer = JsonlRecordWriter(str(tmp_path / name), fieldnames, DataDecoder())
+            writer.write(
+                {
+                    const.SEQ_NUM: n,
+                    const.DATA: f"record {n}".encode(),
+                    const.PARTITION_KEY: "key",
+                    const.TIMESTAMP: 1729747423000 + n,
+                }
+                for n in sequence_numbers
+            )
+            writer.close()
+
+        # 名前順と期間の順序が異なり、期間が重複するファイルを用意する
+        write(f"kdv_output_stream_{shard_id}_1.jsonl", range(50, 100))
+        write(f"kdv_output_stream_{shard_id}_2.jsonl", range(0, 60))
+        write(f"kdv_output_stream_{shard_id}_3.jsonl", range(90, 120, 2))
+
+        # 全ファイルのレコードをシーケンス番号順に重複なく返すことを確認
+        source = SnapshotSource(str(tmp_path), "stream")
+        records = [r for batch in source.iter_shard_records(shard_id) for r in batch]
+        expected = sorted(set(range(0, 100)) | set(range(90, 120, 2)))
+        assert [r[const.SEQ_NUM] for r in records] == expected
+        assert all(r[const.DATA] == f"record {r[const.SEQ_NUM]}".encode() for r in records)
+        after = [
+            r[const.SEQ_NUM]
+            for batch in source.iter_shard_records(shard_id, after_sequence_number=95)
+            for r in batch
+        ]
+        assert after == [n for n in expected if n > 95]
+        source.close()
+
+    @mock_aws
+    def test_source_cache(self, capsys, tmp_path, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+        kds_client = KinesisClient(self.region, self.stream_name, cache_dir=str(tmp_path))
+        expected = kds_client.get_records(tuple(self.shard_ids))
+
+        # キャッシュディレクトリを読み取り元とし、ストリームを読み取らずに集計できることを確認
+        monkeypatch.setattr(KinesisClient, "iter_shard_records", None)
+        monkeypatch.setattr(KinesisDataViewerCLI, "_select_command", lambda self: "exit")
+        source = SnapshotSource(str(tmp_path))
+        assert source.target_stream_name == self.stream_name
+        assert source.list_shards() == tuple(sorted(self.shard_ids))
+        assert {
+            shard_id: len(batch) for shard_id, batch in source.iter_records(source.list_shards())
+        } == {shard_id: len(records) for shard_id, records in expected.items() if records}
+        KinesisDataViewerCLI().main(source=str(tmp_path), command="summary")
+        total_row = next(line for line in capsys.readouterr().out.splitlines() if "total" in line)
+        assert str(NUM_OF_TEST_RECORDS) in total_row
+
+    def test_source_not_found(self, tmp_path):
+        with pytest.raises(ValueError, match=msg.SOURCE_NOT_FOUND):
+            SnapshotSource(str(tmp_path / "missing"))
+        with pytest.raises(ValueError, match=msg.SOURCE_NOT_FOUND):
+            SnapshotSource(str(tmp_path))
+
+    @mock_aws
+    def test_dump_records_stdout(self, capsys):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.dump_dir = "-"
+        kdv._dump_records(target_shard="all", output="csv")
+
+        # 全シャードのレコードがShardId列付きで標準出力に書き込まれることを確認
+        lines = capsys.readouterr().out.splitlines()
+        assert lines[0].startswith(const.SHARD_ID)
+        assert len(lines) == NUM_OF_TEST_RECORDS + 1
+
+    @mock_aws
+    def test_iter_records(self):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        kds_client = KinesisClient(self.region, self.stream_name)
+        batches = list(kds_client.iter_records(tuple(self.shard_ids)))
+
+        # 全シャードのレコードがバッチ単位で返却されることを確認
+        assert sum(len(batch) for _, batch in batches) == NUM_OF_TEST_RECORDS
+        assert {shard_id for shard_id, _ in batches} <= set(self.shard_ids)
+        assert kds_client.get_records(tuple(self.shard_ids)).keys() == set(self.shard_ids)
+
+    @mock_aws
+    def test_iter_records_fail_fast(self, monkeypatch):
+        self.setup_kinesis()
+        failed_shard, *other_shards = self.shard_ids
+
+        def iter_shard_records(self, shard_id, end_bound=None, after_sequence_number=None):
+            """1シャードのみ即座に失敗し、他のシャードは長時間読み取りを続けるスタブ"""
+            if shard_id == failed_shard:
+                raise ValueError("fatal")
+            for _ in range(1000):
+                time.sleep(0.01)
+                yield [{const.SEQ_NUM: 1}]
+
+        # 他のシャードの読み取りを待たずに例外が伝播することを確認
+        monkeypatch.setattr(KinesisClient, "iter_shard_records", iter_shard_records)
+        kds_client = KinesisClient(self.region, self.stream_name)
+        started = time.monotonic()
+        with pytest.raises(ValueError):
+            for _ in kds_client.iter_records(tuple(self.shard_ids)):
+                pass
+        assert time.monotonic() - started < 5
+        assert other_shards
+
+    @mock_aws
+    def test_stream_consumer_lifecycle(self):
+        self.setup_kinesis()
+        kds_client = KinesisClient(self.region, self.stream_name, read_engine="efo")
+
+        # 最初の使用時にコンシューマーを登録し、closeで削除することを確認
+        consumer = kds_client.consumer()
+        assert consumer is kds_client.consumer()
+        consumers = self.client.list_stream_consumers(StreamARN=self.stream_arn)["Consumers"]
+        assert [c["ConsumerName"] for c in consumers] == [consumer.name]
+        kds_client.close()
+        assert not self.client.list_stream_consumers(StreamARN=self.stream_arn)["Consumers"]
+        kds_client.close()
+
+    @mock_aws
+    def test_iter_records_efo(self, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+        kds_client = KinesisClient(self.region, self.stream_name, read_engine="efo")
+        get_shard_iterator = kds_client.kinesis_client.get_shard_iterator
+        get_records = kds_client.kinesis_client.get_records
+        positions: list[str] = []
+        batch_size = 2
+
+        def stub_subscribe_to_shard(ConsumerARN, ShardId, StartingPosition) -> dict:
+            """motoはSubscribeToShardに未対応のため、GetRecordsの結果を1イベントずつ返すスタブ"""
+            assert ConsumerARN == kds_client.consumer().arn
+            positions.append(StartingPosition["Type"])
+            kwargs = {"ShardIteratorType": StartingPosition["Type"]}
+            if "SequenceNumber" in StartingPosition:
+                kwargs["StartingSequenceNumber"] = StartingPosition["SequenceNumber"]
+            shard_iterator = get_shard_iterator(
+                StreamName=self.stream_name, ShardId=ShardId, **kwargs
+            )["ShardIterator"]
+            records = get_records(ShardIterator=shard_iterator, Limit=batch_size)["Records"]
+            event = {
+                "Records": records,
+                "ContinuationSequenceNumber": (
+                    records[-1][const.SEQ_NUM]
+                    if records
+                    else StartingPosition.get("SequenceNumber")
+                ),
+                "MillisBehindLatest": 1000 if len(records) == batch_size else 0,
+            }
+            return {"EventStream": [{"SubscribeToShardEvent": event}]}
+
+        monkeypatch.setattr(
+            kds_client.kinesis_client, "subscribe_to_shard", stub_subscribe_to_shard
+        )
+        batches = list(kds_client.iter_records(tuple(self.shard_ids)))
+
+        # 購読の終了後は続きから購読し直し、全レコードを読み取ることを確認
+        assert sum(len(batch) for _, batch in batches) == NUM_OF_TEST_RECORDS
+        assert positions[0] == "TRIM_HORIZON"
+        assert "AFTER_SEQUENCE_NUMBER" in positions
+        kds_client.close()
+        assert not self.client.list_stream_consumers(StreamARN=self.stream_arn)["Consumers"]
+
+    @mock_aws
+    def test_follow_records_efo(self, monkeypatch):
+        self.setup_kinesis()
+        kds_client = KinesisClient(self.region, self.stream_name, read_engine="efo")
+        positions: list[str] = []
+
+        def stub_subscribe_to_shard(ConsumerARN, ShardId, StartingPosition) -> dict:
+            """最初の購読では1件のレコード、以降は空のイベントを返すスタブ"""
+            positions.append(StartingPosition["Type"])
+            records = []
+            if StartingPosition["Type"] == "LATEST":
+                records.append(
+                    {
+                        const.SEQ_NUM: "1",
+                        const.DATA: b"hello",
+                        const.PARTITION_KEY: "key",
+                        const.TIMESTAMP: datetime.datetime.now().astimezone(),
+                    }
+                )
+            else:
+                time.sleep(0.05)
+            event = {"Records": records, "ContinuationSequenceNumber": "1", "MillisBehindLatest": 0}
+            return {"EventStream": [{"SubscribeToShardEvent": event}]}
+
+        monkeypatch.setattr(
+            kds_client.kinesis_client, "subscribe_to_shard", stub_subscribe_to_shard
+        )
+        stop = threading.Event()
+        threading.Timer(0.5, stop.set).start()
+        received = [shard_id for shard_id, batch in kds_client.follow_records(stop) for _ in batch]
+
+        # オープン中の全シャードをLATESTから購読し、続きから購読し直すことを確認
+        assert sorted(received) == sorted(self.shard_ids)
+        assert positions.count("LATEST") == len(self.shard_ids)
+        assert "AFTER_SEQUENCE_NUMBER" in positions
+        kds_client.close()
+
+    @mock_aws
+    def test_iter_records_async(self, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+        parent = self.shard_ids[0]
+        self.client.split_shard(
+            StreamName=self.stream_name, ShardToSplit=parent, NewStartingHashKey=str(2**125)
+        )
+        self.setup_sample_records()
+        kds_client = KinesisClient(self.region, self.stream_name, read_backend="async")
+        monkeypatch.setattr(
+            AsyncShardReader,
+            "_create_client",
+            lambda reader: util.AsyncClientAdapter(kds_client.kinesis_client),
+        )
+
+        # スレッドでの読み取りと同じ形式で全レコードを返し、子シャードは親シャードの後に返すことを確認
+        shard_ids = kds_client.list_shards()
+        children = kds_client.topology().children(parent)
+        batches = list(kds_client.iter_records(shard_ids))
+        assert sum(len(batch) for _, batch in batches) == NUM_OF_TEST_RECORDS * 2
+        assert all(
+            isinstance(record[const.SEQ_NUM], int) for _, batch in batches for record in batch
+        )
+        read_order = [shard_id for shard_id, _ in batches]
+        parent_batches = [n for n, shard_id in enumerate(read_order) if shard_id == parent]
+        child_batches = [n for n, shard_id in enumerate(read_order) if shard_id in children]
+        assert not parent_batches or not child_batches or max(parent_batches) < min(child_batches)
+
+        # 途中で読み取りをやめた場合もイベントループが停止することを確認
+        records = kds_client.iter_records(shard_ids)
+        next(records)
+        records.close()
+
+    @mock_aws
+    def test_iter_records_async_fail_fast(self, monkeypatch):
+        self.setup_kinesis()
+        kds_client = KinesisClient(
+            self.region, self.stream_name, read_backend="async", max_empty_polls=10**6
+        )
+        failing = self.shard_ids[0]
+        get_shard_iterator = kds_client.kinesis_client.get_shard_iterator
+        get_records_calls = []
+
+        def stub_get_shard_iterator(**kwargs):
+            """1つのシャードのみシャードイテレーターの取得に失敗させるスタブ"""
+            if kwargs["ShardId"] == failing:
+                time.sleep(0.2)
+                raise RuntimeError("shard failure")
+            return get_shard_iterator(**kwargs)
+
+        def stub_get_records(**kwargs):
+            """最新のレコードに追いつかず読み取りが終わらないシャードのスタブ"""
+            get_records_calls.append(kwargs)
+            return {"Records": [], "NextShardIterator": "iterator", "MillisBehindLatest": 1000}
+
+        monkeypatch.setattr(
+            kds_client.kinesis_client, "get_shard_iterator", stub_get_shard_iterator
+        )
+        monkeypatch.setattr(kds_client.kinesis_client, "get_records", stub_get_records)
+        monkeypatch.setattr(
+            AsyncShardReader,
+            "_create_client",
+            lambda reader: util.AsyncClientAdapter(kds_client.kinesis_client),
+        )
+
+        # 1つのシャードの例外が他のシャードの読み取りの完了を待たずに送出されることを確認
+        started = time.monotonic()
+        with pytest.raises(RuntimeError, match="shard failure"):
+            list(kds_client.iter_records(tuple(self.shard_ids)))
+        assert time.monotonic() - started < 5
+        assert get_records_calls
+
+    @mock_aws
+    def test_iter_records_async_unavailable(self, monkeypatch):
+        self.setup_kinesis()
+        kds_client = KinesisClient(self.region, self.stream_name, read_backend="async")
+        monkeypatch.setitem(sys.modules, "aiobotocore", None)
+
+        with pytest.raises(ValueError, match=msg.ASYNC_UNAVAILABLE):
+            list(kds_client.iter_records(tuple(self.shard_ids)))
+
+    def test_async_concurrency(self):
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+
+        # asyncの同時リクエスト数はスケジューラーの同時実行数(スレッド数、接続プール)を変更しないことを確認
+        kds_client = kdv._create_client(self.region, read_backend="async")
+        assert kds_client.scheduler.max_concurrency == DEFAULT_MAX_CONCURRENCY
+        assert AsyncShardReader(kds_client, kds_client.async_concurrency).max_concurrency == (
+            DEFAULT_ASYNC_CONCURRENCY
+        )
+        kds_client = kdv._create_client(self.region, max_concurrency=8, read_backend="async")
+        assert AsyncShardReader(kds_client, kds_client.async_concurrency).max_concurrency == 8
+
+    @mock_aws
+    def test_list_shards_pagination(self, monkeypatch):
+        self.setup_kinesis()
+        kds_client = KinesisClient(self.region, self.stream_name)
+        shards = kds_client.kinesis_client.list_shards(StreamName=self.stream_name)["Shards"]
+        calls = []
+
+        def paginated_list_shards(**kwargs) -> dict:
+            """1ページに1シャードずつ返却するスタブ"""
+            calls.append(kwargs)
+            page = int(kwargs.get("NextToken", 0))
+            response: dict = {"Shards": shards[page : page + 1]}
+            if page + 1 < len(shards):
+                response["NextToken"] = str(page + 1)
+            return response
+
+        # NextTokenがなくなるまで全てのシャードを取得することを確認
+        monkeypatch.setattr(kds_client.kinesis_client, "list_shards", paginated_list_shards)
+        assert kds_client.list_shards() == tuple(self.shard_ids)
+        assert len(calls) == len(self.shard_ids)
+        assert "StreamName" not in calls[-1]
+
+    @mock_aws
+    def test_iter_records_resharded(self):
+        self.setup_kinesis()
+        self.setup_sample_records()
+        parent = self.shard_ids[0]
+        self.client.split_shard(
+            StreamName=self.stream_name,
+            ShardToSplit=parent,
+            NewStartingHashKey=str(2**125),
+        )
+        self.setup_sample_records()
+
+        # 子シャードは親シャードの後に並び、親シャードを読み終えてから読み取ることを確認
+        kds_client = KinesisClient(self.region, self.stream_name)
+        shard_ids = kds_client.list_shards()
+        children = kds_client.topology().children(parent)
+        assert len(children) == 2
+        assert all(shard_ids.index(parent) < shard_ids.index(child) for child in children)
+        batches = list(kds_client.iter_records(shard_ids))
+        read_order = [shard_id for shard_id, _ in batches]
+        parent_batches = [n for n, shard_id in enumerate(read_order) if shard_id == parent]
+        child_batches = [n for n, shard_id in enumerate(read_order) if shard_id in children]
+        assert not parent_batches or not child_batches or max(parent_batches) < min(child_batches)
+        assert sum(len(batch) for _, batch in batches) == NUM_OF_TEST_RECORDS * 2
+
+        # オープン中のシャードのみを対象とした場合は親シャードを読み取らないことを確認
+        kds_client = KinesisClient(self.region, self.stream_name, open_shards_only=True)
+        assert parent not in kds_client.list_shards()
+        assert set(children) <= set(kds_client.list_shards())
+
+    @mock_aws
+    def test_iter_records_snapshot_end(self):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        kds_client = KinesisClient(self.region, self.stream_name, snapshot_end=True)
+        bounds = kds_client.snapshot_bounds(tuple(self.shard_ids))
+        # 終端の記録後に追加したレコードは読み取らないことを確認
+        time.sleep(0.01)
+        self.setup_sample_records()
+        num_of_records = sum(
+            len(batch)
+            for shard_id in self.shard_ids
+            for batch in kds_client.iter_shard_records(shard_id, bounds[shard_id])
+        )
+        assert num_of_records == NUM_OF_TEST_RECORDS
+
+    @mock_aws
+    def test_iter_shard_records_max_empty_polls(self, monkeypatch):
+        self.setup_kinesis()
+        kds_client = KinesisClient(self.region, self.stream_name, max_empty_polls=3)
+        calls = []
+
+        def return_empty_records(**kwargs) -> dict:
+            """最新レコードに追いつかない空のレスポンスを返却するスタブ"""
+            calls.append(kwargs)
+            return {"Records": [], "NextShardIterator": "dummy", "MillisBehindLatest": 1000}
+
+        monkeypatch.setattr(kds_client.kinesis_client, "get_records", return_empty_records)
+
+        # 空のレスポンスが上限回数続いた時点で読み取りを終了することを確認
+        assert list(kds_client.iter_shard_records(self.shard_ids[0])) == []
+        assert len(calls) == 3
+
+    @mock_aws
+    def test_iter_records_cache(self, tmp_path, monkeypatch):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        kds_client = KinesisClient(self.region, self.stream_name, cache_dir=str(tmp_path))
+        assert len(kds_client.get_records(tuple(self.shard_ids))) == len(self.shard_ids)
+
+        # 再起動後の読み取りでは、キャッシュ済みのレコードの続きからのみ読み取ることを確認
+        self.setup_sample_records()
+        kds_client = KinesisClient(self.region, self.stream_name, cache_dir=str(tmp_path))
+        iterator_types = []
+        get_shard_iterator = kds_client.kinesis_client.get_shard_iterator
+
+        def spy_get_shard_iterator(**kwargs) -> dict:
+            """呼び出し時のイテレータータイプを記録するスパイ"""
+            iterator_types.append(kwargs["ShardIteratorType"])
+            return get_shard_iterator(**kwargs)
+
+        monkeypatch.setattr(kds_client.kinesis_client, "get_shard_iterator", spy_get_shard_iterator)
+        records = kds_client.get_records(tuple(self.shard_ids))
+        assert sum(len(records_in_shard) for records_in_shard in records.values()) == (
+            NUM_OF_TEST_RECORDS * 2
+        )
+        assert "AFTER_SEQUENCE_NUMBER" in iterator_types
+
+    @mock_aws
+    def test_iter_records_time_window(self):
+        self.setup_kinesis()
+        self.setup_sample_records()
+        time.sleep(0.01)
+        boundary = datetime.datetime.now().astimezone()
+        time.sleep(0.01)
+        self.setup_sample_records()
+
+        # 開始日時以降、終了日時以前のレコードのみを読み取ることを確認
+        for start_time, end_time in ((boundary, None), (None, boundary)):
+            kds_client = KinesisClient(
+                self.region, self.stream_name, start_time=start_time, end_time=end_time
+            )
+            records = kds_client.get_records(tuple(self.shard_ids))
+            num_of_records = sum(len(records_in_shard) for records_in_shard in records.values())
+            assert num_of_records == NUM_OF_TEST_RECORDS
+
+    @mock_aws
+    def test_tail(self, capsys, tmp_path):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        def put_records() -> None:
+            """追跡開始後にレコードを追加する"""
+            time.sleep(0.5)
+            records: list["PutRecordsRequestEntryTypeDef"] = [
+                {"Data": data, "PartitionKey": util.get_random_string()}
+                for data in (b"hello tail", b"other") * NUM_OF_TEST_RECORDS
+            ]
+            self.client.put_records(Records=records, StreamARN=self.stream_arn)
+
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.tail_output = "jsonl"
+        kdv.tail_filter = "hello"
+        kdv.tail_duration = 2
+        kdv.dump_dir = str(tmp_path)
+        thread = threading.Thread(target=put_records)
+        thread.start()
+        kdv.tail()
+        thread.join()
+
+        # 追跡開始後に追加され、検索条件に一致するレコードのみを出力することを確認
+        captured = capsys.readouterr()
+        assert f"{NUM_OF_TEST_RECORDS} record received" in captured.out
+        files = glob.glob(str(tmp_path / f"kdv_tail_{self.stream_name}_*.jsonl"))
+        rows = [json.loads(line) for line in open(files[0])]
+        assert len(rows) == NUM_OF_TEST_RECORDS
+        assert all(row[const.DATA] == "hello tail" for row in rows)
+        assert {row[const.SHARD_ID] for row in rows} <= set(self.shard_ids)
+
+    @mock_aws
+    def test_follow_records_resharded(self, monkeypatch):
+        self.setup_kinesis()
+        parent = self.shard_ids[0]
+        kds_client = KinesisClient(self.region, self.stream_name)
+        # motoは分割後の親シャードをクローズしないため、イテレーターとシャードの対応を記録してスタブする
+        shard_of_iterator: dict[str, str] = {}
+        split = threading.Event()
+        get_shard_iterator = kds_client.kinesis_client.get_shard_iterator
+        get_records = kds_client.kinesis_client.get_records
+
+        def spy_get_shard_iterator(**kwargs) -> dict:
+            response = get_shard_iterator(**kwargs)
+            shard_of_iterator[response["ShardIterator"]] = kwargs["ShardId"]
+            return response
+
+        def stub_get_records(**kwargs) -> dict:
+            """分割後の親シャードはクローズ済み、子シャードは1件のレコードを返却するスタブ"""
+            shard_id = shard_of_iterator.get(kwargs["ShardIterator"], "")
+            if shard_id == parent and split.is_set():
+                return {"Records": [], "MillisBehindLatest": 0}
+            if shard_id not in self.shard_ids:
+                record = {
+                    const.SEQ_NUM: "1",
+                    const.DATA: b"hello child",
+                    const.PARTITION_KEY: "key",
+                    const.TIMESTAMP: datetime.datetime.now().astimezone(),
+                }
+                shard_of_iterator[f"{shard_id}-next"] = parent
+                return {
+                    "Records": [record],
+                    "NextShardIterator": f"{shard_id}-next",
+                    "MillisBehindLatest": 0,
+                }
+            response = get_records(**kwargs)
+            shard_of_iterator[response["NextShardIterator"]] = shard_id
+            return response
+
+        monkeypatch.setattr(kds_client.kinesis_client, "get_shard_iterator", spy_get_shard_iterator)
+        monkeypatch.setattr(kds_client.kinesis_client, "get_records", stub_get_records)
+        stop = threading.Event()
+        received: list[str] = []
+
+        def follow() -> None:
+            for shard_id, batch in kds_client.follow_records(stop, poll_interval=0.05):
+                received.extend(shard_id for _ in batch)
+
+        thread = threading.Thread(target=follow)
+        thread.start()
+        time.sleep(0.3)
+        self.client.split_shard(
+            StreamName=self.stream_name, ShardToSplit=parent, NewStartingHashKey=str(2**125)
+        )
+        split.set()
+        time.sleep(1)
+        stop.set()
+        thread.join()
+
+        # 追跡中にクローズされたシャードの子シャードを追跡することを確認
+        children = kds_client.topology().children(parent)
+        assert sorted(received) == sorted(children)
+
+    def test_parse_time(self):
+        assert parse_time("") is None
+        assert parse_time("2024-10-24T14:00:00+09:00") == datetime.datetime.fromisoformat(
+            "2024-10-24T14:00:00+09:00"
+        )
+        assert parse_time("2024-10-24 14:00:00").tzinfo is not None  # type: ignore
+        relative = parse_time("-10m")
+        now = datetime.datetime.now().astimezone()
+        assert relative is not None
+        assert datetime.timedelta(minutes=9) < now - relative < datetime.timedelta(minutes=11)
+        with pytest.raises(ValueError):
+            parse_time("10 minutes ago")
+
     @mock_aws
     def test_show_recent_records(self, capsys):
         self.setup_kinesis()
@@ -201,6 +1197,21 @@ class TestKinesisDataViewer:
         assert captured.out.count("hello world") > 0
         assert captured.out.count("hello world") <= 100
 
+    @mock_aws
+    @pytest.mark.parametrize("use_cache", [False, True])
+    def test_get_recent_records(self, tmp_path, use_cache):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        cache_dir = str(tmp_path) if use_cache else ""
+        kds_client = KinesisClient(self.region, self.stream_name, cache_dir=cache_dir)
+        all_records = kds_client.get_records(tuple(self.shard_ids))
+        for shard_id in self.shard_ids:
+            # シーケンス番号の大きい順に上位の件数のみ返却されることを確認
+            expected = sorted(all_records[shard_id], key=int, reverse=True)[:3]
+            recent_records = kds_client.get_recent_records(shard_id, 3)
+            assert [record[const.SEQ_NUM] for record in recent_records] == expected
+
     @mock_aws
     @pytest.mark.no_records
     def test_show_recent_records_no_records(self, capsys):
@@ -230,6 +1241,23 @@ class TestKinesisDataViewer:
         captured = capsys.readouterr()
         assert f"{NUM_OF_TEST_RECORDS} record found" in captured.out
 
+    @mock_aws
+    def test_search_record_gzip(self, capsys):
+        self.setup_kinesis()
+        records = [
+            {"Data": gzip.compress(b"hello gzip"), "PartitionKey": util.get_random_string()}
+            for _ in range(NUM_OF_TEST_RECORDS)
+        ]
+        self.client.put_records(Records=records, StreamARN=self.stream_arn)
+
+        # デコーダーを指定した場合は展開後のDataで検索できることを確認
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.decoder = DataDecoder("gzip")
+        kdv._search_record(key="hello gzip")
+
+        captured = capsys.readouterr()
+        assert f"{NUM_OF_TEST_RECORDS} record found" in captured.out
+
     @mock_aws
     def test_search_record_key_blank(self, capsys):
         self.setup_kinesis()
@@ -265,3 +1293,593 @@ class TestKinesisDataViewer:
         # ターミナルへの出力内容の確認
         captured = capsys.readouterr()
         assert msg.NO_RECORD in captured.out
+
+    @mock_aws
+    def test_search_record_field(self, capsys):
+        self.setup_kinesis()
+        records = [
+            {"Data": f'{{"recordId": "id{n}", "count": {n}}}', "PartitionKey": f"key{n}"}
+            for n in range(NUM_OF_TEST_RECORDS)
+        ]
+        self.client.put_records(Records=records, StreamARN=self.stream_arn)
+
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv._search_record(key="recordId=id1")
+        # 2回目以降の検索は読み取り済みのレコードのインデックスから検索することを確認
+        kdv.kds_client = None
+        kdv._search_record(key="count=2")
+        kdv._search_record(key="pk:key3")
+        kdv._search_record(key="re:id1[0-9]")
+
+        captured = capsys.readouterr()
+        assert captured.out.count("1 record found") == 3
+        assert f"{min(10, NUM_OF_TEST_RECORDS - 10)} record found" in captured.out
+
+    @mock_aws
+    def test_search_record_limit(self, capsys):
+        self.setup_kinesis()
+        self.setup_sample_records()
+
+        # 表示件数の上限に達した時点で検索を打ち切ることを確認
+        kdv = KinesisDataViewerCLI(region=self.region, target_stream_name=self.stream_name)
+        kdv.search_limit = 2
+        kdv._search_record(key="hello world")
+
+        captured = capsys.readouterr()
+        assert "2 record found" in captured.out
+
+
+class TestStartup:
+    def test_import_time(self):
+        code = (
+            "import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import src.kinesis_data_viewer\n"
+            "print(time.perf_counter() - start)\n"
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        # 読み込みに時間がかかるライブラリを読み込まず、起動時間が上限以内であることを確認
+        elapsed = []
+        for _ in range(3):
+            output = subprocess.run(
+                [sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True
+            ).stdout.splitlines()
+            elapsed.append(float(output[0]))
+            assert output[1:] == [""]
+        assert min(elapsed) < STARTUP_BUDGET_SEC
+
+
+class TestBenchmark:
+    def test_run_benchmarks(self):
+        report = bench.run_benchmarks(shards=2, records=20, payload_size=64, repeat=1)
+
+        # 全ての処理の実行時間とメモリ使用量が計測され、前回の結果と比較できることを確認
+        assert report["meta"]["records"] == 20
+        assert set(report["results"]) == {
+            "get_records",
+            "summary",
+            "search_record",
+            "dump_records_csv",
+            "show_recent_records",
+        }
+        assert all(result["peak_memory_bytes"] > 0 for result in report["results"].values())
+        assert "time +0.0%" in bench.format_report(report, report)
+
+
+class TestReadMetrics:
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for latency_ms in (0.5, 3, 4, 30, 15000):
+            histogram.add(latency_ms)
+
+        # パーセンタイルはバケットの上限、上限のないバケットは最大値で返すことを確認
+        assert histogram.percentile(0.5) == 5
+        assert histogram.percentile(0.99) == 15000
+        assert histogram.to_dict()["histogram"][">10000"] == 1
+        assert LatencyHistogram().percentile(0.5) is None
+
+    def test_progress(self):
+        metrics = ReadMetrics()
+        shard_id = "shardId-000000000000"
+        metrics.on_batch(shard_id, [{const.DATA: b"abc"}, {const.DATA: b"de"}], 1000)
+        metrics.on_batch(shard_id, [{const.DATA: b"f"}], 250)
+
+        # 最初に観測したMillisBehindLatestを基準に進捗を求めることを確認
+        shard = metrics.shards[shard_id]
+        assert (shard.records, shard.bytes, shard.millis_behind_latest) == (3, 6, 250)
+        assert shard.completed == 0.75
+        metrics.on_batch(shard_id, [], 0)
+        assert shard.completed == 1.0
+
+        table = metrics.render_progress()
+        assert table.row_count == 1
+
+
+class TestSearchEngine:
+    @staticmethod
+    def _shard(payloads: list[bytes]) -> ShardRecords:
+        shard = ShardRecords("shardId-000000000000")
+        shard.extend(
+            {
+                const.SEQ_NUM: n,
+                const.DATA: payload,
+                const.PARTITION_KEY: f"key{n}",
+                const.TIMESTAMP: 1729747423000,
+            }
+            for n, payload in enumerate(payloads)
+        )
+        return shard
+
+    def test_parse_query(self):
+        assert SearchQuery.parse("hello world").kind == "text"
+        assert SearchQuery.parse("a b=c").kind == "text"
+        assert SearchQuery.parse("detail.items[0].id = 10")[:3] == (
+            "field",
+            "10",
+            "detail.items[0].id",
+        )
+        assert SearchQuery.parse("pk:key1")[:2] == ("partition_key", "key1")
+        assert SearchQuery.parse("re:^hello").kind == "regex"
+        with pytest.raises(ValueError):
+            SearchQuery.parse("re:(")
+
+    def test_search_indexed(self):
+        shard = self._shard(
+            [b'{"id": "abc-123", "items": [{"n": 1}]}', b"hello world", b"say hello.world!"]
+        )
+        engine = SearchEngine(DataDecoder())
+
+        # 正規表現、単語を含まない文字列はインデックスを構築しないことを確認
+        list(engine.search("", [(shard, 0, 3)]))
+        shard.complete = True
+        ranges = [(shard, 0, len(shard))]
+        assert [i for _, i in engine.search(r"re:o\.w", ranges)] == [2]
+        assert engine.indexes == {}
+        assert [i for _, i in engine.search("world", ranges)] == [1, 2]
+        assert [i for _, i in engine.search("lo.wor", ranges)] == [2]
+        assert [i for _, i in engine.search("ello", ranges)] == [1, 2]
+        assert [i for _, i in engine.search("c-12", ranges)] == [0]
+        assert [i for _, i in engine.search("hello wor", ranges)] == [1]
+        assert [i for _, i in engine.search("items[0].n=1", ranges)] == [0]
+        assert [i for _, i in engine.search("id=abc-123", ranges)] == [0]
+        assert [i for _, i in engine.search("pk:key2", ranges)] == [2]
+
+        # 使用した種類のインデックスのみを構築することを確認
+        postings = engine.indexes[shard.shard_id].postings
+        assert set(postings) == {"token", "field:items[0].n", "field:id", "partition_key"}
+
+        # 追加されたレコードはインデックスに差分で反映されることを確認
+        shard.extend(
+            [
+                {
+                    const.SEQ_NUM: 3,
+                    const.DATA: b'{"id": "x"}',
+                    const.PARTITION_KEY: "k",
+                    const.TIMESTAMP: 0,
+                }
+            ]
+        )
+        ranges = [(shard, 0, len(shard))]
+        assert [i for _, i in engine.search("id=x", ranges)] == [3]
+        assert [i for _, i in engine.search("hello", ranges)] == [1, 2]
+
+    @pytest.mark.parametrize("decoder", ["utf-8", "base64"])
+    def test_search_token_index(self, decoder, monkeypatch):
+        def encode(payload: bytes) -> bytes:
+            return base64.b64encode(payload) if decoder == "base64" else payload
+
+        payloads = [b'{"id": "abc-123"}', b"hello world", b"say hello.world!", b"hollow"]
+        shard = self._shard([encode(payload) for payload in payloads])
+        engine = SearchEngine(DataDecoder(decoder))
+        index_record = engine.index_record
+        decoded = []
+
+        def counting_index_record(query, data, partition_key):
+            """デコードしたレコードを記録するスタブ"""
+            decoded.append(data)
+            return index_record(query, data, partition_key)
+
+        # 読み取り中の範囲はインデックスへの追加と照合を1度の走査で行うことを確認
+        monkeypatch.setattr(engine, "index_record", counting_index_record)
+        assert [i for _, i in engine.search("world", [(shard, 0, 2), (shard, 2, 4)])] == [1, 2]
+        assert len(decoded) == len(payloads)
+
+        # 読み取り済みのシャードはトークンのインデックスで前方、後方、部分一致を検索することを確認
+        shard.complete = True
+        ranges = [(shard, 0, len(shard))]
+        assert [i for _, i in engine.search("llo", ranges)] == [1, 2, 3]
+        assert [i for _, i in engine.search("lo.wor", ranges)] == [2]
+        assert [i for _, i in engine.search("c-12", ranges)] == [0]
+        assert [i for _, i in engine.search("hello wor", ranges)] == [1]
+        assert [i for _, i in engine.search("abc-123", ranges)] == [0]
+        assert [i for _, i in engine.search("nothing", ranges)] == []
+        assert len(decoded) == len(payloads)
+
+        # 追加されたレコードはインデックスに差分で反映されることを確認
+        shard.extend(
+            [
+                {
+                    const.SEQ_NUM: 4,
+                    const.DATA: encode(b"yellow"),
+                    const.PARTITION_KEY: "k",
+                    const.TIMESTAMP: 0,
+                }
+            ]
+        )
+        ranges = [(shard, 0, len(shard))]
+        assert [i for _, i in engine.search("llo", ranges)] == [1, 2, 3, 4]
+        assert len(decoded) == len(payloads) + 1
+
+        # シャードが読み直された場合はインデックスを作り直すことを確認
+        shard.clear()
+        shard.extend(
+            [
+                {
+                    const.SEQ_NUM: 5,
+                    const.DATA: encode(b"world"),
+                    const.PARTITION_KEY: "k",
+                    const.TIMESTAMP: 0,
+                }
+            ]
+        )
+        assert [i for _, i in engine.search("world", [(shard, 0, 1)])] == [0]
+
+    def test_search_parallel(self, monkeypatch):
+        monkeypatch.setattr(search, "PARALLEL_CHUNK_SIZE", 3)
+        shard = self._shard([f"record-{n}".encode() for n in range(10)])
+        shard.complete = True
+        engine = SearchEngine(DataDecoder())
+
+        # 複数のプロセスで走査しても、シングルプロセスと同じ結果が同じ順序で返ることを確認
+        ranges = [(shard, 0, len(shard))]
+        expected = [i for _, i in engine.search("re:[13579]$", ranges, workers=1)]
+        assert expected == [1, 3, 5, 7, 9]
+        assert [i for _, i in engine.search("re:[13579]$", ranges, workers=2)] == expected
+        # 読み取りスレッドの実行中でもデッドロックしないよう、forkでプロセスを開始しないことを確認
+        assert search.process_context().get_start_method() != "fork"
+
+    def test_search_parallel_while_loading(self, monkeypatch):
+        monkeypatch.setattr(search, "PARALLEL_CHUNK_SIZE", 3)
+        shard = self._shard([json.dumps({"n": n % 3}).encode() for n in range(10)])
+        engine = SearchEngine(DataDecoder())
+        chunks = []
+        scan_chunk = engine.scan_chunk
+
+        def recording_scan_chunk(query, data, partition_keys, build_index):
+            """このプロセスで走査したチャンクの件数を記録するスタブ"""
+            chunks.append(len(data))
+            return scan_chunk(query, data, partition_keys, build_index)
+
+        # 読み取り中の範囲もチャンクにまとめて子プロセスで走査し、フィールドのインデックスを構築することを確認
+        monkeypatch.setattr(engine, "scan_chunk", recording_scan_chunk)
+        loading = [(shard, start, min(start + 2, 10)) for start in range(0, 10, 2)]
+        assert [i for _, i in engine.search("n=1", loading, workers=2)] == [1, 4, 7]
+        assert chunks == []
+        assert engine.indexes[shard.shard_id].indexed["field:n"] == 10
+
+        # 2回目の検索はインデックスから回答し、走査しないことを確認
+        shard.complete = True
+        ranges = [(shard, 0, len(shard))]
+        assert [i for _, i in engine.search("n=2", ranges, workers=2)] == [2, 5, 8]
+        assert chunks == []
+
+
+class TestStreamStats:
+    def test_size_histogram(self):
+        histogram = SizeHistogram()
+        for size in range(1, 1001):
+            histogram.add(size)
+
+        # パーセンタイルが相対誤差の範囲内で概算されることを確認
+        assert (histogram.min, histogram.max) == (1, 1000)
+        assert abs(histogram.percentile(0.5) - 500) <= 500 * 0.02  # type: ignore
+        assert abs(histogram.percentile(0.99) - 990) <= 990 * 0.02  # type: ignore
+        assert histogram.percentile(1.0) == 1000
+        assert SizeHistogram().percentile(0.5) is None
+
+    def test_throughput_histogram(self):
+        histogram = ThroughputHistogram(max_buckets=10)
+        for second in range(100):
+            histogram.add(1729747423000 + second * 1000)
+
+        # バケット数が上限以下に抑えられ、合計のレコード数が変わらないことを確認
+        rates = histogram.rates()
+        assert len(rates) <= 10
+        assert sum(rate * histogram.width / 1000 for _, rate in rates) == 100
+
+    def test_hot_keys(self):
+        hot_keys = HotKeys(top_n=3)
+        for n in range(5000):
+            hot_keys.add(f"key{n}")
+            if n % 10 == 0:
+                hot_keys.add("hot1")
+            if n % 20 == 0:
+                hot_keys.add("hot2")
+
+        # 出現回数の多いキーが上位に含まれ、候補数が上限以下に抑えられることを確認
+        top = hot_keys.top()
+        assert [key for key, _ in top[:2]] == ["hot1", "hot2"]
+        assert top[0][1] >= 500
+        assert len(hot_keys.candidates) < hot_keys.capacity * 2
+
+    def test_stream_stats(self):
+        stats = StreamStats(("shardId-000000000000", "shardId-000000000001"))
+        for n, shard_id in enumerate(stats.shards):
+            stats.add_batch(
+                shard_id,
+                [
+                    {
+                        const.DATA: b"x" * (n + 1),
+                        const.PARTITION_KEY: "key",
+                        const.TIMESTAMP: 1729747423000 + n,
+                    }
+                ],
+            )
+
+        # シャードごとの統計とストリーム全体の統計を確認
+        total = stats.total()
+        assert (total.count, total.total_bytes) == (2, 3)
+        assert (total.first_timestamp, total.last_timestamp) == (1729747423000, 1729747423001)
+        assert stats.hot_keys is not None and stats.hot_keys.top() == [("key", 2)]
+
+
+class TestShardTopology:
+    def test_ordered(self):
+        topology = ShardTopology(
+            [
+                ShardInfo(
+                    "shardId-3", parent_shard_id="shardId-1", adjacent_parent_shard_id="shardId-2"
+                ),
+                ShardInfo("shardId-1", ending_sequence_number=10),
+                ShardInfo("shardId-2", parent_shard_id="shardId-0", ending_sequence_number=20),
+                ShardInfo("shardId-4"),
+            ]
+        )
+
+        # 親シャードが子シャードより前に並び、保持期間切れの親シャードは無視することを確認
+        assert topology.ordered() == ("shardId-1", "shardId-2", "shardId-3", "shardId-4")
+        assert topology.ordered(open_only=True) == ("shardId-3", "shardId-4")
+        assert topology.parents("shardId-3") == ("shardId-1", "shardId-2")
+        assert topology.parents("shardId-2") == ()
+        assert topology.children("shardId-1") == ("shardId-3",)
+
+
+class TestRecordPager:
+    def test_pager(self, capsys):
+        shard = ShardRecords("shardId-000000000000")
+        batches = [
+            [
+                {
+                    const.SEQ_NUM: 10 * n + m,
+                    const.DATA: b"x" * 300,
+                    const.PARTITION_KEY: "key",
+                    const.TIMESTAMP: 1729747423000,
+                }
+                for m in range(5)
+            ]
+            for n in range(4)
+        ]
+
+        def ranges():
+            for batch in batches:
+                start = len(shard)
+                shard.extend(batch)
+                yield shard, start, len(shard)
+
+        pager = RecordPager(shard, ranges(), "title", DataDecoder(), page_size=3)
+
+        # 表示するページに必要な分だけ読み進めることを確認
+        assert pager.has_page(1)
+        assert len(shard) == 5
+        assert pager.find_page(22) == 4
+        assert len(shard) == 15
+        assert pager.find_page(25) is None
+        assert pager.find_page(99) is None
+        assert not pager.has_page(7)
+
+        # Dataは省略して表示されることを確認
+        rich.print(pager.render(0))
+        captured = capsys.readouterr()
+        assert "x" * 300 not in captured.out
+        assert "..." in captured.out
+
+    def test_truncate(self):
+        assert truncate("hello world", 8) == "hello..."
+        assert truncate("hello world", 11) == "hello world"
+        assert truncate("hello world", 0) == "hello world"
+
+
+class TestRecordCache:
+    def test_encode_sequence_number(self):
+        sequence_numbers = [
+            0,
+            9,
+            10,
+            255,
+            256,
+            49657051368801430459340561020608066337892395447780114434,
+            49657051368801430459340561020609275263712010076954820610,
+        ]
+
+        # 桁数が異なってもバイト列の順序が数値の順序と一致することを確認
+        encoded = [encode_sequence_number(n) for n in sequence_numbers]
+        assert sorted(encoded) == encoded
+        assert [decode_sequence_number(value) for value in encoded] == sequence_numbers
+
+    def test_iter_batches_numeric_order(self, tmp_path):
+        cache = RecordCache(str(tmp_path), REGION, STREAM_NAME)
+        records = [
+            {const.SEQ_NUM: n, const.DATA: b"", const.PARTITION_KEY: "", const.TIMESTAMP: 0}
+            for n in (9, 10, 100)
+        ]
+        cache.append("shardId-000000000000", records)
+
+        # シーケンス番号が数値順に返却されることを確認
+        batches = list(cache.iter_batches("shardId-000000000000", batch_size=2))
+        assert [record[const.SEQ_NUM] for batch in batches for record in batch] == [9, 10, 100]
+        assert cache.last_sequence_number("shardId-000000000000") == 100
+        recent_records = cache.recent_records("shardId-000000000000", 1)
+        assert recent_records[0][const.SEQ_NUM] == 100
+
+
+class TestDataDecoder:
+    @staticmethod
+    def _protobuf_field(field: int, value: bytes) -> bytes:
+        """長さ付きのprotobufフィールドを生成する(127byte以下のみ)"""
+        return bytes([field << 3 | 2, len(value)]) + value
+
+    def _kpl_aggregate(self, payloads: list[bytes]) -> bytes:
+        """KPLの集約レコードを生成する"""
+        message = self._protobuf_field(1, b"key") + b"".join(
+            self._protobuf_field(3, b"\x08\x00" + self._protobuf_field(3, payload))
+            for payload in payloads
+        )
+        return KPL_MAGIC + message + hashlib.md5(message).digest()
+
+    def test_decode(self):
+        assert DataDecoder().decode(b"hello world") == "hello world"
+        assert DataDecoder("gzip").decode(gzip.compress(b"hello world")) == "hello world"
+        assert DataDecoder("base64").decode(base64.b64encode(b"hello world")) == "hello world"
+        assert DataDecoder("kpl").decode(self._kpl_aggregate([b"hello", b"world"])) == (
+            "hello\nworld"
+        )
+        # 複数のデコーダーを指定した順に適用できることを確認
+        aggregated = self._kpl_aggregate([gzip.compress(b"hello"), gzip.compress(b"world")])
+        assert DataDecoder("kpl,gzip").decode(aggregated) == "hello\nworld"
+        assert DataDecoder("auto").decode(aggregated) == "hello\nworld"
+
+    def test_decode_binary(self):
+        # UTF-8として解釈できないDataや形式の異なるDataでも例外とならないことを確認
+        assert DataDecoder().decode(b"\xff\xfehello") == "\\xff\\xfehello"
+        assert DataDecoder("gzip,base64,kpl").decode(b"hello world") == "hello world"
+
+    def test_field_multiline(self):
+        # 改行を含む整形済みのJSON、KPLで集約された各ユーザーレコードのJSONを検索できることを確認
+        pretty = json.dumps({"recordId": "abc", "detail": {"id": 1}}, indent=2).encode()
+        query = SearchQuery.parse("recordId=abc")
+        assert SearchEngine(DataDecoder()).match(query, pretty, "pk")
+        assert SearchEngine(DataDecoder()).match(query, b'{"recordId": "abc"}', "pk")
+        aggregated = self._kpl_aggregate(
+            [json.dumps({"recordId": "xyz"}, indent=2).encode(), pretty]
+        )
+        engine = SearchEngine(DataDecoder("kpl"))
+        assert engine.match(query, aggregated, "pk")
+        assert engine.index_record(SearchQuery.parse("detail.id=1"), aggregated, "pk") == (
+            True,
+            {"1"},
+        )
+        assert engine.index_record(query, aggregated, "pk")[1] == {"abc", "xyz"}
+
+    def test_invalid_decoder(self):
+        with pytest.raises(ValueError):
+            DataDecoder("zstd")
+
+
+class TestRecordStore:
+    def test_shard_records(self):
+        shard = ShardRecords("shardId-000000000000")
+        shard.extend(
+            [
+                {
+                    const.SEQ_NUM: 10 + n,
+                    const.DATA: b"hello world",
+                    const.PARTITION_KEY: "key",
+                    const.TIMESTAMP: 1729747423000 + n,
+                }
+                for n in range(3)
+            ]
+        )
+
+        # 列ごとに格納したレコードをdictionaryとして参照できることを確認
+        assert len(shard) == 3
+        assert shard.record(2) == {
+            const.SEQ_NUM: 12,
+            const.DATA: b"hello world",
+            const.PARTITION_KEY: "key",
+            const.TIMESTAMP: 1729747423002,
+        }
+        assert [record[const.SEQ_NUM] for record in shard.iter_records(1)] == [11, 12]
+        assert shard.partition_keys[0] is shard.partition_keys[1]
+
+
+class TestShardReadScheduler:
+    def test_workers_for(self):
+        scheduler = ShardReadScheduler(max_concurrency=8)
+
+        # シャード数と上限値の小さい方がスレッド数となることを確認
+        assert scheduler.workers_for(3) == 3
+        assert scheduler.workers_for(64) == 8
+        assert scheduler.workers_for(0) == 1
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=100, capacity=1)
+
+        # 1つ目は即時取得でき、2つ目は補充を待機することを確認
+        assert bucket.acquire() == 0
+        assert bucket.acquire() > 0
+
+    def test_call_retry_on_throttling(self):
+        scheduler = ShardReadScheduler(max_retries=3, base_backoff=0.001)
+        calls = []
+
+        def throttled_api(**kwargs) -> str:
+            """2回スロットリングした後に成功するスタブ"""
+            calls.append(kwargs)
+            if len(calls) <= 2:
+                error = {"Error": {"Code": "ProvisionedThroughputExceededException"}}
+                raise ClientError(error, "GetRecords")  # type: ignore
+            return "ok"
+
+        assert scheduler.call("shardId-000000000000", throttled_api, Limit=1) == "ok"
+        assert len(calls) == 3
+
+    def test_call_async_retry_on_throttling(self):
+        scheduler = ShardReadScheduler(max_retries=3, base_backoff=0.001)
+        calls = []
+
+        async def throttled_api(**kwargs) -> str:
+            """2回スロットリングした後に成功するスタブ"""
+            calls.append(kwargs)
+            if len(calls) <= 2:
+                error = {"Error": {"Code": "ProvisionedThroughputExceededException"}}
+                raise ClientError(error, "GetRecords")  # type: ignore
+            return "ok"
+
+        result = asyncio.run(scheduler.call_async("shardId-000000000000", throttled_api, Limit=1))
+        assert result == "ok"
+        assert len(calls) == 3
+
+    def test_call_hooks(self):
+        metrics = ReadMetrics()
+        scheduler = ShardReadScheduler(max_retries=3, base_backoff=0.001, hooks=metrics)
+        calls = []
+
+        def get_records(**kwargs) -> str:
+            """1回スロットリングした後に成功するスタブ"""
+            calls.append(kwargs)
+            if len(calls) <= 1:
+                error = {"Error": {"Code": "ProvisionedThroughputExceededException"}}
+                raise ClientError(error, "GetRecords")  # type: ignore
+            return "ok"
+
+        # 試行ごとの呼び出し、スロットリング、再試行がシャードとAPIごとに集計されることを確認
+        scheduler.call("shardId-000000000000", get_records)
+        result = metrics.to_dict()
+        assert result["total"]["api_calls"] == 2
+        assert result["total"]["throttles"] == 1
+        assert result["total"]["retries"] == 1
+        assert result["operations"]["get_records"]["api_calls"] == 2
+        assert result["shards"]["shardId-000000000000"]["latency_ms"]["count"] == 2
+
+    def test_call_raise_after_max_retries(self):
+        scheduler = ShardReadScheduler(max_retries=1, base_backoff=0.001)
+
+        def throttled_api() -> str:
+            """常にスロットリングするスタブ"""
+            error = {"Error": {"Code": "ProvisionedThroughputExceededException"}}
+            raise ClientError(error, "GetRecords")  # type: ignore
+
+        with pytest.raises(ClientError):
+            scheduler.call("shardId-000000000000", throttled_api)
@@ -24,3 +24,27 @@ def error_handling(func):
             raise e
 
     return wrapper
+
+
+class AsyncClientAdapter:
+    """同期のboto3クライアントをaiobotocoreのクライアントと同じ非同期のAPIで呼び出すアダプター
+
+    motoはaiobotocoreの通信をモックできないため、非同期読み取りのテストで使用する
+    """
+
+    def __init__(self, client) -> None:
+        self.client = client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        return None
+
+    def __getattr__(self, name: str):
+        method = getattr(self.client, name)
+
+        async def call(**kwargs):
+            return method(**kwargs)
+
+        return call